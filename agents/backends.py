@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Iterator
+
+# KQLTUTOR_LLM_BACKEND selects what LLMClient talks to:
+#   gemini  the real google.generativeai model (default)
+#   fake    FakeBackend, no network or API key needed
+#   record  the real model, with every response appended to the replay file
+BACKEND_KINDS = ("gemini", "fake", "record")
+
+def backend_kind() -> str:
+    kind = os.getenv("KQLTUTOR_LLM_BACKEND", "gemini").strip().lower()
+    return kind if kind in BACKEND_KINDS else "gemini"
+
+def replay_path() -> str:
+    from .base import CACHE_DIR
+    return os.getenv("KQLTUTOR_REPLAY_FILE") or os.path.join(CACHE_DIR, "replay.jsonl")
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+class Response:
+    """Minimal stand-in for a generate_content response (or one streamed chunk)."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+class LLMBackend(ABC):
+    """What LLMClient needs from a model: generate_content(prompt) returning an
+    object with .text, or with stream=True an iterator of such chunks.
+    google.generativeai.GenerativeModel already has this shape."""
+
+    model_name = "backend"
+
+    @abstractmethod
+    def generate_content(self, prompt: str, stream: bool = False) -> Any:
+        ...
+
+class LatencyModel:
+    """Response time distribution, parsed from specs like:
+    fixed:0.5   uniform:0.2,1.5   normal:1.0,0.3   lognormal:0.8,0.5 (median, sigma)
+    Values are seconds; samples are never negative."""
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, args = spec.partition(":")
+        self.kind = kind.strip().lower() or "fixed"
+        self.args = [float(a) for a in args.split(",") if a.strip()] or [0.0]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.spec = spec
+
+    def sample(self, rng: random.Random) -> float:
+        a = self.args
+        if self.kind == "uniform":
+            value = rng.uniform(a[0], a[1] if len(a) > 1 else a[0])
+        elif self.kind == "normal":
+            value = rng.gauss(a[0], a[1] if len(a) > 1 else 0.0)
+        elif self.kind == "lognormal":
+            value = a[0] * rng.lognormvariate(0.0, a[1] if len(a) > 1 else 0.0) if a[0] > 0 else 0.0
+        else:
+            value = a[0]
+        return max(0.0, value)
+
+def load_replay(path: str) -> dict[str, str]:
+    """prompt hash -> response text from a replay file (later lines win)."""
+    recorded = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    recorded[entry["key"]] = entry["response"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    continue
+    except OSError:
+        pass
+    return recorded
+
+class FakeBackend(LLMBackend):
+    """Local stand-in for the Gemini model.
+
+    Prompts found in the replay file get their recorded response; any other
+    prompt gets a canned, well-formed response for the agent that sent it, so
+    every agent runs end to end offline. Latency, 5xx errors and 429s are
+    injected with the configured distribution and rates; 429 messages carry a
+    retry hint so the client's backoff path is exercised too."""
+
+    model_name = "fake"
+
+    def __init__(self, replay: str | dict | None = None, latency: LatencyModel | str = "fixed:0", error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 0.5, chunk_size: int = 40, seed: int | None = None):
+        self.recorded = load_replay(replay) if isinstance(replay, str) else dict(replay or {})
+        self.latency = LatencyModel(latency) if isinstance(latency, str) else latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.chunk_size = max(1, chunk_size)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.replayed = 0
+        self.errors = 0
+        self.throttled = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeBackend":
+        seed = os.getenv("KQLTUTOR_FAKE_SEED")
+        return cls(
+            replay=replay_path(),
+            latency=os.getenv("KQLTUTOR_FAKE_LATENCY", "lognormal:0.8,0.4"),
+            error_rate=float(os.getenv("KQLTUTOR_FAKE_ERROR_RATE", "0")),
+            throttle_rate=float(os.getenv("KQLTUTOR_FAKE_429_RATE", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def generate_content(self, prompt: str, stream: bool = False) -> Any:
+        with self._lock:
+            self.calls += 1
+            delay = self.latency.sample(self._rng)
+            roll = self._rng.random()
+            text = self.recorded.get(prompt_key(prompt))
+            if text is not None:
+                self.replayed += 1
+            else:
+                text = canned_response(prompt, self._rng)
+        if roll < self.throttle_rate:
+            with self._lock:
+                self.throttled += 1
+            time.sleep(delay * 0.1)
+            raise Exception(f"429 Resource exhausted (injected). Please retry in {self.retry_after}s")
+        if roll < self.throttle_rate + self.error_rate:
+            with self._lock:
+                self.errors += 1
+            time.sleep(delay)
+            raise Exception("503 Service unavailable (injected)")
+        if not stream:
+            time.sleep(delay)
+            return Response(text)
+        return self._stream(text, delay)
+
+    def _stream(self, text: str, delay: float) -> Iterator[Response]:
+        # About a third of the latency before the first chunk, the rest spread over the chunks
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+        time.sleep(delay / 3)
+        per_chunk = (delay - delay / 3) / len(chunks)
+        for chunk in chunks:
+            yield Response(chunk)
+            time.sleep(per_chunk)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "replayed": self.replayed, "errors": self.errors, "throttled": self.throttled,
+                    "latency": self.latency.spec}
+
+class RecordingBackend(LLMBackend):
+    """Wraps a real model and appends every successful response to a replay file
+    that FakeBackend can serve later."""
+
+    def __init__(self, model: Any, path: str):
+        self.model = model
+        self.path = path
+        self.model_name = getattr(model, "model_name", None) or getattr(model, "name", "recorded")
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt: str, stream: bool = False) -> Any:
+        if not stream:
+            response = self.model.generate_content(prompt)
+            from .base import extract_text
+            self.record(prompt, extract_text(response))
+            return response
+        return self._stream(prompt)
+
+    def _stream(self, prompt: str) -> Iterator[Any]:
+        parts = []
+        for chunk in self.model.generate_content(prompt, stream=True):
+            try:
+                parts.append(chunk.text or "")
+            except Exception:
+                pass
+            yield chunk
+        self.record(prompt, "".join(parts))
+
+    def record(self, prompt: str, text: str | None) -> None:
+        if not text:
+            return
+        line = json.dumps({"key": prompt_key(prompt), "prompt": prompt, "response": text, "ts": time.time()})
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError:
+                pass
+
+FAKE_TASKS = [
+    ("Distinct hosts with failed logins in 24h\n• Table: SecurityEvent\n• Time range: Last 24 hours (ago(24h))\n• Filter: EventID == 4625 (failed logon)\n• Output: Distinct HostName values",
+     "SecurityEvent | where TimeGenerated >= ago(24h) and EventID == 4625 | distinct HostName"),
+    ("Count sign-ins per user today\n• Table: SigninLogs\n• Time range: From start of today (startofday(now()))\n• Group by: UserPrincipalName\n• Aggregation: Count sign-ins per user",
+     "SigninLogs | where TimeGenerated >= startofday(now()) | summarize Count = count() by UserPrincipalName | order by Count desc"),
+    ("Failed logons per host in 7d\n• Table: SecurityEvent\n• Time range: Last 7 days (ago(7d))\n• Filter: EventID == 4625 (failed logon)\n• Group by: HostName",
+     "SecurityEvent | where TimeGenerated >= ago(7d) and EventID == 4625 | summarize Failures = count() by HostName | order by Failures desc"),
+]
+
+def _prompt_query(prompt: str) -> str:
+    m = re.search(r"^(?:USER QUERY|QUERY TO \w+|QUERY):\n(.*?)\n\n", prompt, re.MULTILINE | re.DOTALL)
+    return m.group(1).strip() if m else ""
+
+def _section_json(section: str, query: str) -> dict:
+    if section == "TUTOR":
+        return {"lesson": ["Start from the table the task names", "Filter on TimeGenerated first", "Aggregate with summarize ... by"],
+                "alternatives": ["Use dcount() for distinct counts"], "task_relevance": "Covers the filters and aggregation the task asks for."}
+    if section == "FIXER":
+        return {"corrected_query": query, "task_coverage": "The query covers the task requirements.", "improvements": []}
+    if section == "OPTIMIZER":
+        return {"optimized_query": query, "improvements": ["Filter before aggregating"], "task_alignment": "Keeps the task result while scanning less."}
+    return {"explanation": "The query filters the table to the task's time window and returns the requested fields.",
+            "task_connection": "It answers the task question directly."}
+
+def canned_response(prompt: str, rng: random.Random) -> str:
+    """A well-formed response for whichever agent prompt this is."""
+    query = _prompt_query(prompt)
+    if "fields 'task' and 'query'" in prompt:
+        task, q = rng.choice(FAKE_TASKS)
+        return json.dumps({"task": task, "query": q})
+    if prompt.startswith("You are a KQL task evaluator"):
+        return json.dumps({"fulfills_task": "Yes", "task_requirements": ["Table", "Time range", "Filter"],
+                           "query_coverage": "Filters and projects the requested data.", "missing_elements": [],
+                           "reason": "The query addresses the task requirements."})
+    sections = re.findall(r"^=== (TUTOR|FIXER|OPTIMIZER|EXPLAINER) ===$", prompt, re.MULTILINE)
+    if sections:
+        return "\n".join(f"=== {s} ===\n{json.dumps(_section_json(s, query))}" for s in sections)
+    for section, marker in (("TUTOR", "KQL tutor"), ("FIXER", "KQL fixer"), ("OPTIMIZER", "KQL optimizer"), ("EXPLAINER", "KQL explainer")):
+        if marker in prompt[:80]:
+            return json.dumps(_section_json(section, query))
+    return "OK"
@@ -1,5 +1,18 @@
+import asyncio
+import hashlib
+import json
 import os
-from dataclasses import dataclass
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from dataclasses import dataclass, field
+from typing import Any, Callable
+from .backends import LLMBackend, FakeBackend, RecordingBackend, backend_kind, replay_path
+from .cache import ResponseCache
+from .ratelimit import PRIORITY_INTERACTIVE, estimate_tokens, get_rate_limiter
+from kql_canon import canonical_query
 
 @dataclass
 class AgentResult:
@@ -10,140 +23,417 @@ class AgentResult:
     suggestions: list[str] | None = None
     fulfills_task: bool | None = None
     reason: str | None = None
+    # Rule-based certainty of the verdict and the requirements it checked (evaluator only)
+    confidence: float | None = None
+    checks: list[dict] | None = None
+    exact_match: bool = False
+    # Set when a deadline expired: this is the rule-based result and pending will
+    # resolve to the LLM-enhanced one
+    enhancing: bool = False
+    pending: Any = field(default=None, repr=False, compare=False)
+
+def cache_text(prompt: str, query: str | None) -> str:
+    if not query or not query.strip() or query not in prompt:
+        return prompt
+    return prompt.replace(query, canonical_query(query))
+
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("KQLTUTOR_HEDGE_WORKERS", "16")), thread_name_prefix="llm-hedge")
+
+def run_with_deadline(agent: Any, context: dict, budget: float | None = None, on_text: Callable[[str], None] | None = None) -> Any:
+    """Run agent with a latency budget.
+
+    If the LLM-backed run is not done within budget (default agent.latency_budget),
+    the agent's deterministic finish(context, None) result is returned right away,
+    marked enhancing, with pending holding the future of the full run. The run is
+    not cancelled, so its response still lands in the response cache for the next
+    identical request."""
+    if not agent.llm.use_google:
+        return agent.run(context)
+    budget = agent.latency_budget if budget is None else budget
+    future = _hedge_pool.submit(agent.run, context, on_text)
+    try:
+        return future.result(timeout=budget)
+    except FuturesTimeout:
+        fallback = agent.finish(context, None)
+        for r in (fallback.values() if isinstance(fallback, dict) else [fallback]):
+            r.enhancing = True
+            r.pending = future
+        return fallback
+
+# At or above this rule-based confidence the evaluator's LLM call is skipped
+# and the downstream agents skip or shorten theirs
+CONFIDENCE_SKIP = float(os.getenv("KQLTUTOR_CONFIDENCE_SKIP", "0.9"))
+
+def is_decisive(context: dict) -> bool:
+    """True when the evaluation in context is a high-confidence rule verdict."""
+    evaluation = context.get("evaluation")
+    return bool(evaluation and evaluation.confidence is not None and evaluation.confidence >= CONFIDENCE_SKIP)
+
+def evaluation_header(context: dict, query_label: str = "QUERY", query: str | None = None) -> str:
+    """TASK / QUERY / TASK EVALUATION block shared by the agent prompts."""
+    evaluation = context.get("evaluation")  # Get evaluation result
+    fulfills_task = evaluation.fulfills_task if evaluation else None
+    eval_status = "fulfills" if fulfills_task else "does NOT fulfill"
+    eval_reason = evaluation.reason if evaluation and evaluation.reason else "Not evaluated"
+    q = query if query is not None else context.get("query", "")
+    return (
+        "TASK:\n" + str(context.get("task") or "") + "\n\n"
+        + query_label + ":\n" + q + "\n\n"
+        + f"TASK EVALUATION: The query {eval_status} the task.\n"
+        + f"Evaluation details: {eval_reason}\n\n"
+        + (checked_requirements(evaluation) if is_decisive(context) else "")
+    )
+
+def checked_requirements(evaluation: AgentResult) -> str:
+    lines = [f"- {'PASS' if c['passed'] else 'FAIL'}: {c['requirement']}" for c in evaluation.checks or []]
+    return ("Checked requirements (rule-based, certain):\n" + "\n".join(lines) + "\n\n") if lines else ""
+
+MODEL_CACHE_TTL = 24 * 3600
+CACHE_DIR = os.getenv("KQLTUTOR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "kqltutor"))
+LLM_TIMEOUT = float(os.getenv("KQLTUTOR_LLM_TIMEOUT", "30"))
+LLM_MAX_CONCURRENCY = int(os.getenv("KQLTUTOR_LLM_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_BASE = 1.0
+LLM_BACKOFF_CAP = 16.0
+PREFERRED_MODELS = ['gemini-2.5-flash', 'gemini-2.5-pro', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro', 'gemini-flash-latest']
+
+_model_name_cache: dict = {}
+_shared_clients: dict = {}
+_shared_lock = threading.Lock()
+_response_cache: ResponseCache | None = None
+_cache_lock = threading.Lock()
+_llm_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+# Blocking model calls run here rather than on the event loop's default executor:
+# asyncio.run joins that executor on exit, so a call abandoned at its deadline
+# would hold the synchronous generate() until the model answered
+_call_pool = ThreadPoolExecutor(max_workers=4 * LLM_MAX_CONCURRENCY, thread_name_prefix="llm-call")
+
+def get_response_cache() -> ResponseCache:
+    """Process-wide response cache; KQLTUTOR_LLM_CACHE=0 keeps it memory-only."""
+    global _response_cache
+    with _cache_lock:
+        if _response_cache is None:
+            persist = os.getenv("KQLTUTOR_LLM_CACHE", "1") != "0"
+            _response_cache = ResponseCache(os.path.join(CACHE_DIR, "responses.sqlite3") if persist else None)
+        return _response_cache
+
+def _model_cache_path() -> str:
+    return os.path.join(CACHE_DIR, "model.json")
+
+def load_cached_model_name(api_key: str) -> str | None:
+    key = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    entry = _model_name_cache.get(key)
+    if entry is None:
+        try:
+            with open(_model_cache_path()) as f:
+                entry = json.load(f).get(key)
+        except Exception:
+            entry = None
+    if entry and time.time() - entry.get("ts", 0) < MODEL_CACHE_TTL:
+        _model_name_cache[key] = entry
+        return entry.get("model")
+    return None
+
+def store_cached_model_name(api_key: str, model_name: str | None) -> None:
+    key = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    path = _model_cache_path()
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except Exception:
+        data = {}
+    if model_name:
+        entry = {"model": model_name, "ts": time.time()}
+        _model_name_cache[key] = entry
+        data[key] = entry
+    else:
+        _model_name_cache.pop(key, None)
+        data.pop(key, None)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+    except Exception:
+        pass
+
+def get_shared_client(use_google: bool = False) -> "LLMClient":
+    """One LLMClient per process (and API key and backend); model discovery runs at most once."""
+    key = (bool(use_google), os.getenv("GOOGLE_API_KEY") or "", backend_kind())
+    with _shared_lock:
+        client = _shared_clients.get(key)
+        if client is None:
+            client = LLMClient(use_google)
+            _shared_clients[key] = client
+        return client
 
 class LLMClient:
-    def __init__(self, use_google: bool = False):
+    def __init__(self, use_google: bool = False, backend: LLMBackend | None = None):
+        """backend replaces the Gemini model (see agents.backends); by default it
+        comes from KQLTUTOR_LLM_BACKEND, where "fake" needs no API key or network."""
         api_key = os.getenv("GOOGLE_API_KEY")
-        self.use_google = use_google and bool(api_key)
+        if backend is None and backend_kind() == "fake":
+            backend = FakeBackend.from_env()
+        self.backend = backend
+        self.use_google = use_google and (backend is not None or bool(api_key))
         self.model = None
+        self._model_name = None
         self._last_error = None
-        if self.use_google:
+        self._api_key = api_key or ""
+        self._lock = threading.Lock()
+        self.cache = get_response_cache()
+        self.limiter = get_rate_limiter()
+        if self.use_google and backend is not None:
+            self.model = backend
+            self._model_name = backend.model_name
+        elif self.use_google:
             try:
                 import google.generativeai as genai
-                if api_key:
-                    genai.configure(api_key=api_key)
-                    # Try to find an available model by listing them
-                    model_name = None
-                    available_model_names = []
-                    
-                    # List available models
-                    try:
-                        models = genai.list_models()
-                        model_map = {}  # Map short names to full names
-                        for model in models:
-                            if hasattr(model, 'supported_generation_methods') and 'generateContent' in model.supported_generation_methods:
-                                full_name = model.name  # Keep full name like 'models/gemini-1.5-flash'
-                                # Extract short name for matching
-                                short_name = full_name.split('/')[-1] if '/' in full_name else full_name
-                                model_map[short_name] = full_name
-                                available_model_names.append(short_name)
-                        
-                        # Prefer stable models for free tier (avoid experimental models that may have quota issues)
-                        preferred_models = ['gemini-2.5-flash', 'gemini-2.5-pro', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro', 'gemini-flash-latest']
-                        for preferred in preferred_models:
-                            if preferred in model_map:
-                                model_name = model_map[preferred]  # Use full name
-                                break
-                        
-                        # If no preferred model found, use first available
-                        if not model_name and available_model_names:
-                            first_short = available_model_names[0]
-                            model_name = model_map.get(first_short, first_short)
-                            
-                    except Exception as list_error:
-                        # If listing fails, try common free tier models directly
-                        self._last_error = f"List models error: {str(list_error)}. Trying direct model names..."
-                        preferred_models = ['gemini-2.5-flash', 'gemini-2.5-pro', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro']
-                        for preferred in preferred_models:
-                            try:
-                                # Test if model works by trying to create it
-                                test_model = genai.GenerativeModel(preferred)
-                                model_name = preferred
-                                break
-                            except Exception:
-                                continue
-                    
-                    # If still no model found, try with 'models/' prefix
-                    if not model_name:
-                        try:
-                            self.model = genai.GenerativeModel('models/gemini-2.5-flash')
-                            model_name = 'models/gemini-2.5-flash'
-                        except Exception:
-                            pass
-                    
-                    if model_name:
-                        self.model = genai.GenerativeModel(model_name)
-                        self._model_name = model_name  # Store for debugging
-                    else:
-                        raise Exception(f"No available models found. Tried: {available_model_names if available_model_names else 'none'}")
-                else:
-                    self.use_google = False
+                genai.configure(api_key=api_key)
+                model_name = load_cached_model_name(self._api_key)
+                if not model_name:
+                    model_name = self._discover_model_name()
+                    store_cached_model_name(self._api_key, model_name)
+                self.model = self._wrap(genai.GenerativeModel(model_name))
+                self._model_name = model_name  # Store for debugging
             except Exception as e:
                 # If initialization fails, disable Google AI
                 self.use_google = False
                 self.model = None
                 self._last_error = str(e)
 
-    def generate(self, prompt: str) -> str | None:
-        if not self.use_google or not self.model:
-            return None
+    def _wrap(self, model: Any) -> Any:
+        # Record mode keeps talking to the real model but captures every response
+        return RecordingBackend(model, replay_path()) if backend_kind() == "record" else model
+
+    def _discover_model_name(self) -> str:
+        import google.generativeai as genai
+        # Try to find an available model by listing them
+        model_name = None
+        available_model_names = []
+
+        # List available models
         try:
-            # Use the standard google.generativeai API
-            response = self.model.generate_content(prompt)
-            
-            # Extract text from response
-            if response is None:
-                return None
-            
-            # Standard google.generativeai response format
-            # The response object has a .text property that returns the generated text
-            try:
-                # Try accessing .text directly (it's a property, not a method)
-                text = response.text
-                if text and isinstance(text, str) and text.strip():
-                    return text.strip()
-            except AttributeError:
-                # .text might not exist, try alternative access
-                pass
-            except Exception as e:
-                # Some other error accessing .text
-                pass
-            
-            # Alternative: get from candidates structure
+            models = genai.list_models()
+            model_map = {}  # Map short names to full names
+            for model in models:
+                if hasattr(model, 'supported_generation_methods') and 'generateContent' in model.supported_generation_methods:
+                    full_name = model.name  # Keep full name like 'models/gemini-1.5-flash'
+                    # Extract short name for matching
+                    short_name = full_name.split('/')[-1] if '/' in full_name else full_name
+                    model_map[short_name] = full_name
+                    available_model_names.append(short_name)
+
+            # Prefer stable models for free tier (avoid experimental models that may have quota issues)
+            for preferred in PREFERRED_MODELS:
+                if preferred in model_map:
+                    model_name = model_map[preferred]  # Use full name
+                    break
+
+            # If no preferred model found, use first available
+            if not model_name and available_model_names:
+                first_short = available_model_names[0]
+                model_name = model_map.get(first_short, first_short)
+
+        except Exception as list_error:
+            # If listing fails, try common free tier models directly
+            self._last_error = f"List models error: {str(list_error)}. Trying direct model names..."
+            for preferred in PREFERRED_MODELS[:5]:
+                try:
+                    # Test if model works by trying to create it
+                    genai.GenerativeModel(preferred)
+                    model_name = preferred
+                    break
+                except Exception:
+                    continue
+
+        # If still no model found, fall back to the 'models/' prefixed default
+        if not model_name:
             try:
-                if hasattr(response, 'candidates') and response.candidates and len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    if hasattr(candidate, 'content'):
-                        content = candidate.content
-                        if hasattr(content, 'parts') and content.parts and len(content.parts) > 0:
-                            part = content.parts[0]
-                            # Part can be a string or have a text attribute
-                            if isinstance(part, str):
-                                return part.strip()
-                            elif hasattr(part, 'text'):
-                                text = part.text
-                                if text and isinstance(text, str):
-                                    return text.strip()
+                genai.GenerativeModel('models/gemini-2.5-flash')
+                model_name = 'models/gemini-2.5-flash'
             except Exception:
                 pass
-            
-            # Last resort: try to convert response to string
+
+        if not model_name:
+            raise Exception(f"No available models found. Tried: {available_model_names if available_model_names else 'none'}")
+        return model_name
+
+    def _rediscover(self) -> bool:
+        """Drop the cached model name and list models again; used when the model stops working."""
+        if self.backend is not None:
+            return False
+        with self._lock:
             try:
-                response_str = str(response)
-                if response_str and response_str != "None":
-                    return response_str
-            except Exception:
-                pass
-            
+                import google.generativeai as genai
+                store_cached_model_name(self._api_key, None)
+                model_name = self._discover_model_name()
+                store_cached_model_name(self._api_key, model_name)
+                self.model = self._wrap(genai.GenerativeModel(model_name))
+                self._model_name = model_name
+                return True
+            except Exception as e:
+                self._last_error = str(e)
+                return False
+
+    def generate(self, prompt: str, cache: bool = True, timeout: float | None = None, priority: int = PRIORITY_INTERACTIVE, on_text: Callable[[str], None] | None = None, query: str | None = None) -> str | None:
+        """Blocking wrapper around agenerate, safe to call from worker threads."""
+        if not self.use_google or not self.model:
             return None
-        except Exception as e:
-            # Store error for debugging (could be logged in production)
-            error_msg = str(e)
-            self._last_error = error_msg
-            
-            # Check if it's a quota error
-            if '429' in error_msg or 'quota' in error_msg.lower() or 'rate limit' in error_msg.lower():
-                # Quota exceeded - user needs to wait or check their plan
-                self._last_error = f"Quota exceeded. Please wait and try again, or check your API plan. Error: {error_msg[:200]}"
-            
+        return run_sync(self.agenerate(prompt, cache=cache, timeout=timeout, priority=priority, on_text=on_text, query=query))
+
+    async def agenerate(self, prompt: str, cache: bool = True, timeout: float | None = None, priority: int = PRIORITY_INTERACTIVE, on_text: Callable[[str], None] | None = None, query: str | None = None) -> str | None:
+        """Generate with a per-call deadline, a process-wide concurrency limit and
+        exponential backoff with jitter on 429/5xx errors (honouring retry hints).
+
+        Each attempt first takes a slot from the client-side rate limiter; when
+        the budget is short for this priority the call returns None so the agent
+        uses its rule-based output.
+
+        With on_text the response is streamed and on_text receives the text
+        generated so far after every chunk (once, in full, on a cache hit).
+
+        query is the student query embedded in the prompt; the cache key uses
+        its canonical form, so resubmissions that differ only in spacing,
+        limit/take or `and` order share one response."""
+        if not self.use_google or not self.model:
             return None
+        key = self.cache.key(self._model_name, cache_text(prompt, query)) if cache else None
+        if key:
+            hit = self.cache.get(key)
+            if hit is not None:
+                if on_text:
+                    on_text(hit)
+                return hit
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or LLM_TIMEOUT)
+        attempt = 0
+        rediscovered = False
+        tokens = estimate_tokens(prompt)
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._last_error = "LLM call timed out"
+                return None
+            if not await loop.run_in_executor(_call_pool, self.limiter.acquire, tokens, priority, remaining):
+                self._last_error = "Rate budget exhausted for this priority; using rule-based output"
+                return None
+            try:
+                response = await asyncio.wait_for(loop.run_in_executor(_call_pool, self._call, prompt, remaining, on_text), remaining)
+                text = response if isinstance(response, str) else extract_text(response)
+                if text and key:
+                    self.cache.put(key, text)
+                return text
+            except asyncio.TimeoutError:
+                self._last_error = "LLM call timed out"
+                return None
+            except Exception as e:
+                # Store error for debugging (could be logged in production)
+                error_msg = str(e)
+                self._last_error = error_msg
+                if '429' in error_msg or 'resource exhausted' in error_msg.lower():
+                    self.limiter.throttled()
+                if is_retryable(error_msg) and attempt < LLM_MAX_RETRIES:
+                    delay = retry_after(error_msg)
+                    if delay is None:
+                        delay = min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+                    if delay < deadline - loop.time():
+                        attempt += 1
+                        await asyncio.sleep(delay)
+                        continue
+                # Check if it's a quota error
+                if '429' in error_msg or 'quota' in error_msg.lower() or 'rate limit' in error_msg.lower():
+                    # Quota exceeded - user needs to wait or check their plan
+                    self._last_error = f"Quota exceeded. Please wait and try again, or check your API plan. Error: {error_msg[:200]}"
+                elif not rediscovered and ('404' in error_msg or 'not found' in error_msg.lower() or 'not supported' in error_msg.lower()):
+                    # The cached model went away - discover again once
+                    rediscovered = True
+                    if await loop.run_in_executor(_call_pool, self._rediscover):
+                        continue
+                return None
+
+    def _call(self, prompt: str, wait: float, on_text: Callable[[str], None] | None = None) -> Any:
+        # The slot is held by the worker thread itself, so calls abandoned by a
+        # timed-out caller still count against the concurrency limit until they return
+        if not _llm_slots.acquire(timeout=max(wait, 0)):
+            raise TimeoutError("No free LLM slot before the deadline")
+        try:
+            # Use the standard google.generativeai API
+            if on_text is None:
+                return self.model.generate_content(prompt)
+            parts = []
+            for chunk in self.model.generate_content(prompt, stream=True):
+                try:
+                    piece = chunk.text
+                except Exception:
+                    piece = extract_text(chunk)
+                if piece:
+                    parts.append(piece)
+                    on_text("".join(parts))
+            return "".join(parts).strip() or None
+        finally:
+            _llm_slots.release()
+
+def is_retryable(error_msg: str) -> bool:
+    msg = error_msg.lower()
+    return any(k in msg for k in ("429", "quota", "rate limit", "resource exhausted", "resourceexhausted", "500", "502", "503", "504", "unavailable", "internal error", "deadline exceeded"))
+
+def retry_after(error_msg: str) -> float | None:
+    # Gemini errors carry hints like "Please retry in 13.2s" or "retry_delay { seconds: 13 }"
+    m = re.search(r"retry in ([\d.]+)\s*s", error_msg, re.IGNORECASE) or re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", error_msg) or re.search(r"retry-after:?\s*([\d.]+)", error_msg, re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+def run_sync(coro: Any) -> Any:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # Called from inside an event loop: run on a helper thread with its own loop
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        return ex.submit(asyncio.run, coro).result()
+
+def extract_text(response: Any) -> str | None:
+    # Extract text from response
+    if response is None:
+        return None
+
+    # Standard google.generativeai response format
+    # The response object has a .text property that returns the generated text
+    try:
+        # Try accessing .text directly (it's a property, not a method)
+        text = response.text
+        if text and isinstance(text, str) and text.strip():
+            return text.strip()
+    except AttributeError:
+        # .text might not exist, try alternative access
+        pass
+    except Exception:
+        # Some other error accessing .text
+        pass
+
+    # Alternative: get from candidates structure
+    try:
+        if hasattr(response, 'candidates') and response.candidates and len(response.candidates) > 0:
+            candidate = response.candidates[0]
+            if hasattr(candidate, 'content'):
+                content = candidate.content
+                if hasattr(content, 'parts') and content.parts and len(content.parts) > 0:
+                    part = content.parts[0]
+                    # Part can be a string or have a text attribute
+                    if isinstance(part, str):
+                        return part.strip()
+                    elif hasattr(part, 'text'):
+                        text = part.text
+                        if text and isinstance(text, str):
+                            return text.strip()
+    except Exception:
+        pass
+
+    # Last resort: try to convert response to string
+    try:
+        response_str = str(response)
+        if response_str and response_str != "None":
+            return response_str
+    except Exception:
+        pass
+
+    return None
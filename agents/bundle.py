@@ -0,0 +1,93 @@
+import json
+import re
+from typing import Callable
+from .base import AgentResult, LLMClient, get_shared_client, evaluation_header
+from .ratelimit import PRIORITY_ASSIST
+from .tutor import TutorAgent
+from .fixer import FixerAgent
+from .optimizer import OptimizerAgent
+from .explainer import ExplainerAgent
+
+SECTION_RE = re.compile(r"^[ \t>#*]*=+\s*\[?(TUTOR|FIXER|OPTIMIZER|EXPLAINER)\]?\s*=+[ \t*]*$", re.IGNORECASE | re.MULTILINE)
+
+def split_sections(txt: str, names: list[str]) -> dict[str, str]:
+    """Split a bundled response into per-agent text.
+
+    The prompt asks for '=== NAME ===' marker lines, each followed by that agent's
+    JSON object. If the model returns one JSON object keyed by section instead,
+    each value is re-serialized for the agent's own parser. Missing sections are
+    simply absent, and the agent falls back to its rule-based output."""
+    if not txt:
+        return {}
+    txt = re.sub(r"```(?:json)?", "", txt)
+    marks = list(SECTION_RE.finditer(txt))
+    sections = {}
+    if marks:
+        for m, nxt in zip(marks, marks[1:] + [None]):
+            body = txt[m.end():nxt.start() if nxt else len(txt)].strip()
+            if body:
+                sections[m.group(1).upper()] = body
+        return sections
+    start, end = txt.find("{"), txt.rfind("}")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        obj = json.loads(txt[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    lowered = {str(k).lower(): v for k, v in obj.items()} if isinstance(obj, dict) else {}
+    for name in names:
+        value = lowered.get(name.lower())
+        if isinstance(value, dict):
+            sections[name] = json.dumps(value)
+    return sections
+
+class AnalysisBundleAgent:
+    """Runs the Tutor/Fixer/Optimizer/Explainer fan-out as one LLM request.
+
+    The task, query and evaluation are sent once, followed by each agent's own
+    instructions; the response is split back per agent and handed to that
+    agent's finish() so the AgentResults match the per-agent mode."""
+
+    use_cache = True
+    priority = PRIORITY_ASSIST
+    latency_budget = 8.0
+
+    def __init__(self, use_google: bool = False, llm: LLMClient | None = None):
+        self.llm = llm or get_shared_client(use_google)
+        self.agents = {
+            "tutor": TutorAgent(llm=self.llm),
+            "fixer": FixerAgent(llm=self.llm),
+            "optimizer": OptimizerAgent(llm=self.llm),
+            "explainer": ExplainerAgent(llm=self.llm),
+        }
+
+    def prompt(self, context: dict) -> str:
+        q = context.get("query", "")
+        parts = [
+            "You are a KQL tutor, fixer, optimizer and explainer. Answer each section below for the same task and query.\n\n",
+            evaluation_header(context, "USER QUERY"),
+            "Output each section as a line '=== NAME ===' followed by that section's JSON object only, "
+            "with no markdown and no other text.\n\n",
+        ]
+        for agent in self.agents.values():
+            if not agent.needs_llm(context):
+                continue
+            parts.append(f"=== {agent.section} ===\n")
+            # Optimizer/Explainer may be given a query other than the user's
+            own = context.get({"OPTIMIZER": "fixed_query", "EXPLAINER": "optimized_query"}.get(agent.section, ""), q)
+            if own and own != q:
+                parts.append(f"Use this query for this section:\n{own}\n")
+            parts.append(agent.instructions(context) + "\n\n")
+        return "".join(parts)
+
+    def finish(self, context: dict, txt: str | None) -> dict[str, AgentResult]:
+        sections = split_sections(txt, [a.section for a in self.agents.values()]) if txt else {}
+        return {key: agent.finish(context, sections.get(agent.section)) for key, agent in self.agents.items()}
+
+    def run(self, context: dict, on_text: Callable[[str], None] | None = None) -> dict[str, AgentResult]:
+        txt = None
+        # Sections whose agent does not need the LLM are left out; skip the call if none do
+        if self.llm.use_google and any(agent.needs_llm(context) for agent in self.agents.values()):
+            txt = self.llm.generate(self.prompt(context), cache=self.use_cache, priority=self.priority, on_text=on_text, query=context.get("query")) or ""
+        return self.finish(context, txt)
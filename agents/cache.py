@@ -0,0 +1,156 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 7 * 24 * 3600
+# Another process (service and Streamlit sharing KQLTUTOR_CACHE_DIR) may hold the
+# write lock; past this wait a read counts as a miss and a write is skipped
+BUSY_TIMEOUT = 0.5
+# Eviction trims the disk cache to this share of max_disk, so it runs once per many puts
+EVICT_TO = 0.9
+
+class ResponseCache:
+    """Content-addressed LLM response cache: an in-memory LRU in front of SQLite.
+
+    Keys are sha256(model name + prompt), so identical prompts against the same
+    model share one answer across sessions and processes. The database runs in
+    WAL mode so readers do not wait for writers; disk errors (a locked or
+    broken database) are counted and treated as misses or skipped writes."""
+
+    def __init__(self, path: str | None = None, max_memory: int = 512, max_disk: int = 20000, ttl: float = DEFAULT_TTL):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_errors = 0
+        self._disk_rows = 0
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+                self._db.commit()
+                (self._disk_rows,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+            except Exception:
+                self._db = None
+
+    @staticmethod
+    def key(model_name: str | None, prompt: str) -> str:
+        return hashlib.sha256(((model_name or "") + "\0" + prompt).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                try:
+                    row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error:
+                    self.disk_errors += 1
+                    row = None
+                if row and now - row[1] < self.ttl:
+                    self._touch(key, now)
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                self._db.commit()
+                # counts replaced keys and other processes' rows loosely; _evict recounts
+                self._disk_rows += 1
+                if self._disk_rows > self.max_disk:
+                    self._evict(now)
+            except sqlite3.Error:
+                self.disk_errors += 1
+                self._rollback()
+
+    def _touch(self, key: str, now: float) -> None:
+        # LRU bookkeeping only: losing it to a busy database costs nothing
+        try:
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        except sqlite3.Error:
+            self.disk_errors += 1
+            self._rollback()
+
+    def _rollback(self) -> None:
+        try:
+            self._db.rollback()
+        except sqlite3.Error:
+            pass
+
+    def _remember(self, key: str, value: str, created: float) -> None:
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float) -> None:
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        keep = int(self.max_disk * EVICT_TO)
+        if count > keep:
+            # least recently used rows go first
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (count - keep,),
+            )
+            count = keep
+        self._db.commit()
+        self._disk_rows = count
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM responses")
+                    self._db.commit()
+                    self._disk_rows = 0
+                except sqlite3.Error:
+                    self.disk_errors += 1
+                    self._rollback()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_errors": self.disk_errors,
+        }
@@ -1,10 +1,18 @@
-from .base import AgentResult, LLMClient
+from .base import AgentResult, LLMClient, get_shared_client
+from .ratelimit import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from .taskbank import get_task_bank, validate_task
 import random
 import json
+import re
 
 class CreatorAgent:
-    def __init__(self, use_google: bool = False):
-        self.llm = LLMClient(use_google)
+    # Generated tasks should vary between clicks, so responses are not cached
+    use_cache = False
+    use_bank = True
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, use_google: bool = False, llm: LLMClient | None = None):
+        self.llm = llm or get_shared_client(use_google)
 
     def run(self, context: dict) -> AgentResult:
         level = context.get("level", "Easy")
@@ -78,6 +86,27 @@ class CreatorAgent:
         if not self.llm.use_google:
             return _fallback(level)
 
+        # Serve a pre-generated task; the bank refills itself in the background
+        bank = get_task_bank() if self.use_bank else None
+        if bank is not None:
+            banked = bank.take(level, refill=self.bank_candidate)
+            if banked is not None:
+                return AgentResult(title="Creator", content=banked[0], query=banked[1])
+        generated = self.generate(level, self.priority)
+        if generated is None:
+            return _fallback(level)
+        if bank is not None:
+            # Recorded as served, so the refill does not bank the same task again;
+            # generate() has already validated it
+            bank.add(level, generated.content, generated.query, served=True, validated=True)
+        return generated
+
+    def bank_candidate(self, level: str) -> tuple[str, str] | None:
+        generated = self.generate(level, PRIORITY_BACKGROUND)
+        return (generated.content, generated.query) if generated else None
+
+    def generate(self, level: str, priority: int = PRIORITY_INTERACTIVE) -> AgentResult | None:
+        """A task from the LLM whose starter query passes validate_task, or None."""
         prompt = (
             "Return ONLY a valid JSON object with fields 'task' and 'query'. "
             + "Level=" + level + "; Use realistic security tasks and valid KQL. "
@@ -93,14 +122,13 @@ class CreatorAgent:
             + "Do not include any markdown formatting, code blocks, or additional text. "
             + "Example format: {\"task\": \"Find failed logins\\n• Table: SecurityEvent\\n• Time: Last 24h\\n• Filter: EventID == 4625\", \"query\": \"SecurityEvent | where TimeGenerated >= ago(24h) and EventID == 4625\"}"
         )
-        txt = self.llm.generate(prompt) or ""
+        txt = self.llm.generate(prompt, cache=self.use_cache, priority=priority) or ""
 
         if not txt or not txt.strip():
-            # API call failed or returned empty - use fallback
-            return _fallback(level)
+            # API call failed or returned empty
+            return None
 
         # Try to extract JSON from the response (might be wrapped in markdown code blocks)
-        import re
         # Remove markdown code blocks if present
         txt = re.sub(r'```json\s*', '', txt)
         txt = re.sub(r'```\s*', '', txt)
@@ -119,9 +147,8 @@ class CreatorAgent:
             obj = json.loads(txt)
             task = obj.get("task")
             query = obj.get("query")
-            if task and query:
-                return AgentResult(title="Creator", content=task, query=query)
-            else:
-                return _fallback(level)
         except (json.JSONDecodeError, AttributeError):
-            return _fallback(level)
+            return None
+        if not isinstance(task, str) or not isinstance(query, str) or validate_task(task, query) is not None:
+            return None
+        return AgentResult(title="Creator", content=task, query=query)
@@ -1,54 +1,73 @@
-from .base import AgentResult, LLMClient
+from typing import Callable
+from .base import AgentResult, LLMClient, get_shared_client, evaluation_header, is_decisive
+from .ratelimit import PRIORITY_ENRICHMENT
 from kql_rules import explain_natural
 
 class ExplainerAgent:
-    def __init__(self, use_google: bool = False):
-        self.llm = LLMClient(use_google)
+    use_cache = True
+    latency_budget = 4.0
+    priority = PRIORITY_ENRICHMENT
+    section = "EXPLAINER"
 
-    def run(self, context: dict) -> AgentResult:
+    def __init__(self, use_google: bool = False, llm: LLMClient | None = None):
+        self.llm = llm or get_shared_client(use_google)
+
+    def run(self, context: dict, on_text: Callable[[str], None] | None = None) -> AgentResult:
+        txt = None
+        if self.llm.use_google and self.needs_llm(context):
+            txt = self.llm.generate(self.prompt(context), cache=self.use_cache, priority=self.priority, on_text=on_text, query=context.get("query")) or ""
+        return self.finish(context, txt)
+
+    def prompt(self, context: dict) -> str:
+        q = context.get("optimized_query", context.get("query", ""))
+        return (
+            "You are a KQL explainer. Explain the query in context of the TASK evaluation.\n\n"
+            + evaluation_header(context, "QUERY TO EXPLAIN", q)
+            + self.instructions(context)
+        )
+
+    def needs_llm(self, context: dict) -> bool:
+        return True
+
+    def instructions(self, context: dict) -> str:
+        if is_decisive(context):
+            return (
+                "1. Explain in 2 sentences what the KQL query returns and how that relates to the checks above.\n\n"
+                "Return a JSON object with fields: 'explanation' (short explanation), 'task_connection' (one sentence)."
+            )
+        return (
+            "1. Explain what the KQL query returns and each pipe stage (3-4 sentences).\n"
+            "2. Connect the explanation to how it relates to the TASK requirements.\n"
+            "3. If the query does NOT fulfill the task, explain what's missing and what the query actually returns.\n"
+            "4. Describe what insights this query provides for the TASK.\n\n"
+            "Return a JSON object with fields: 'explanation' (detailed explanation), 'task_connection' (how query serves the task)."
+        )
+
+    def finish(self, context: dict, txt: str | None) -> AgentResult:
         q = context.get("optimized_query", context.get("query", ""))
-        task = context.get("task", "")
-        evaluation = context.get("evaluation")  # Get evaluation result
-        fulfills_task = evaluation.fulfills_task if evaluation else None
         text, classification = explain_natural(q)
         task_connection = None
-        if self.llm.use_google:
-            eval_status = "fulfills" if fulfills_task else "does NOT fulfill"
-            eval_reason = evaluation.reason if evaluation and evaluation.reason else "Not evaluated"
-            prompt = (
-                "You are a KQL explainer. Explain the query in context of the TASK evaluation.\n\n"
-                "TASK:\n" + str(task) + "\n\n"
-                "QUERY TO EXPLAIN:\n" + q + "\n\n"
-                f"TASK EVALUATION: The query {eval_status} the task.\n"
-                f"Evaluation details: {eval_reason}\n\n"
-                "1. Explain what the KQL query returns and each pipe stage (3-4 sentences).\n"
-                "2. Connect the explanation to how it relates to the TASK requirements.\n"
-                "3. If the query does NOT fulfill the task, explain what's missing and what the query actually returns.\n"
-                "4. Describe what insights this query provides for the TASK.\n\n"
-                "Return a JSON object with fields: 'explanation' (detailed explanation), 'task_connection' (how query serves the task)."
-            )
-            txt = self.llm.generate(prompt) or ""
-            if txt:
-                try:
-                    import json
-                    import re
-                    json_match = re.search(r'\{.*?"explanation".*?"task_connection".*?\}', txt, re.DOTALL)
-                    if json_match:
-                        obj = json.loads(json_match.group(0))
-                        explanation = obj.get("explanation", "")
-                        if explanation:
-                            text = explanation
-                        task_connection = obj.get("task_connection", "")
-                except Exception:
-                    # Fallback to simple text extraction
-                    if txt:
-                        text = txt
-        
+        if txt:
+            try:
+                import json
+                import re
+                json_match = re.search(r'\{.*?"explanation".*?"task_connection".*?\}', txt, re.DOTALL)
+                if json_match:
+                    obj = json.loads(json_match.group(0))
+                    explanation = obj.get("explanation", "")
+                    if explanation:
+                        text = explanation
+                    task_connection = obj.get("task_connection", "")
+            except Exception:
+                # Fallback to simple text extraction
+                if txt:
+                    text = txt
+
         schema = context.get("schema") or {}
         if schema and classification:
             classification = classification + " Using table: " + str(schema.get("suggested_table"))
-        
+
         if task_connection:
             text += f"\n\n**Connection to Task:** {task_connection}"
-        
+
         return AgentResult(title="Explainer", content=text, hints=[classification] if classification else None)
@@ -1,12 +1,61 @@
-from .base import AgentResult, LLMClient
+from typing import Callable
+from .base import AgentResult, LLMClient, get_shared_client, evaluation_header, is_decisive
+from .ratelimit import PRIORITY_ASSIST
 from kql_rules import fix_query, compute_diffs, render_commented_query, assess_task
 import json
 
 class FixerAgent:
-    def __init__(self, use_google: bool = False):
-        self.llm = LLMClient(use_google)
+    use_cache = True
+    latency_budget = 6.0
+    priority = PRIORITY_ASSIST
+    section = "FIXER"
 
-    def run(self, context: dict) -> AgentResult:
+    def __init__(self, use_google: bool = False, llm: LLMClient | None = None):
+        self.llm = llm or get_shared_client(use_google)
+
+    def run(self, context: dict, on_text: Callable[[str], None] | None = None) -> AgentResult:
+        txt = None
+        if self.llm.use_google and self.needs_llm(context):
+            txt = self.llm.generate(self.prompt(context), cache=self.use_cache, priority=self.priority, on_text=on_text, query=context.get("query")) or ""
+        return self.finish(context, txt)
+
+    def prompt(self, context: dict) -> str:
+        return (
+            "You are a KQL fixer. Fix the query based on the task evaluation.\n\n"
+            + evaluation_header(context, "USER QUERY")
+            + self.instructions(context)
+        )
+
+    def needs_llm(self, context: dict) -> bool:
+        """False when the verdict is decisive and the rule-based fix already meets every check."""
+        if not is_decisive(context):
+            return True
+        evaluation = context["evaluation"]
+        if evaluation.fulfills_task:
+            return False
+        task = str(context.get("task") or "")
+        schema = context.get("schema") or {}
+        _, _, corrected, _ = assess_task(task, context.get("query", ""), schema)
+        fixed = fix_query(corrected, suggested_table=schema.get("suggested_table"), task=task)
+        fulfills, _, _, _ = assess_task(task, fixed, schema)
+        return not fulfills
+
+    def instructions(self, context: dict) -> str:
+        evaluation = context.get("evaluation")
+        missing_elements = evaluation.suggestions if evaluation and evaluation.suggestions else []
+        return (
+            (f"Missing elements: {', '.join(missing_elements)}\n\n" if missing_elements else "")
+            + "IMPORTANT: Pay special attention to EventID values. For failed logins/logons, EventID must be 4625. "
+            "If the query has a different EventID (like 5625, 4624, etc.) and the task requires failed logins, correct it to 4625.\n\n"
+            "1. Explain in 2–3 bullet points what the user query returns.\n"
+            "2. Based on the evaluation, provide a corrected KQL query that fulfils ALL TASK requirements.\n"
+            "3. Ensure EventID values match the task requirements (4625 for failed logons).\n"
+            "4. If the query already fulfills the task, suggest minor improvements or optimizations.\n"
+            "5. Explain how the corrected query addresses each TASK requirement.\n\n"
+            "Return a JSON object with fields: corrected_query (KQL query), task_coverage (how corrected query covers task requirements), improvements (list of changes made)."
+        )
+
+    def finish(self, context: dict, txt: str | None) -> AgentResult:
         q = context.get("query", "")
         schema = context.get("schema") or {}
         evaluation = context.get("evaluation")  # Get evaluation result
@@ -15,28 +64,8 @@ class FixerAgent:
         corrected = None
         diffs = []
         commented = None
-        
-        if self.llm.use_google:
-            eval_status = "fulfills" if fulfills else "does NOT fulfill"
-            eval_reason = reason or "Not evaluated"
-            missing_elements = evaluation.suggestions if evaluation and evaluation.suggestions else []
-            prompt = (
-                "You are a KQL fixer. Fix the query based on the task evaluation.\n\n"
-                "TASK:\n" + str(context.get("task")) + "\n\n"
-                "USER QUERY:\n" + q + "\n\n"
-                f"TASK EVALUATION: The query {eval_status} the task.\n"
-                f"Evaluation details: {eval_reason}\n"
-                + (f"Missing elements: {', '.join(missing_elements)}\n" if missing_elements else "") + "\n"
-                "IMPORTANT: Pay special attention to EventID values. For failed logins/logons, EventID must be 4625. "
-                "If the query has a different EventID (like 5625, 4624, etc.) and the task requires failed logins, correct it to 4625.\n\n"
-                "1. Explain in 2–3 bullet points what the user query returns.\n"
-                "2. Based on the evaluation, provide a corrected KQL query that fulfils ALL TASK requirements.\n"
-                "3. Ensure EventID values match the task requirements (4625 for failed logons).\n"
-                "4. If the query already fulfills the task, suggest minor improvements or optimizations.\n"
-                "5. Explain how the corrected query addresses each TASK requirement.\n\n"
-                "Return a JSON object with fields: corrected_query (KQL query), task_coverage (how corrected query covers task requirements), improvements (list of changes made)."
-            )
-            txt = self.llm.generate(prompt) or ""
+
+        if txt:
             try:
                 import re
                 json_match = re.search(r'\{.*?"corrected_query".*?"task_coverage".*?\}', txt, re.DOTALL)
@@ -47,9 +76,9 @@ class FixerAgent:
                 corrected_llm = obj.get("corrected_query")
                 task_coverage = obj.get("task_coverage", "")
                 improvements = obj.get("improvements", [])
-                
+
                 corrected = corrected_llm if corrected_llm else q
-                
+
                 if task_coverage and reason:
                     reason = reason + "\n\n**Task Coverage:** " + task_coverage
                 if improvements:
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Lower numbers are served first and may use more of the remaining budget
+PRIORITY_INTERACTIVE = 0  # EvaluatorAgent, CreatorAgent: the user is waiting on them
+PRIORITY_ASSIST = 1  # FixerAgent, OptimizerAgent
+PRIORITY_ENRICHMENT = 2  # ExplainerAgent, TutorAgent
+PRIORITY_BACKGROUND = 3  # pre-generation and warm-up work
+
+# Share of each bucket a priority must leave untouched, and how long it may queue
+RESERVE = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_ASSIST: 0.1, PRIORITY_ENRICHMENT: 0.25, PRIORITY_BACKGROUND: 0.5}
+MAX_WAIT = {PRIORITY_INTERACTIVE: 30.0, PRIORITY_ASSIST: 8.0, PRIORITY_ENRICHMENT: 3.0, PRIORITY_BACKGROUND: 0.0}
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, reserve: float) -> float:
+        # time until amount can be taken while keeping reserve * capacity in the bucket
+        short = amount + reserve * self.capacity - self.level
+        return max(short, 0.0) / self.rate if self.rate > 0 else float("inf")
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute budget for LLM calls.
+
+    Callers queue by priority. Lower priorities may not dip into the reserve kept
+    for interactive calls and give up quickly, so enrichment agents fall back to
+    their rule-based output before the API starts answering 429."""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.granted = 0
+        self.denied = 0
+        self._cond = threading.Condition()
+        self._waiting: list = []
+        self._seq = itertools.count()
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE, timeout: float | None = None) -> bool:
+        reserve = RESERVE.get(priority, RESERVE[PRIORITY_BACKGROUND])
+        max_wait = MAX_WAIT.get(priority, 0.0)
+        if timeout is not None:
+            max_wait = min(max_wait, timeout)
+        tokens = min(tokens, self.tokens.capacity)
+        entry = (priority, next(self._seq))
+        give_up = time.monotonic() + max_wait
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    if self._waiting[0] == entry:
+                        wait = max(self.requests.wait_time(1, reserve), self.tokens.wait_time(tokens, reserve))
+                        if wait == 0:
+                            self.requests.level -= 1
+                            self.tokens.level -= tokens
+                            self.granted += 1
+                            return True
+                    else:
+                        wait = 0.05
+                    if now + wait > give_up:
+                        self.denied += 1
+                        return False
+                    self._cond.wait(min(wait, give_up - now))
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def throttled(self) -> None:
+        """The API answered 429: treat the request budget as spent for now."""
+        with self._cond:
+            self.requests.refill(time.monotonic())
+            self.requests.level = min(self.requests.level, 0.0)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "granted": self.granted,
+                "denied": self.denied,
+                "queued": len(self._waiting),
+                "requests_left": round(self.requests.level, 1),
+                "tokens_left": round(self.tokens.level),
+            }
+
+_limiter: RateLimiter | None = None
+_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    """Process-wide limiter sized by KQLTUTOR_RPM / KQLTUTOR_TPM (plan limits)."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(float(os.getenv("KQLTUTOR_RPM", "10")), float(os.getenv("KQLTUTOR_TPM", "250000")))
+        return _limiter
+
+def estimate_tokens(prompt: str, expected_output: int = 512) -> int:
+    # roughly four characters per token for English prompts
+    return len(prompt) // 4 + expected_output
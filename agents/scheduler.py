@@ -0,0 +1,275 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable
+from .base import AgentResult, LLMClient, get_shared_client, run_with_deadline
+from .evaluator import EvaluatorAgent
+from .tutor import TutorAgent
+from .fixer import FixerAgent
+from .optimizer import OptimizerAgent
+from .explainer import ExplainerAgent
+from kql_canon import query_hash
+
+@dataclass
+class Node:
+    name: str
+    run: Callable[[dict], Any]
+    inputs: list[str] = field(default_factory=list)
+
+class AgentScheduler:
+    """Runs a DAG of agent steps on one long-lived, bounded thread pool.
+
+    A node is submitted as soon as all of its inputs have resolved, so nodes never
+    block a worker while waiting on each other."""
+
+    def __init__(self, max_workers: int = 16):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent")
+
+    def submit(self, nodes: list[Node], values: dict | None = None) -> dict[str, Future]:
+        futures: dict[str, Future] = {}
+        for name, value in (values or {}).items():
+            futures[name] = Future()
+            futures[name].set_result(value)
+        for node in nodes:
+            futures[node.name] = Future()
+        for node in nodes:
+            missing = [i for i in node.inputs if i not in futures]
+            if missing:
+                raise ValueError(f"Node {node.name} depends on unknown inputs: {missing}")
+        for node in nodes:
+            self._schedule(node, futures)
+        return futures
+
+    def _schedule(self, node: Node, futures: dict[str, Future]) -> None:
+        out = futures[node.name]
+        deps = [futures[i] for i in node.inputs]
+        pending = [len(deps)]
+        lock = threading.Lock()
+
+        def work(inputs: dict) -> None:
+            try:
+                out.set_result(node.run(inputs))
+            except Exception as e:
+                out.set_exception(e)
+
+        def start() -> None:
+            failed = next((d.exception() for d in deps if d.exception() is not None), None)
+            if failed is not None:
+                out.set_exception(failed)
+                return
+            self.executor.submit(work, {i: futures[i].result() for i in node.inputs})
+
+        def on_done(_: Future) -> None:
+            with lock:
+                pending[0] -= 1
+                ready = pending[0] == 0
+            if ready:
+                start()
+
+        if not deps:
+            start()
+        for d in deps:
+            d.add_done_callback(on_done)
+
+    def run(self, nodes: list[Node], values: dict | None = None, timeout: float | None = None) -> dict[str, Any]:
+        futures = self.submit(nodes, values)
+        return {name: f.result(timeout=timeout) for name, f in futures.items()}
+
+_scheduler: AgentScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> AgentScheduler:
+    """Process-wide scheduler sized by KQLTUTOR_AGENT_WORKERS."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = AgentScheduler(int(os.getenv("KQLTUTOR_AGENT_WORKERS", "16")))
+        return _scheduler
+
+# Final results for submissions that exactly match the task's reference query, so
+# every student who submits it gets the same feedback without new LLM calls
+REFERENCE_FEEDBACK_MAX = 256
+_reference_feedback: OrderedDict = OrderedDict()
+_reference_lock = threading.Lock()
+
+def reference_feedback_key(context: dict, bundle: bool) -> str:
+    raw = "\x00".join([str(context.get("task") or ""), query_hash(context.get("query") or ""), str((context.get("schema") or {}).get("suggested_table")), str(bundle)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def cached_reference_feedback(key: str) -> dict | None:
+    with _reference_lock:
+        hit = _reference_feedback.get(key)
+        if hit is not None:
+            _reference_feedback.move_to_end(key)
+        return hit
+
+def remember_reference_feedback(key: str, results: dict) -> None:
+    # Hedged fallbacks are not the final answer, so they are not kept
+    values = [v for r in results.values() for v in (r.values() if isinstance(r, dict) else [r])]
+    if any(v.enhancing for v in values):
+        return
+    with _reference_lock:
+        _reference_feedback[key] = results
+        _reference_feedback.move_to_end(key)
+        while len(_reference_feedback) > REFERENCE_FEEDBACK_MAX:
+            _reference_feedback.popitem(last=False)
+
+# Evaluator and fixer results for a task's starter query, stored by the warm-up
+# (agents/warmup) when they need no LLM call, so the first Analyze of the
+# starter query skips both
+STARTER_RESULTS_MAX = 256
+_starter_results: OrderedDict = OrderedDict()
+
+def starter_key(context: dict) -> str:
+    schema = context.get("schema") or {}
+    raw = "\x00".join([str(context.get("task") or ""), query_hash(context.get("query") or ""),
+                       query_hash(context.get("reference_query") or ""), str(schema.get("suggested_table")), str(bool(schema.get("ranked")))])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def cached_starter_results(context: dict) -> dict:
+    """{"evaluation"?, "fixer"?} for a query that is its task's starter query."""
+    if not context.get("reference_query"):
+        return {}
+    key = starter_key(context)
+    with _reference_lock:
+        hit = _starter_results.get(key)
+        if hit is not None:
+            _starter_results.move_to_end(key)
+        return hit or {}
+
+def remember_starter_results(context: dict, results: dict) -> None:
+    key = starter_key(context)
+    with _reference_lock:
+        _starter_results[key] = results
+        _starter_results.move_to_end(key)
+        while len(_starter_results) > STARTER_RESULTS_MAX:
+            _starter_results.popitem(last=False)
+
+def follow_late_evaluation(speculative: Any, evaluation: AgentResult, rule_verdict: bool | None,
+                           rerun: Callable[[AgentResult], Any]) -> Any:
+    """speculative (an AgentResult, or the bundle's dict of them) marked enhancing
+    until the hedged evaluation's LLM verdict lands: pending then resolves to
+    speculative itself when the verdict agrees with the rule verdict, or to
+    rerun(final evaluation) when it does not, so sections never contradict the
+    evaluation that replaces the rule-based one."""
+    late: Future = Future()
+
+    def rerun_into(final: AgentResult) -> None:
+        try:
+            late.set_result(rerun(final))
+        except Exception as e:
+            late.set_exception(e)
+
+    def settle(done: Future) -> None:
+        final = None if done.exception() is not None else done.result()
+        if final is None or final.fulfills_task == rule_verdict:
+            late.set_result(speculative)
+        else:
+            get_scheduler().executor.submit(rerun_into, final)
+
+    evaluation.pending.add_done_callback(settle)
+    if isinstance(speculative, dict):
+        return {k: replace(v, enhancing=True, pending=late) for k, v in speculative.items()}
+    return replace(speculative, enhancing=True, pending=late)
+
+def analysis_nodes(context: dict, llm: LLMClient, bundle: bool = False, progress: Callable[[str, str], None] | None = None) -> list[Node]:
+    """The Analyze pipeline as a DAG.
+
+    The rule-based evaluation (assess_task) is ready almost immediately, so the
+    downstream agents start speculatively from it while the evaluator's LLM call
+    is still running. When the LLM verdict differs from the rule verdict, those
+    agents are re-issued with the final evaluation; otherwise the speculative
+    results are kept. When the evaluator itself runs past its budget, the
+    speculative results are returned enhancing and follow its late verdict
+    (follow_late_evaluation).
+
+    progress(name, text_so_far) is called while each LLM response streams in.
+    Every agent runs under its latency budget (run_with_deadline), so a slow
+    LLM call yields the rule-based result marked enhancing instead of blocking.
+
+    A query that exactly matches context["reference_query"] is answered from the
+    reference feedback cache once that feedback has been produced, and takes its
+    evaluation and fixer results from the warm-up (cached_starter_results)
+    before that."""
+    evaluator = EvaluatorAgent(llm=llm)
+
+    def stream_to(name: str) -> Callable[[str], None] | None:
+        return (lambda text: progress(name, text)) if progress else None
+
+    query = context.get("query", "")
+    final_names = ["evaluation", "bundle"] if bundle else ["evaluation", "tutor", "fixer", "optimizer", "explainer"]
+    warm = cached_starter_results(context)
+    rule_evaluation = warm.get("evaluation") or evaluator.assess(context)
+    reference_key = None
+    if rule_evaluation.exact_match and llm.use_google:
+        reference_key = reference_feedback_key(context, bundle)
+        cached = cached_reference_feedback(reference_key)
+        if cached is not None:
+            return [Node(name, lambda _, v=cached[name]: v) for name in final_names]
+
+    nodes = [
+        Node("rule_evaluation", lambda _: rule_evaluation),
+        # a warmed evaluation is decisive, which is what the evaluator would return
+        Node("evaluation", lambda _: warm.get("evaluation") or run_with_deadline(
+            evaluator, {**context, "rule_evaluation": rule_evaluation}, on_text=stream_to("evaluation"))),
+    ]
+
+    def final(name: str, rerun: Callable[[AgentResult], Any]) -> Node:
+        def choose(inputs: dict) -> Any:
+            evaluation, rule_verdict = inputs["evaluation"], inputs["rule_evaluation"].fulfills_task
+            if evaluation.fulfills_task != rule_verdict:
+                return rerun(evaluation)
+            if evaluation.enhancing and evaluation.pending is not None:
+                return follow_late_evaluation(inputs[name + "_speculative"], evaluation, rule_verdict, rerun)
+            return inputs[name + "_speculative"]
+        return Node(name, choose, ["evaluation", "rule_evaluation", name + "_speculative"])
+
+    if bundle:
+        from .bundle import AnalysisBundleAgent
+        agent = AnalysisBundleAgent(llm=llm)
+        run = lambda ev: run_with_deadline(agent, {**context, "evaluation": ev}, on_text=stream_to("bundle"))
+        nodes.append(Node("bundle_speculative", lambda i: run(i["rule_evaluation"]), ["rule_evaluation"]))
+        nodes.append(final("bundle", run))
+    else:
+        agents = {
+            "tutor": (TutorAgent(llm=llm), {}),
+            "fixer": (FixerAgent(llm=llm), {}),
+            "optimizer": (OptimizerAgent(llm=llm), {"fixed_query": query}),
+            "explainer": (ExplainerAgent(llm=llm), {"optimized_query": query}),
+        }
+        for name, (agent, extra) in agents.items():
+            run = lambda ev, agent=agent, extra=extra, name=name: run_with_deadline(agent, {**context, **extra, "evaluation": ev}, on_text=stream_to(name))
+            speculative = (lambda _, v=warm[name]: v) if name in warm else (lambda i, run=run: run(i["rule_evaluation"]))
+            nodes.append(Node(name + "_speculative", speculative, ["rule_evaluation"]))
+            nodes.append(final(name, run))
+    if reference_key:
+        nodes.append(Node("reference_feedback", lambda i: remember_reference_feedback(reference_key, i), final_names))
+    return nodes
+
+def rule_based_analysis(context: dict) -> dict[str, AgentResult]:
+    """Deterministic results for every section, computed without any LLM call."""
+    llm = get_shared_client(False)
+    evaluation = EvaluatorAgent(llm=llm).assess(context)
+    query = context.get("query", "")
+    ctx = {**context, "evaluation": evaluation}
+    return {
+        "evaluation": evaluation,
+        "tutor": TutorAgent(llm=llm).finish(ctx, None),
+        "fixer": FixerAgent(llm=llm).finish(ctx, None),
+        "optimizer": OptimizerAgent(llm=llm).finish({**ctx, "fixed_query": query}, None),
+        "explainer": ExplainerAgent(llm=llm).finish({**ctx, "optimized_query": query}, None),
+    }
+
+def run_analysis(context: dict, llm: LLMClient | None = None, bundle: bool = False, scheduler: AgentScheduler | None = None) -> dict[str, AgentResult]:
+    """Evaluation plus the Tutor/Fixer/Optimizer/Explainer results for one Analyze click."""
+    llm = llm or get_shared_client(False)
+    results = (scheduler or get_scheduler()).run(analysis_nodes(context, llm, bundle))
+    out = {"evaluation": results["evaluation"]}
+    if bundle:
+        out.update(results["bundle"])
+    else:
+        out.update({k: results[k] for k in ("tutor", "fixer", "optimizer", "explainer")})
+    return out
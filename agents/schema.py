@@ -1,7 +1,12 @@
 from dataclasses import dataclass
 from typing import List, Dict, Any
-from .base import AgentResult, LLMClient
-from schema_catalog import BASE_CATALOG
+from .base import AgentResult, LLMClient, get_shared_client
+from schema_catalog import CATALOG, mentions, search
+
+DEFAULT_TABLE = "SecurityEvent"
+# A best-ranked table without rows to run queries on must beat the runner-up by
+# this factor; closer calls fall back to the keyword mapping
+RANK_MARGIN = 1.3
 
 @dataclass
 class SchemaView:
@@ -9,10 +14,22 @@ class SchemaView:
     reason: str
     relevant_columns: List[str]
     sample_rows: List[Dict[str, Any]]
+    # True when only the BM25 ranking picked the table, not the keyword mapping;
+    # a query on another table is then not a certain failure
+    ranked: bool = False
+
+def keyword_table(task: str) -> tuple[str, str]:
+    """(table, reason) from the task's keywords; always a table with data."""
+    t = task.lower()
+    if any(k in t for k in ["sign-in", "signin", "signins"]):
+        return "SigninLogs", "Task mentions sign-ins → use SigninLogs with ResultType"
+    if any(k in t for k in ["failed", "4625", "logon"]):
+        return DEFAULT_TABLE, "Task mentions failed logins → use SecurityEvent with EventID 4625"
+    return DEFAULT_TABLE, f"Default to {DEFAULT_TABLE} for authentication-related tasks"
 
 class SchemaAgent:
-    def __init__(self, use_google: bool = False):
-        self.llm = LLMClient(use_google)
+    def __init__(self, use_google: bool = False, llm: LLMClient | None = None):
+        self.llm = llm or get_shared_client(use_google)
 
     def run(self, task: str) -> AgentResult:
         view = self._build_view(task or "")
@@ -28,31 +45,17 @@ class SchemaAgent:
         return self._build_view(task or "")
 
     def _build_view(self, task: str) -> SchemaView:
-        t = task.lower()
-        if any(k in t for k in ["sign-in", "signin", "signins"]):
-            table = "SigninLogs"
-            base_cols = BASE_CATALOG[table]["columns"]
-            cols = ["TimeGenerated", "UserPrincipalName", "IPAddress", "ResultType"]
-            reason = "Task mentions sign-ins → use SigninLogs with ResultType"
-        else:
-            table = "SecurityEvent"
-            base_cols = BASE_CATALOG[table]["columns"]
-            cols = ["TimeGenerated", "HostName", "EventID", "LogonResult"]
-            if "host" in t and "HostName" not in cols:
-                cols.append("HostName")
-            if any(k in t for k in ["failed", "4625", "logon"]):
-                reason = "Task mentions failed logins → use SecurityEvent with EventID 4625"
-            else:
-                reason = "Default to SecurityEvent for authentication-related tasks"
-        if "user" in t:
-            if table == "SecurityEvent" and "Account" in base_cols and "Account" not in cols:
-                cols.append("Account")
-            if table == "SigninLogs" and "UserPrincipalName" in base_cols and "UserPrincipalName" not in cols:
-                cols.append("UserPrincipalName")
-        if "ip" in t:
-            ip_col = "IpAddress" if table == "SecurityEvent" else "IPAddress"
-            if ip_col in base_cols and ip_col not in cols:
-                cols.append(ip_col)
-        cols = [c for c in cols if c in base_cols]
-        rows = BASE_CATALOG[table]["sample_rows"]
-        return SchemaView(table, reason, cols, rows)
+        table, reason = keyword_table(task)
+        hits = search(task)
+        if hits:
+            best, score, matched = hits[0]
+            schema = CATALOG.table(best)
+            runnable = bool(schema and schema.sample_rows)
+            if runnable or len(hits) == 1 or score >= RANK_MARGIN * hits[1][1]:
+                table = best
+                reason = f"Task mentions {', '.join(mentions(task, matched)[:4])} → use {table}"
+        schema = CATALOG.table(table)
+        description = f": {schema.description}" if schema and schema.description else ""
+        cols = CATALOG.relevant_columns(table, task)
+        return SchemaView(table, reason + description, cols, list(schema.sample_rows) if schema else [],
+                          ranked=table != keyword_table(task)[0])
@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+TARGET = int(os.getenv("KQLTUTOR_TASK_BANK_SIZE", "20"))
+LOW_WATER = max(1, TARGET // 4)
+# A refill gives up after this many generated tasks in a row are rejected (the
+# model keeps repeating itself, or the background rate budget is spent)
+MAX_REJECTS = 5
+
+# level -> (task, starter query), or None when generation failed
+Generator = Callable[[str], "tuple[str, str] | None"]
+
+def validate_task(task: str, query: str) -> str | None:
+    """Why a generated task is unusable, or None. The starter query must read a
+    catalog table, use only stages the local engine runs, and return rows on the
+    generated datasets grading uses."""
+    from kql_exec import execute_query, unsupported_stages
+    from kql_parse import analyze_query
+    from schema_catalog import BASE_CATALOG
+    import kql_semantic
+
+    if not (task or "").strip() or not (query or "").strip():
+        return "Empty task or query"
+    a = analyze_query(query)
+    if a.table not in BASE_CATALOG:
+        return f"Starter query does not start from a catalog table ({a.table or 'none'})"
+    unsupported = unsupported_stages(query)
+    if unsupported:
+        return "Unsupported stages: " + "; ".join(unsupported[:3])
+    base, _ = kql_semantic.datasets()
+    result = execute_query(query, tables=base, now=kql_semantic.NOW, budget=kql_semantic.BUDGET)
+    if result.aborted:
+        return f"Starter query failed: {result.message}"
+    if not result:
+        return "Starter query returns no rows on the generated data"
+    return None
+
+class TaskBank:
+    """Validated tasks per level, pre-generated so Create task does not wait on the LLM.
+
+    Rows persist in SQLite (memory-only without a path). Served tasks are kept,
+    marked served, so their fingerprints still count as duplicates. take() pops
+    the oldest unserved task and schedules a background refill once a level
+    falls below LOW_WATER; one refill per level runs at a time."""
+
+    def __init__(self, path: str | None = None, target: int = TARGET, low_water: int = LOW_WATER):
+        self.target = target
+        self.low_water = low_water
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._refilling: set[str] = set()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="task-bank")
+        self._db = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+            except Exception:
+                self._db = None
+        if self._db is None:
+            self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks (level TEXT, fingerprint TEXT, task TEXT, query TEXT, created REAL, "
+            "served INTEGER DEFAULT 0, PRIMARY KEY (level, fingerprint))"
+        )
+        self._db.commit()
+
+    def available(self, level: str) -> int:
+        with self._lock:
+            (n,) = self._db.execute("SELECT COUNT(*) FROM tasks WHERE level = ? AND served = 0", (level,)).fetchone()
+        return n
+
+    def add(self, level: str, task: str, query: str, served: bool = False, validated: bool = False) -> str | None:
+        """Store a task unless it is invalid or a near-duplicate; returns why it was rejected.
+        validated=True skips validate_task for a task the caller already checked."""
+        from kql_canon import query_fingerprint
+
+        problem = None if validated else validate_task(task, query)
+        if problem is None:
+            with self._lock:
+                cur = self._db.execute(
+                    "INSERT OR IGNORE INTO tasks (level, fingerprint, task, query, created, served) VALUES (?, ?, ?, ?, ?, ?)",
+                    (level, query_fingerprint(query), task, query, time.time(), int(served)),
+                )
+                self._db.commit()
+            if not cur.rowcount:
+                problem = "Duplicate of a banked task"
+        self.stats["accepted" if problem is None else "rejected"] += 1
+        return problem
+
+    def take(self, level: str, refill: Generator | None = None) -> tuple[str, str] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprint, task, query FROM tasks WHERE level = ? AND served = 0 ORDER BY created LIMIT 1", (level,)
+            ).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE tasks SET served = 1 WHERE level = ? AND fingerprint = ?", (level, row[0]))
+                self._db.commit()
+        self.stats["hits" if row else "misses"] += 1
+        if refill is not None and self.available(level) < self.low_water:
+            self.refill_async(level, refill)
+        return (row[1], row[2]) if row else None
+
+    def refill_async(self, level: str, generate: Generator) -> None:
+        with self._lock:
+            if level in self._refilling:
+                return
+            self._refilling.add(level)
+        self._pool.submit(self._refill, level, generate)
+
+    def _refill(self, level: str, generate: Generator) -> None:
+        try:
+            rejects = 0
+            while self.available(level) < self.target and rejects < MAX_REJECTS:
+                generated = generate(level)
+                self.stats["generated" if generated else "failed"] += 1
+                if generated is None or self.add(level, *generated) is not None:
+                    rejects += 1
+                else:
+                    rejects = 0
+        except Exception:
+            self.stats["errors"] += 1
+        finally:
+            with self._lock:
+                self._refilling.discard(level)
+
+    def summary(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT level, COUNT(*) FROM tasks WHERE served = 0 GROUP BY level").fetchall()
+            refilling = sorted(self._refilling)
+        return {"available": dict(rows), "refilling": refilling, **self.stats}
+
+    def wait_idle(self, timeout: float | None = None) -> bool:
+        """Block until no refill is running (for scripts)."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._refilling:
+                    return True
+            if end is not None and time.monotonic() >= end:
+                return False
+            time.sleep(0.05)
+
+_bank: TaskBank | None = None
+_bank_lock = threading.Lock()
+
+def get_task_bank() -> TaskBank | None:
+    """Process-wide bank; KQLTUTOR_TASK_BANK=0 disables it, KQLTUTOR_LLM_CACHE=0 keeps it memory-only."""
+    global _bank
+    if os.getenv("KQLTUTOR_TASK_BANK", "1") == "0":
+        return None
+    with _bank_lock:
+        if _bank is None:
+            from .base import CACHE_DIR
+
+            persist = os.getenv("KQLTUTOR_LLM_CACHE", "1") != "0"
+            _bank = TaskBank(os.path.join(CACHE_DIR, "tasks.sqlite3") if persist else None)
+        return _bank
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+ENABLED = os.getenv("KQLTUTOR_WARMUP", "1") != "0"
+# (task, reference hash) pairs already warmed; Create task often repeats banked tasks
+RECENT_SIZE = 256
+
+_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm-up")
+_recent: "OrderedDict[tuple[str, str], Future]" = OrderedDict()
+_lock = threading.Lock()
+
+def warm_up(task: str, query: str | None, schema: Any = None) -> Future | None:
+    """Start warming the caches the first Analyze of a new task will read; the
+    future resolves to per-step timings. A task already warmed returns its
+    earlier future."""
+    from kql_canon import query_hash
+
+    if not ENABLED or not task or not query:
+        return None
+    key = (task, query_hash(query))
+    with _lock:
+        future = _recent.get(key)
+        if future is not None:
+            _recent.move_to_end(key)
+            return future
+        future = _recent[key] = _pool.submit(_warm, task, query, schema_dict(schema))
+        while len(_recent) > RECENT_SIZE:
+            _recent.popitem(last=False)
+    future.add_done_callback(lambda f: f.exception() is not None and forget(key, f))
+    return future
+
+def forget(key: tuple[str, str], future: Future) -> None:
+    # a failed warm-up is retried the next time the task is created
+    with _lock:
+        if _recent.get(key) is future:
+            del _recent[key]
+
+def schema_dict(schema: Any) -> dict:
+    if schema is None or isinstance(schema, dict):
+        return schema or {}
+    return {"suggested_table": schema.suggested_table, "reason": schema.reason,
+            "relevant_columns": schema.relevant_columns, "sample_rows": schema.sample_rows[:3],
+            "ranked": schema.ranked}
+
+def _warm(task: str, query: str, schema: dict) -> dict:
+    """Steps, each timed:
+    - prepare: generated datasets, the reference's stage plan and indexes on the
+      columns it compares (kql_semantic.prepare)
+    - reference: the reference's results per dataset variant, cached for grading
+    - rules: the rule-based agent outputs for the starter query, which the app
+      puts in the editor, so its analysis, lint, canonical form and result
+      comparison are memoized before the first Analyze. The evaluator and fixer
+      results are stored for analysis_nodes (remember_starter_results) when
+      they are what an LLM-backed run returns too: a decisive evaluation, and a
+      fix the fixer would not ask the LLM about"""
+    from agents.base import CONFIDENCE_SKIP, get_shared_client
+    from agents.evaluator import EvaluatorAgent
+    from agents.explainer import ExplainerAgent
+    from agents.fixer import FixerAgent
+    from agents.optimizer import OptimizerAgent
+    from agents.scheduler import remember_starter_results
+    from agents.tutor import TutorAgent
+    import kql_semantic
+
+    timings: dict[str, Any] = {}
+    if kql_semantic.ENABLED:
+        timings.update(kql_semantic.prepare(query))
+        start = time.perf_counter()
+        kql_semantic.reference_results(task, query)
+        timings["reference_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    start = time.perf_counter()
+    llm = get_shared_client(False)
+    context = {"query": query, "task": task, "reference_query": query, "schema": schema}
+    evaluation = EvaluatorAgent(llm=llm).assess(context)
+    ctx = {**context, "evaluation": evaluation}
+    fixer = FixerAgent(llm=llm)
+    fixed = fixer.finish(ctx, None)
+    stored = {}
+    if evaluation.confidence is not None and evaluation.confidence >= CONFIDENCE_SKIP:
+        stored["evaluation"] = evaluation
+        if not fixer.needs_llm(ctx):
+            stored["fixer"] = fixed
+    for agent in (TutorAgent, OptimizerAgent, ExplainerAgent):
+        agent(llm=llm).run(ctx)
+    if stored:
+        remember_starter_results(context, stored)
+    timings["stored"] = sorted(stored)
+    timings["rules_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return timings
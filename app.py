@@ -1,21 +1,26 @@
 import os
+import time
 import streamlit as st
 from dotenv import load_dotenv
 import google.generativeai as genai
 from agents.creator import CreatorAgent
-from agents.tutor import TutorAgent
-from agents.fixer import FixerAgent
-from agents.optimizer import OptimizerAgent
-from agents.explainer import ExplainerAgent
 from agents.schema import SchemaAgent
-from agents.evaluator import EvaluatorAgent
+from agents.base import get_shared_client
+from agents.backends import backend_kind
+from agents.scheduler import analysis_nodes, get_scheduler, rule_based_analysis
+from agents.warmup import warm_up
 from kql_exec import execute_query
+from service_client import ServiceClient
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 API_KEY = os.environ.get("GOOGLE_API_KEY")
 if API_KEY:
     genai.configure(api_key=API_KEY)
 
+# With KQLTUTOR_SERVICE_URL set, the page is a thin client of service.py
+SERVICE_URL = os.environ.get("KQLTUTOR_SERVICE_URL")
+service = ServiceClient(SERVICE_URL) if SERVICE_URL else None
+
 st.set_page_config(page_title="KQL Playground", page_icon="🧠", layout="wide")
 
 if "task" not in st.session_state:
@@ -23,18 +28,25 @@ if "task" not in st.session_state:
 if "level" not in st.session_state:
     st.session_state.level = "Easy"
 if "use_google" not in st.session_state:
-    st.session_state.use_google = bool(API_KEY)
+    # The fake backend (KQLTUTOR_LLM_BACKEND=fake) runs without an API key
+    st.session_state.use_google = bool(API_KEY) or backend_kind() == "fake"
 
 st.sidebar.title("KQL Playground")
 st.sidebar.selectbox("Task level", ["Easy", "Intermediate"], key="level")
 st.sidebar.checkbox("Use Google AI SDK", key="use_google")
+st.sidebar.checkbox("Single combined LLM call", key="bundle_mode", help="Ask for lesson, fix, optimization and explanation in one request")
 st.sidebar.selectbox("Query source", ["Static (base)", "Dynamic (task view)"], key="query_source")
+st.sidebar.checkbox("Fast preview (sampled results)", key="sample_preview")
+if st.session_state.get("sample_preview"):
+    st.sidebar.slider("Sample rate", 0.01, 0.5, 0.1, key="sample_rate")
+    st.sidebar.selectbox("Sampling", ["uniform", "time"], key="sample_mode")
 
 # Debug info
 if st.sidebar.checkbox("Show debug info", key="show_debug"):
     st.sidebar.write(f"use_google: {st.session_state.use_google}")
     st.sidebar.write(f"API_KEY set: {bool(API_KEY)}")
-    if st.session_state.use_google:
+    st.sidebar.write(f"LLM backend: {backend_kind()}")
+    if st.session_state.use_google and backend_kind() != "fake":
         import google.generativeai as genai
         genai.configure(api_key=API_KEY)
         try:
@@ -50,10 +62,11 @@ if st.sidebar.checkbox("Show debug info", key="show_debug"):
         except Exception as e:
             st.sidebar.error(f"Error listing models: {e}")
         
-        from agents.base import LLMClient
-        test_client = LLMClient(use_google=True)
+        test_client = get_shared_client(use_google=True)
         st.sidebar.write(f"LLMClient.use_google: {test_client.use_google}")
         st.sidebar.write(f"LLMClient.model: {test_client.model is not None}")
+        st.sidebar.write(f"LLM cache: {test_client.cache.stats()}")
+        st.sidebar.write(f"Rate limiter: {test_client.limiter.stats()}")
         if hasattr(test_client, '_model_name'):
             st.sidebar.write(f"Selected model: {test_client._model_name}")
         if hasattr(test_client, '_last_error') and test_client._last_error:
@@ -65,12 +78,19 @@ if st.sidebar.checkbox("Show debug info", key="show_debug"):
             if hasattr(test_client, '_last_error') and test_client._last_error:
                 st.sidebar.error(f"API Error: {test_client._last_error}")
 
+llm = get_shared_client(st.session_state.use_google)
+
 if st.sidebar.button("Create task"):
-    cr = CreatorAgent(use_google=st.session_state.use_google).run({"level": st.session_state.level})
+    if service:
+        cr, schema_view = service.create_task(st.session_state.level, use_llm=st.session_state.use_google)
+    else:
+        cr = CreatorAgent(llm=llm).run({"level": st.session_state.level})
+        schema_view = SchemaAgent(llm=llm).compute(cr.content or "")
+        warm_up(cr.content or "", cr.query, schema_view)
     st.session_state.task = cr.content
     st.session_state.starter_query = cr.query
     st.session_state.query_input = cr.query or st.session_state.get("query_input", "")
-    st.session_state.schema_view = SchemaAgent(use_google=st.session_state.use_google).compute(st.session_state.task or "")
+    st.session_state.schema_view = schema_view
 
 st.title("KQL Tutor, Fixer, Optimizer, Explainer")
 col1, col2 = st.columns([2, 1])
@@ -121,71 +141,26 @@ with col2:
             for r in sv.sample_rows[:3]:
                 st.write(r)
 
-if run:
-    context = {
-        "query": query or "",
-        "task": st.session_state.task,
-        "level": st.session_state.level,
-    }
-    schema_view = st.session_state.get("schema_view")
-    schema_dict = None
-    if schema_view:
-        schema_dict = {
-            "suggested_table": schema_view.suggested_table,
-            "reason": schema_view.reason,
-            "relevant_columns": schema_view.relevant_columns,
-            "sample_rows": schema_view.sample_rows[:3],
-        }
-    
-    # Step 1: Run EvaluatorAgent first to evaluate if query fulfills task
-    evaluator = EvaluatorAgent(use_google=st.session_state.use_google).run({
-        **context,
-        "schema": schema_dict
-    })
-    
-    # Step 2: Run all other agents in parallel with evaluation result
-    from concurrent.futures import ThreadPoolExecutor
-    
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        # Submit all agent tasks in parallel with evaluation result
-        tutor_future = executor.submit(
-            TutorAgent(use_google=st.session_state.use_google).run,
-            {**context, "schema": schema_dict, "evaluation": evaluator}
-        )
-        fixer_future = executor.submit(
-            FixerAgent(use_google=st.session_state.use_google).run,
-            {**context, "schema": schema_dict, "evaluation": evaluator}
-        )
-        opt_future = executor.submit(
-            OptimizerAgent(use_google=st.session_state.use_google).run,
-            {**context, "schema": schema_dict, "fixed_query": query, "evaluation": evaluator}
-        )
-        expl_future = executor.submit(
-            ExplainerAgent(use_google=st.session_state.use_google).run,
-            {**context, "schema": schema_dict, "optimized_query": query, "evaluation": evaluator}
-        )
-        
-        # Wait for all agents to complete (their LLM calls run in parallel)
-        tutor = tutor_future.result()
-        fixer = fixer_future.result()
-        opt = opt_future.result()
-        expl = expl_future.result()
+# How long the page keeps waiting for LLM results after showing the rule-based ones
+ENHANCE_WAIT = 60.0
 
-    st.header("Output")
-    
-    # Show evaluation result at the top
-    st.subheader("Task Evaluation")
-    if evaluator.fulfills_task is not None:
-        st.write(f"**Query fulfills task:** {'✅ Yes' if evaluator.fulfills_task else '❌ No'}")
-    if evaluator.reason:
-        if "**" in evaluator.reason:
-            st.markdown(evaluator.reason)
-        else:
-            st.write(evaluator.reason)
-    st.divider()
-    
-    o1, o2 = st.columns(2)
-    with o1:
+def render_section(name: str, results: dict, query: str, draft: str | None, enhancing: bool) -> None:
+    evaluator, tutor, fixer, opt, expl = (results[k] for k in ("evaluation", "tutor", "fixer", "optimizer", "explainer"))
+    if name == "evaluation":
+        # Show evaluation result at the top
+        st.subheader("Task Evaluation")
+        if evaluator.fulfills_task is not None:
+            st.write(f"**Query fulfills task:** {'✅ Yes' if evaluator.fulfills_task else '❌ No'}")
+        if evaluator.checks:
+            st.caption(f"Rule-based confidence: {evaluator.confidence:.0%}")
+            for c in evaluator.checks:
+                st.write(f"{'✅' if c['passed'] else '➖' if c.get('superseded') else '❌'} {c['requirement']}")
+        if evaluator.reason:
+            if "**" in evaluator.reason:
+                st.markdown(evaluator.reason)
+            else:
+                st.write(evaluator.reason)
+    elif name == "tutor":
         st.subheader("Tutor lesson")
         if tutor.content:
             # Check if content has markdown formatting
@@ -199,6 +174,7 @@ if run:
         st.subheader("Alternative patterns")
         for a in tutor.suggestions or []:
             st.write(f"- {a}")
+    elif name == "fixer":
         st.subheader("Task vs Query")
         # Use evaluator's result (already shown at top, but show fixer's corrections here)
         if fixer.reason and "Task Coverage" in fixer.reason:
@@ -212,7 +188,7 @@ if run:
             st.write(f"- {d}")
         st.subheader("Fixed query (commented)")
         st.code(fixer.query or "", language="kusto")
-    with o2:
+    elif name == "optimizer":
         st.subheader("Optimizer: Before vs After")
         st.write("Before:")
         st.code(fixer.query or query or "", language="kusto")
@@ -223,6 +199,7 @@ if run:
             st.write(f"- {s}")
         if opt.content and "Task Alignment" in opt.content:
             st.markdown(opt.content)
+    elif name == "explainer":
         st.subheader("Explanation")
         if expl.content:
             # Check if content has markdown formatting
@@ -233,4 +210,114 @@ if run:
         if expl.hints:
             for h in expl.hints:
                 st.write(h)
+    if enhancing and st.session_state.use_google:
+        st.caption("Enhancing with AI…")
+        if draft:
+            st.text(draft[-800:])
+
+if run:
+    context = {
+        "query": query or "",
+        "task": st.session_state.task,
+        "level": st.session_state.level,
+        "reference_query": st.session_state.get("starter_query"),
+    }
+    schema_view = st.session_state.get("schema_view")
+    schema_dict = None
+    if schema_view:
+        schema_dict = {
+            "suggested_table": schema_view.suggested_table,
+            "reason": schema_view.reason,
+            "relevant_columns": schema_view.relevant_columns,
+            "sample_rows": schema_view.sample_rows[:3],
+            "ranked": schema_view.ranked,
+        }
+    
+    # Evaluator and the four agents run as one dependency graph: agents start from the
+    # rule-based evaluation and are only re-run if the LLM verdict disagrees.
+    # Rule-based results render first; each section is replaced as its agent finishes
+    # and shows the LLM text while it streams in.
+    agent_context = {**context, "schema": schema_dict}
+    bundle_mode = st.session_state.get("bundle_mode", False)
+    st.header("Output")
+    eval_ph = st.empty()
+    st.divider()
+    o1, o2 = st.columns(2)
+    with o1:
+        tutor_ph = st.empty()
+        fixer_ph = st.empty()
+    with o2:
+        opt_ph = st.empty()
+        expl_ph = st.empty()
+    placeholders = {"evaluation": eval_ph, "tutor": tutor_ph, "fixer": fixer_ph, "optimizer": opt_ph, "explainer": expl_ph}
+
+    if service:
+        # The service waits for hedged sections itself, so there is nothing to stream here
+        with st.spinner("Analyzing…"):
+            current = service.analyze(agent_context, bundle=bundle_mode, use_llm=st.session_state.use_google)
+        for name, placeholder in placeholders.items():
+            with placeholder.container():
+                render_section(name, current, query, None, False)
+    else:
+        current = rule_based_analysis(agent_context)
+        drafts = {}
+        futures = get_scheduler().submit(analysis_nodes(agent_context, llm, bundle=bundle_mode, progress=drafts.__setitem__))
+
+        final_keys = ["evaluation", "bundle"] if bundle_mode else ["evaluation", "tutor", "fixer", "optimizer", "explainer"]
+        pending = set(final_keys)
+        shown = {}
+        started = time.monotonic()
+        while True:
+            for k in list(pending):
+                if futures[k].done():
+                    pending.discard(k)
+                    value = futures[k].result()
+                    current.update(value if k == "bundle" else {k: value})
+            # Sections that hit their latency budget show rule output until the LLM result lands
+            for name in placeholders:
+                r = current[name]
+                if r.enhancing and r.pending is not None and r.pending.done():
+                    value = r.pending.result()
+                    current[name] = value[name] if isinstance(value, dict) else value
+            waiting = time.monotonic() - started < ENHANCE_WAIT
+            for name, ph in placeholders.items():
+                draft_key = "bundle" if bundle_mode and name != "evaluation" else name
+                enhancing = waiting and (draft_key in pending or current[name].enhancing)
+                draft = drafts.get(draft_key) if enhancing else None
+                state = (id(current[name]), id(current["fixer"]) if name == "optimizer" else None, draft, enhancing)
+                if shown.get(name) != state:
+                    shown[name] = state
+                    with ph.container():
+                        render_section(name, current, query, draft, enhancing)
+            if not pending and not any(current[n].enhancing for n in placeholders):
+                break
+            if not waiting:
+                # Late LLM results still finish in the background and are cached for the next Analyze
+                break
+            time.sleep(0.1)
+
+    st.subheader("Query results")
+    source = "dynamic" if st.session_state.get("query_source", "").startswith("Dynamic") else "static"
+    results_placeholder = st.empty()
+
+    def run_query(sample: float | None = None, sample_mode: str = "uniform"):
+        if service:
+            return service.execute(query or "", source=source, task=st.session_state.task, sample=sample, sample_mode=sample_mode)
+        return execute_query(query or "", source=source, schema_view=schema_view, sample=sample, sample_mode=sample_mode)
+
+    if st.session_state.get("sample_preview"):
+        # Show the approximate preview first, then replace it with the exact run
+        preview = run_query(st.session_state.get("sample_rate", 0.1), st.session_state.get("sample_mode", "uniform"))
+        with results_placeholder.container():
+            st.caption(f"Approximate: sampled {preview.stats.get('rows_sampled', 0)} of {preview.stats.get('rows_total', 0)} rows; counts are scaled estimates with 95% bounds. Exact results follow…")
+            st.dataframe(list(preview))
+    exact = run_query()
+    with results_placeholder.container():
+        if exact.aborted:
+            st.error(exact.message)
+        elif exact.truncated:
+            st.warning(exact.message)
+        if exact.aborted or exact.truncated:
+            st.caption(f"Rows scanned: {exact.stats.get('rows_scanned', 0)}, elapsed: {exact.stats.get('elapsed_ms', 0)} ms")
+        st.dataframe(list(exact))
 
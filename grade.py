@@ -0,0 +1,245 @@
+"""Batch grading of cohort submissions.
+
+Reads JSONL records ({"student", "task", "query"}, optionally "reference_query"
+and "suggested_table") and writes one JSONL result per record, in input order,
+as soon as it and every record before it are graded. Each distinct (task,
+canonical query) is graded once, however many students sent it, so spacing,
+take/limit and the order of `and` terms do not cost a regrade;
+records carry the query's canonical hash and structural fingerprint
+(kql_canon), and --clusters prints the most common query shapes with their
+pass counts. Grading runs
+assess_task, fix_query and optimize_query, and with --execute also compares the
+query's rows against the reference query's (order insensitive) on every
+generated dataset variant, with the clock pinned as in kql_semantic; "match" is
+null when the reference returns no rows on any of them. When a reference query is given, assess_task also compares
+results on generated data (kql_semantic). Example:
+
+    python grade.py submissions.jsonl --execute --clusters 10 > grades.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, wait
+from typing import Any, Iterable, Iterator
+
+def read_records(path: str) -> Iterator[tuple[int, dict | None, str | None]]:
+    """(line number, record, error) for each non-blank line."""
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield n, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict) or not isinstance(record.get("query"), str):
+                yield n, None, "Record needs a string 'query'"
+                continue
+            yield n, record, None
+
+def result_summary(rows: list, ref_rows: list) -> dict:
+    """rows and ref_rows hold one result per dataset variant; the first
+    variant where they differ is reported, else the base dataset."""
+    from kql_semantic import canonical, rows_match
+
+    # two empty results agree on nothing
+    if not any(ref_rows):
+        return {"match": None, "rows": len(rows[0]), "reference_rows": 0, "variants": len(rows)}
+    differs = next((i for i, (got, want) in enumerate(zip(rows, ref_rows))
+                    if not rows_match(canonical(got), canonical(want))), None)
+    i = differs or 0
+    return {"match": differs is None, "rows": len(rows[i]), "reference_rows": len(ref_rows[i]), "variants": len(rows),
+            **({"variant": differs} if differs is not None else {})}
+
+def compare_results(query: str, reference: str, source: str, view: Any) -> dict:
+    from kql_exec import execute_query
+    import kql_semantic
+
+    # every variant the semantic grade checks (including the time-window boundary rows), so the
+    # two verdicts agree; generated tables replace the catalog sample, source/view apply to the rest
+    base, deltas = kql_semantic.datasets()
+    rows, ref_rows = [], []
+    for delta in deltas:
+        tables = {t: base_rows + delta.get(t, []) for t, base_rows in base.items()}
+        try:
+            ref = execute_query(reference, source=source, schema_view=view, tables=tables, now=kql_semantic.NOW, budget=kql_semantic.BUDGET)
+            got = execute_query(query, source=source, schema_view=view, tables=tables, now=kql_semantic.NOW, budget=kql_semantic.BUDGET)
+        except Exception as e:
+            return {"match": False, "error": f"{type(e).__name__}: {e}"}
+        if got.aborted or ref.aborted:
+            return {"match": False, "error": got.message if got.aborted else f"Reference query: {ref.message}"}
+        rows.append(list(got))
+        ref_rows.append(list(ref))
+    return result_summary(rows, ref_rows)
+
+def grade_one(job: dict) -> dict:
+    from kql_parse import analyze_query
+    from kql_rules import assess_task_detailed, compute_diffs, fix_query, optimize_query
+
+    a = analyze_query(job["query"])
+    task, table = job["task"], job["suggested_table"]
+    verdict = assess_task_detailed(task, a, {"suggested_table": table, "ranked": job["ranked"]}, job["reference_query"])
+    fixed = fix_query(a, suggested_table=table, task=task)
+    optimized, changes = optimize_query(a, task, job["relevant_columns"], table)
+    graded = {
+        "fulfills": verdict["fulfills"],
+        "confidence": verdict["confidence"],
+        "exact_match": verdict["exact_match"],
+        "reason": verdict["reason"],
+        "mismatches": verdict["mismatches"],
+        "checks": verdict["checks"],
+        "semantic": verdict["semantic"],
+        "fixed_query": fixed,
+        "fix_diffs": compute_diffs(a, fixed),
+        "optimized_query": optimized,
+        "optimizations": changes,
+    }
+    if job["execute"]:
+        graded["result"] = (compare_results(job["query"], job["reference_query"], job["source"], job["view"])
+                            if job["reference_query"] else {"match": None, "error": "No reference query"})
+    return graded
+
+def grade_chunk(jobs: list[tuple[Any, dict]]) -> list[tuple[Any, dict]]:
+    out = []
+    for key, job in jobs:
+        try:
+            out.append((key, grade_one(job)))
+        except Exception as e:
+            out.append((key, {"error": f"{type(e).__name__}: {e}"}))
+    return out
+
+class InlineExecutor(Executor):
+    """--workers 0: grade in this process (for debugging and profiling)."""
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        f = Future()
+        try:
+            f.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            f.set_exception(e)
+        return f
+
+def grade_stream(records: Iterable[tuple[int, dict | None, str | None]], pool: Executor, chunk_size: int, window: int,
+                 execute: bool, source: str, stats: dict) -> Iterator[dict]:
+    """Yield graded records in input order; at most window chunks are in flight."""
+    from agents.base import get_shared_client
+    from agents.schema import SchemaAgent
+    from kql_canon import canonicalize, query_hash
+
+    schema = SchemaAgent(llm=get_shared_client(False))
+    views: dict[str, Any] = {}
+    graded: dict[Any, dict] = {}
+    queued: set = set()
+    order: deque = deque()   # (line, record, key or error)
+    chunk: list[tuple[Any, dict]] = []
+    inflight: set[Future] = set()
+
+    def collect(done: Iterable[Future]) -> None:
+        for f in done:
+            inflight.discard(f)
+            for key, result in f.result():
+                graded[key] = result
+
+    def flush() -> Iterator[dict]:
+        while order:
+            line, record, key = order[0]
+            if record is None:
+                out = {"line": line, "error": key}
+            elif key in graded:
+                c = canonicalize(record["query"])
+                out = {"line": line, **{k: record.get(k) for k in ("student", "task", "query")},
+                       "query_hash": c.hash, "fingerprint": c.fingerprint, **graded[key]}
+            else:
+                return
+            order.popleft()
+            stats["records"] += 1
+            stats["passed"] += bool(out.get("fulfills"))
+            yield out
+
+    def dispatch() -> None:
+        nonlocal chunk
+        if chunk:
+            inflight.add(pool.submit(grade_chunk, chunk))
+            stats["chunks"] += 1
+            chunk = []
+
+    for line, record, error in records:
+        if record is None:
+            order.append((line, None, error))
+            yield from flush()
+            continue
+        task = str(record.get("task") or "")
+        view = views.get(task)
+        if view is None:
+            view = views[task] = schema.compute(task)
+        reference = record.get("reference_query") or None
+        table = record.get("suggested_table") or view.suggested_table
+        # a table given in the record is certain; one only the schema ranking picked is not
+        ranked = not record.get("suggested_table") and view.ranked
+        key = (task, query_hash(record["query"]), query_hash(reference) if reference else "", table, ranked)
+        order.append((line, record, key))
+        if key not in queued:
+            queued.add(key)
+            chunk.append((key, {"query": record["query"], "task": task, "reference_query": reference, "suggested_table": table,
+                                "ranked": ranked, "relevant_columns": view.relevant_columns, "execute": execute, "source": source,
+                                "view": view if source == "dynamic" else None}))
+            if len(chunk) >= chunk_size:
+                dispatch()
+                # Backpressure: stop reading until a chunk finishes
+                while len(inflight) >= window:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    collect(done)
+        collect([f for f in list(inflight) if f.done()])
+        yield from flush()
+    dispatch()
+    while inflight:
+        done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+        collect(done)
+        yield from flush()
+    yield from flush()
+    stats["distinct"] = len(queued)
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Grade a JSONL file of KQL submissions")
+    ap.add_argument("path", help="JSONL submissions, or - for stdin")
+    ap.add_argument("-o", "--output", default="-", help="JSONL results (default stdout)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="grading processes; 0 grades inline")
+    ap.add_argument("--chunk-size", type=int, default=32, help="distinct queries per dispatched chunk")
+    ap.add_argument("--execute", action="store_true", help="compare result rows against reference_query")
+    ap.add_argument("--source", default="static", choices=["static", "dynamic"], help="execute_query data source for tables without generated data")
+    ap.add_argument("--clusters", type=int, default=0, metavar="N", help="print the N most common query shapes per task")
+    args = ap.parse_args()
+
+    stats = {"records": 0, "passed": 0, "chunks": 0, "distinct": 0}
+    start = time.monotonic()
+    pool = InlineExecutor() if args.workers <= 0 else ProcessPoolExecutor(max_workers=args.workers)
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    seen = []
+    try:
+        with pool:
+            for result in grade_stream(read_records(args.path), pool, max(1, args.chunk_size), max(2, 2 * args.workers),
+                                       args.execute, args.source, stats):
+                out.write(json.dumps(result, default=str) + "\n")
+                out.flush()
+                if args.clusters and "query" in result:
+                    seen.append({k: result.get(k) for k in ("task", "query", "fulfills")})
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.monotonic() - start
+    print(f"Graded {stats['records']} records ({stats['distinct']} distinct queries, {stats['chunks']} chunks) "
+          f"in {elapsed:.2f}s, {stats['passed']} fulfill their task", file=sys.stderr)
+    if args.clusters:
+        from kql_canon import cluster
+
+        print("Most common query shapes:", file=sys.stderr)
+        for c in cluster(seen)[:args.clusters]:
+            print(f"  {c.size:>6} submissions {len(c.variants):>4} variants {c.passed:>6} passed  {c.structure}"
+                  + (f"  [{c.task.splitlines()[0][:40]}]" if c.task else ""), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
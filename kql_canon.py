@@ -0,0 +1,242 @@
+"""Canonical forms of queries, so trivially different submissions share work.
+
+canonicalize() rewrites the token stream: aliases resolved (limit -> take,
+sort -> order), strings in double quotes, comparisons with the constant on the
+right (4625 == EventID -> EventID == 4625), consecutive where stages merged and
+their top-level `and` terms sorted. Whitespace and comments are already gone
+with the tokens.
+
+`hash` identifies the canonical query exactly. KQL keywords are case-sensitive
+(`WHERE` does not parse), so it keeps their case. `fingerprint` is taken after
+stage and word operators are lower-cased and literals replaced with ?, so
+queries differing only in constants (take 5 vs take 10, "srv-01" vs "srv-02")
+or keyword case share it. Cluster a cohort's submissions by
+fingerprint without grading anything:
+
+    python kql_canon.py submissions.jsonl
+"""
+import argparse
+import hashlib
+import json
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable
+from kql_parse import COMPARISONS, KEYWORDS, WORD_OPS, Token, as_analysis, significant, split_tokens, stage_operator, tokenize
+
+ALIASES = {"limit": "take", "sort": "order"}
+# Lower-cased in the structure wherever they appear; other identifiers may be columns and keep their case
+LOWER_WORDS = WORD_OPS | {"and", "or", "not", "by", "asc", "desc", "nulls", "true", "false", "with", "kind"}
+FLIPPED = {">": "<", "<": ">", ">=": "<=", "<=": ">=", "==": "==", "!=": "!=", "=~": "=~", "!~": "!~"}
+LITERALS = {"string", "number", "timespan"}
+LITERAL_CALLS = {"datetime", "timespan", "dynamic", "time"}
+# A term is a list of (canonical text, structural text) pieces; render() picks one by index
+EXACT, STRUCTURE = 0, 1
+Piece = tuple[str, str]
+
+@dataclass(frozen=True)
+class Canonical:
+    text: str           # canonical query
+    hash: str           # of text
+    structure: str      # text with literals replaced by ?
+    fingerprint: str    # of structure
+
+@dataclass
+class Cluster:
+    fingerprint: str
+    structure: str
+    example: str                    # first submission seen, as written
+    task: str = ""
+    size: int = 0
+    variants: set[str] = field(default_factory=set)    # distinct canonical hashes
+    passed: int = 0
+
+    def to_dict(self) -> dict:
+        return {"fingerprint": self.fingerprint, "task": self.task, "size": self.size, "variants": len(self.variants),
+                "passed": self.passed, "structure": self.structure, "example": self.example}
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def quoted(t: Token) -> str:
+    # 'x' -> "x" when that needs no escaping
+    text = t.text
+    prefix = "@" if text.startswith("@") else ""
+    body = text[len(prefix):]
+    if len(body) >= 2 and body[0] == body[-1] == "'" and '"' not in body and "\\" not in body:
+        return prefix + '"' + body[1:-1] + '"'
+    return text
+
+def pieces(tokens: list[Token]) -> list[Piece]:
+    out: list[Piece] = []
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+        if t.kind == "ident" and t.text.lower() in LITERAL_CALLS and nxt is not None and nxt.text == "(":
+            # datetime(2025-12-08) is one literal, not a subtraction of numbers
+            depth, j = 0, i + 1
+            while j < len(tokens):
+                depth += {"lparen": 1, "rparen": -1}.get(tokens[j].kind, 0)
+                j += 1
+                if depth == 0:
+                    break
+            text = t.text + "(" + "".join(x.text for x in tokens[i + 2:j - 1]) + ")"
+            out.append((text, "?"))
+            i = j
+            continue
+        if t.kind == "string":
+            out.append((quoted(t), "?"))
+        elif t.kind in LITERALS:
+            out.append((t.text, "?"))
+        elif t.kind == "ident" and t.text.lower() in LOWER_WORDS:
+            out.append((t.text, t.text.lower()))
+        else:
+            out.append((t.text,) * 2)
+        i += 1
+    return out
+
+def render(ps: list[Piece], which: int) -> str:
+    out = ""
+    prev = ""
+    for p in ps:
+        s = p[which]
+        glue = (not out or prev in ("(", "[", "{", "!", ".") or s in (")", "]", "}", ",", ".")
+                or (s in ("(", "[") and prev.lower() not in LOWER_WORDS and (prev[-1:].isalnum() or prev[-1:] in ("_", ")", "]"))))
+        out += s if glue else " " + s
+        prev = s
+    return out
+
+def constant(ps: list[Piece]) -> bool:
+    """Literals and calls on literals (ago(1d), now()), but not a bare column."""
+    return bool(ps) and all(p[1] in ("?", "(", ")", ",") or p[0].lower() in ("ago", "now") for p in ps) \
+        and any(p[1] == "?" or p[0].lower() in ("ago", "now") for p in ps)
+
+def oriented(term: list[Token]) -> list[Piece]:
+    """4625 == EventID -> EventID == 4625, ago(1d) < TimeGenerated -> TimeGenerated > ago(1d)."""
+    depth = 0
+    ops = []
+    for i, t in enumerate(term):
+        depth += {"lparen": 1, "rparen": -1}.get(t.kind, 0)
+        if depth == 0 and t.kind == "op" and t.text in COMPARISONS:
+            ops.append(i)
+    if len(ops) == 1:
+        i = ops[0]
+        left, right = pieces(term[:i]), pieces(term[i + 1:])
+        if constant(left) and len(right) == 1 and term[-1].kind == "ident" and term[-1].text.lower() not in KEYWORDS:
+            return right + [(FLIPPED[term[i].text],) * 2] + left
+    return pieces(term)
+
+def top_level(tokens: list[Token], word: str, which: int) -> list[list[Token]]:
+    # only the structure folds case: `AND` is not KQL's and
+    parts, cur, depth = [], [], 0
+    for t in tokens:
+        depth += {"lparen": 1, "rparen": -1}.get(t.kind, 0)
+        if depth == 0 and t.kind == "ident" and (t.text.lower() if which == STRUCTURE else t.text) == word:
+            parts.append(cur)
+            cur = []
+            continue
+        cur.append(t)
+    parts.append(cur)
+    return parts
+
+def where_terms(expr: list[Token], which: int) -> list[list[Piece]]:
+    if len(top_level(expr, "or", which)) > 1:
+        # `and` binds tighter than `or`: keep the expression whole, parenthesized for merging
+        return [[("(", "(")] + pieces(expr) + [(")", ")")]]
+    return [oriented(term) for term in top_level(expr, "and", which) if term]
+
+def canonical_stages(tokens: list[Token], which: int) -> list[str]:
+    """Rendered stages, exact (keyword case kept) or structural (folded)."""
+    out = []
+    merged: list[list[Piece]] | None = None     # terms of the where stages seen in a row
+
+    def flush() -> None:
+        nonlocal merged
+        if merged is not None:
+            out.append(" ".join(["where", " and ".join(sorted(render(t, which) for t in merged))]).strip())
+            merged = None
+
+    for n, stage in enumerate(split_tokens(tokens, "pipe")):
+        op = stage_operator(stage)
+        head = 3 if "-" in op and n else 1
+        if which == EXACT:
+            # as written, so a mis-cased operator stays a different (invalid) query
+            op = "".join(t.text for t in stage[:head])
+        if n and op == "where":
+            merged = (merged or []) + where_terms(stage[1:], which)
+            continue
+        flush()
+        if not stage:
+            out.append("")
+        elif n or op.lower() in KEYWORDS:
+            out.append(" ".join([ALIASES.get(op, op), render(pieces(stage[head:]), which)]).strip())
+        else:
+            out.append(render(pieces(stage), which))
+    flush()
+    return out
+
+@lru_cache(maxsize=4096)
+def canonicalize(q: str) -> Canonical:
+    # QueryAnalysis.tokens has no semicolons, so statements are split here
+    statements = [s for s in split_tokens(significant(tokenize(as_analysis(q).code)), "semicolon") if s]
+    texts, structures = [], []
+    for st in statements:
+        texts.append(" | ".join(canonical_stages(st, EXACT)))
+        structures.append(" | ".join(canonical_stages(st, STRUCTURE)))
+    text, structure = "; ".join(texts), "; ".join(structures)
+    # in ("a", "b", "c") and in ("a") have the same shape
+    structure = re.sub(r"\?(?:, \?)+", "?", structure)
+    return Canonical(text, digest(text), structure, digest(structure))
+
+def canonical_query(q: str) -> str:
+    return canonicalize(q or "").text
+
+def query_hash(q: str) -> str:
+    return canonicalize(q or "").hash
+
+def query_fingerprint(q: str) -> str:
+    return canonicalize(q or "").fingerprint
+
+def cluster(queries: Iterable["str | dict"]) -> list[Cluster]:
+    """Submissions grouped by structural fingerprint, largest first. Items are
+    query strings or dicts with "query" and optionally "fulfills" (counted in
+    passed); a dict's "task" keeps the same shape under different tasks apart."""
+    clusters: dict[tuple[str, str], Cluster] = {}
+    for item in queries:
+        record = item if isinstance(item, dict) else {"query": item}
+        q = str(record.get("query") or "")
+        c = canonicalize(q)
+        key = (str(record.get("task") or ""), c.fingerprint)
+        entry = clusters.get(key)
+        if entry is None:
+            entry = clusters[key] = Cluster(c.fingerprint, c.structure, q.strip(), key[0])
+        entry.size += 1
+        entry.variants.add(c.hash)
+        entry.passed += bool(record.get("fulfills"))
+    return sorted(clusters.values(), key=lambda c: (-c.size, c.structure))
+
+def main() -> None:
+    from kql_lint import read_queries
+
+    ap = argparse.ArgumentParser(description="Cluster KQL submissions by query shape")
+    ap.add_argument("path", help="JSONL file of submissions, or - for stdin")
+    ap.add_argument("--top", type=int, default=20, help="clusters to print (0 prints all)")
+    ap.add_argument("--json", action="store_true", help="print clusters as JSONL")
+    args = ap.parse_args()
+
+    items = list(read_queries(args.path))
+    found = cluster(items)
+    shown = found[:args.top] if args.top > 0 else found
+    if args.json:
+        for c in shown:
+            print(json.dumps(c.to_dict()))
+        return
+    distinct = len({h for c in found for h in c.variants})
+    print(f"{len(items)} submissions, {distinct} distinct canonical queries, {len(found)} shapes")
+    print(f"  {'size':>6} {'share':>6} {'variants':>8} {'passed':>6}  shape")
+    for c in shown:
+        print(f"  {c.size:>6} {c.size / len(items):>6.1%} {len(c.variants):>8} {c.passed:>6}  {c.structure}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,23 @@
+import math
+import random
 import re
-from typing import List, Dict, Any
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from itertools import islice
+from threading import Lock
+from typing import List, Dict, Any, Callable, Iterable
 from datetime import datetime, timedelta, timezone
 from schema_catalog import BASE_CATALOG
+from kql_parse import strip_comments
+
+try:
+    import regex as _regex  # optional: supports a match timeout
+except Exception:
+    _regex = None
 
 def parse_iso(dt: str) -> datetime:
     s = str(dt).replace("Z", "+00:00")
@@ -10,124 +26,706 @@ def parse_iso(dt: str) -> datetime:
     except Exception:
         return datetime.now(timezone.utc)
 
-def floor_time(dt: datetime, n: int, unit: str) -> datetime:
-    if unit == 'm':
-        floored_minute = (dt.minute // n) * n
-        return dt.replace(minute=floored_minute, second=0, microsecond=0)
-    if unit == 'h':
-        return dt.replace(minute=0, second=0, microsecond=0)
-    if unit == 'd':
-        return datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
-    return dt.replace(second=0, microsecond=0)
-
-def strip_comments(q: str) -> str:
-    return re.sub(r"//.*", "", q)
-
-def execute_query(q: str, source: str = "static", schema_view: Any = None) -> List[Dict[str, Any]]:
-    q = strip_comments(q).strip()
-    stages = [p.strip() for p in q.split("|") if p.strip()]
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+UNIT_NS = {
+    "ms": 1_000_000,
+    "s": 1_000_000_000,
+    "m": 60 * 1_000_000_000,
+    "h": 3600 * 1_000_000_000,
+    "d": 86400 * 1_000_000_000,
+}
+
+def datetime_to_ns(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    td = dt - EPOCH
+    return (td.days * 86400 + td.seconds) * 1_000_000_000 + td.microseconds * 1000
+
+@lru_cache(maxsize=65536)
+def epoch_ns(value: str) -> int | None:
+    # timestamps repeat across operators and queries, so each distinct string is parsed once
+    try:
+        return datetime_to_ns(datetime.fromisoformat(value.replace("Z", "+00:00")))
+    except Exception:
+        return None
+
+def to_epoch_ns(value: Any) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return datetime_to_ns(value)
+    return epoch_ns(str(value))
+
+def format_ns(ns: int | None) -> str | None:
+    if ns is None:
+        return None
+    return (EPOCH + timedelta(microseconds=ns // 1000)).isoformat()
+
+def timespan_ns(n: float | str, unit: str) -> int:
+    return int(round(float(n) * UNIT_NS[unit]))
+
+def bin_ns(ns: int, size_ns: int) -> int:
+    return ns - ns % size_ns if size_ns > 0 else ns
+
+def floor_time(dt: datetime, n: float, unit: str) -> datetime:
+    ns = bin_ns(datetime_to_ns(dt), timespan_ns(n, unit if unit in UNIT_NS else "m"))
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
+def split_top_level(q: str, sep: str) -> List[str]:
+    # split on sep outside of parentheses and string literals
+    parts = []
+    depth = 0
+    quote = None
+    cur = []
+    for ch in q:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append("".join(cur).strip())
+            cur = []
+            continue
+        cur.append(ch)
+    parts.append("".join(cur).strip())
+    return [p for p in parts if p]
+
+def replace_name(text: str, name: str, value: str) -> str:
+    # substitute a bare identifier, leaving string literals untouched
+    pattern = r"\"[^\"]*\"|'[^']*'|\b" + re.escape(name) + r"\b"
+    return re.sub(pattern, lambda m: value if m.group(0) == name else m.group(0), text)
+
+def count_name(text: str, name: str) -> int:
+    pattern = r"\"[^\"]*\"|'[^']*'|\b" + re.escape(name) + r"\b"
+    return sum(1 for m in re.finditer(pattern, text) if m.group(0) == name)
+
+@dataclass
+class QueryBudget:
+    max_seconds: float | None = 5.0
+    max_rows_scanned: int | None = 5_000_000
+    max_rows_materialized: int | None = 2_000_000
+    max_memory_mb: float | None = 256.0
+
+DEFAULT_BUDGET = QueryBudget()
+
+class QueryAborted(Exception):
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+# nested quantifiers such as (a+)+ or (.*)* and repeated overlapping alternations backtrack exponentially
+UNSAFE_REGEX = re.compile(r"\((?:[^()\\]|\\.)*[+*}](?:[^()\\]|\\.)*\)\s*[+*{]|\(([^()|]+)\|\1\)\s*[+*{]")
+MAX_REGEX_LENGTH = 256
+
+class Governor:
+    """Per-query budget bookkeeping, checked cooperatively from the operator loops."""
+
+    CHECK_EVERY = 1024
+
+    def __init__(self, budget: QueryBudget | None = None):
+        self.budget = budget or QueryBudget(None, None, None, None)
+        self.started = time.monotonic()
+        self.rows_scanned = 0
+        self.rows_materialized = 0
+        self.peak_memory_bytes = 0
+        self.truncated = False
+        self._lock = Lock()
+
+    def remaining(self) -> float | None:
+        if self.budget.max_seconds is None:
+            return None
+        return self.budget.max_seconds - (time.monotonic() - self.started)
+
+    def check_time(self) -> None:
+        left = self.remaining()
+        if left is not None and left <= 0:
+            raise QueryAborted("time", f"Query aborted: exceeded {self.budget.max_seconds}s time budget")
+
+    def scan(self, rows: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+        # rows are counted in batches so the lock and clock are touched every CHECK_EVERY rows
+        pending = 0
+        try:
+            for r in rows:
+                if pending == self.CHECK_EVERY:
+                    pending = 0
+                    if not self._add_scanned(self.CHECK_EVERY):
+                        return
+                pending += 1
+                yield r
+        finally:
+            # also when the consumer stops early (take, an aborted stage) and closes the scan
+            with self._lock:
+                self.rows_scanned += pending
+        self.check_time()
+
+    def _add_scanned(self, n: int) -> bool:
+        self.check_time()
+        with self._lock:
+            self.rows_scanned += n
+            limit = self.budget.max_rows_scanned
+            if limit is not None and self.rows_scanned >= limit:
+                self.truncated = True
+                return False
+        return True
+
+    def materialized(self, rows: List[Dict[str, Any]]) -> None:
+        self.check_time()
+        with self._lock:
+            self.rows_materialized += len(rows)
+            if rows:
+                first = rows[0]
+                row_bytes = sys.getsizeof(first) + sum(sys.getsizeof(v) for v in first.values())
+                self.peak_memory_bytes = max(self.peak_memory_bytes, row_bytes * len(rows))
+        limit = self.budget.max_rows_materialized
+        if limit is not None and self.rows_materialized > limit:
+            raise QueryAborted("rows_materialized", f"Query aborted: materialized more than {limit} rows")
+        mem = self.budget.max_memory_mb
+        if mem is not None and self.peak_memory_bytes > mem * 1024 * 1024:
+            raise QueryAborted("memory", f"Query aborted: estimated memory above {mem} MB")
+
+    def regex(self, pattern: str) -> Any:
+        if len(pattern) > MAX_REGEX_LENGTH or UNSAFE_REGEX.search(pattern):
+            raise QueryAborted("regex", f"Regex rejected as potentially catastrophic: {pattern[:60]}")
+        try:
+            compiled = (_regex or re).compile(pattern, re.IGNORECASE)
+        except Exception as e:
+            raise QueryAborted("regex", f"Invalid regex: {e}")
+        if _regex is None:
+            return compiled.search
+        return lambda s: compiled.search(s, timeout=max(self.remaining() or 1.0, 0.01))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rows_scanned": self.rows_scanned,
+            "rows_materialized": self.rows_materialized,
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "elapsed_ms": round((time.monotonic() - self.started) * 1000, 1),
+        }
+
+@dataclass
+class ExecContext:
+    source: str = "static"
+    schema_view: Any = None
+    env: Dict[str, "LetBinding"] = field(default_factory=dict)
+    sample: float | None = None
+    sample_mode: str = "uniform"
+    seed: int | None = None
+    stats: Dict[str, Any] = field(default_factory=dict)
+    governor: Governor = field(default_factory=Governor)
+    tables: Dict[str, List[Dict[str, Any]]] | None = None  # replaces the catalog rows of these tables
+    now: datetime | None = None  # pins now() for ago()/startofday(); default is the wall clock
+
+class SampledRow(dict):
+    """A sampled row, carrying the number of rows it stands for (1 / its
+    inclusion probability). Rows derived from it (project, extend, union) are
+    SampledRows with the same weight."""
+
+    __slots__ = ("weight",)
+
+    def __init__(self, row: Dict[str, Any], weight: float):
+        super().__init__(row)
+        self.weight = weight
+
+def carry_weight(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    return SampledRow(new, old.weight) if isinstance(old, SampledRow) and not isinstance(new, SampledRow) else new
+
+class QueryResult(list):
+    """Rows returned by execute_query, plus how they were produced."""
+
+    def __init__(self, rows: Iterable[Dict[str, Any]] = (), approximate: bool = False, sample_rate: float | None = None, stats: Dict[str, Any] | None = None, truncated: bool = False, aborted: bool = False, message: str | None = None):
+        super().__init__(rows)
+        self.approximate = approximate
+        self.sample_rate = sample_rate
+        self.stats = stats or {}
+        self.truncated = truncated
+        self.aborted = aborted
+        self.message = message
+
+class LetBinding:
+    """A tabular let statement. Referenced more than once, it is evaluated a single
+    time and the rows are shared by every reference (union branches, self-joins)."""
+
+    def __init__(self, name: str, expr: str, refs: int, env: Dict[str, "LetBinding"]):
+        self.name = name
+        self.expr = expr
+        self.refs = refs
+        self.env = env
+        self.aggregated = re.search(r"\|\s*(summarize|distinct|top|take|limit)\b", expr) is not None
+        self._rows: List[Dict[str, Any]] | None = None
+        self._lock = Lock()
+
+    def rows(self, ctx: ExecContext) -> List[Dict[str, Any]]:
+        ctx = replace(ctx, env=self.env)
+        if self.refs <= 1:
+            return run_pipeline(self.expr, ctx)
+        with self._lock:
+            if self._rows is None:
+                self._rows = run_pipeline(self.expr, ctx)
+            return self._rows
+
+def is_tabular(expr: str, env: Dict[str, LetBinding]) -> bool:
+    head = split_top_level(expr, "|")[0] if expr else ""
+    return head in BASE_CATALOG or head in env or head.startswith("(") or re.match(r"union\b", head, flags=re.IGNORECASE) is not None
+
+def parse_lets(q: str) -> tuple[str, Dict[str, LetBinding]]:
+    statements = split_top_level(q, ";")
+    if not statements:
+        return "", {}
+    body = statements[-1]
+    lets = statements[:-1]
+    env: Dict[str, LetBinding] = {}
+    for i, st in enumerate(lets):
+        m = re.match(r"let\s+([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.+)$", st, flags=re.DOTALL)
+        if not m:
+            continue
+        name, expr = m.group(1), m.group(2).strip()
+        rest = lets[i + 1:] + [body]
+        if is_tabular(expr, env):
+            refs = sum(count_name(r, name) for r in rest)
+            env = {**env, name: LetBinding(name, expr, refs, env)}
+        else:
+            # scalar: fold the value into every later statement
+            lets[i + 1:] = [replace_name(r, name, expr) for r in lets[i + 1:]]
+            body = replace_name(body, name, expr)
+    return body, env
+
+def sample_rows(rows: List[Dict[str, Any]], ctx: ExecContext) -> List[Dict[str, Any]]:
+    n = len(rows)
+    rate = min(max(ctx.sample or 1.0, 0.0), 1.0)
+    rng = random.Random(ctx.seed)
+    if ctx.sample_mode == "time":
+        # time-stratified: the same rate inside every hourly bucket, and at least one
+        # row from each, keeps sparse periods represented
+        strata: Dict[Any, List[int]] = {}
+        for i, r in enumerate(rows):
+            ns = to_epoch_ns(r.get("TimeGenerated"))
+            strata.setdefault(bin_ns(ns, UNIT_NS["h"]) if ns is not None else None, []).append(i)
+        picked = []
+        for idx in strata.values():
+            chosen = rng.sample(idx, max(1, round(len(idx) * rate)))
+            picked.extend((i, len(idx) / len(chosen)) for i in chosen)
+        picked.sort()
+    else:
+        # uniform: draw indexes only, so the cost is proportional to the sample size
+        chosen = sorted(rng.sample(range(n), max(1, round(n * rate)) if n else 0))
+        picked = [(i, n / len(chosen)) for i in chosen]
+    ctx.stats["rows_total"] = ctx.stats.get("rows_total", 0) + n
+    ctx.stats["rows_sampled"] = ctx.stats.get("rows_sampled", 0) + len(picked)
+    # copies, so the weight never leaks into the shared catalog or dataset rows
+    return [SampledRow(rows[i], w) for i, w in picked]
+
+def scan_table(table: str, ctx: ExecContext) -> Iterable[Dict[str, Any]] | None:
+    if table in ctx.env:
+        return ctx.env[table].rows(ctx)
+    if ctx.tables is not None and table in ctx.tables:
+        rows = ctx.tables[table]
+    elif table not in BASE_CATALOG:
+        return None
+    elif ctx.source == "dynamic" and ctx.schema_view is not None and getattr(ctx.schema_view, "suggested_table", table) == table:
+        rows = ctx.schema_view.sample_rows
+    else:
+        rows = BASE_CATALOG[table]["sample_rows"]
+    if ctx.sample is not None and ctx.sample < 1:
+        rows = sample_rows(rows, ctx)
+    return ctx.governor.scan(rows)
+
+# union branches of every query share these threads
+_union_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="kql-union")
+
+def table_columns(table: str) -> List[str]:
+    return list(BASE_CATALOG.get(table, {}).get("columns", []))
+
+def scan_union(stage: str, ctx: ExecContext) -> Iterable[Dict[str, Any]]:
+    m = re.match(r"union\s+(?:withsource\s*=\s*([A-Za-z0-9_]+)\s+)?(.+)$", stage, flags=re.IGNORECASE | re.DOTALL)
+    if not m:
+        return []
+    source_col = m.group(1)
+    branches = split_top_level(m.group(2), ",")
+    if not branches:
+        return []
+
+    def run_branch(b: str) -> List[Dict[str, Any]]:
+        if b.startswith("(") and b.endswith(")"):
+            return run_pipeline(b[1:-1], ctx)
+        return list(scan_table(b, ctx) or [])
+
+    def static_columns(b: str) -> List[str] | None:
+        # None when only the branch's rows tell (a let, or stages the engine does not model)
+        if b.startswith("(") and b.endswith(")"):
+            unmodeled: List[str] = []
+            cols = pipeline_columns(b[1:-1], {}, unmodeled)
+            return None if unmodeled else cols
+        return None if b in ctx.env else table_columns(b) or None
+
+    # scan every branch concurrently; rows are yielded in branch order
+    futures = [_union_pool.submit(run_branch, b) for b in branches]
+
+    def resolve(i: int) -> List[Dict[str, Any]]:
+        # a branch still queued behind a busy pool (or behind the union nesting it)
+        # runs here instead, so nested unions cannot deadlock the shared pool
+        return run_branch(branches[i]) if futures[i].cancel() else futures[i].result()
+
+    def stream() -> Iterable[Dict[str, Any]]:
+        # every row gets the same columns: source column, then each branch's in
+        # order. Only branches whose columns cannot be known up front are waited
+        # for before the first row; the others stream as each one finishes.
+        known = [static_columns(b) for b in branches]
+        results: Dict[int, List[Dict[str, Any]]] = {}
+        for i, cols in enumerate(known):
+            if cols is None:
+                results[i] = resolve(i)
+                known[i] = list(results[i][0].keys()) if results[i] else []
+        columns = dict.fromkeys(([source_col] if source_col else []) + [c for cols in known for c in cols])
+        try:
+            for i, b in enumerate(branches):
+                rows = results.pop(i) if i in results else resolve(i)
+                tag = {source_col: b if not b.startswith("(") else f"union_arg{i}"} if source_col else {}
+                for r in rows:
+                    if not tag and r.keys() == columns.keys():
+                        yield r
+                        continue
+                    yield carry_weight(r, {**columns, **r, **tag})
+        finally:
+            # a consumer that stopped early (take) does not need the branches not yet started
+            for f in futures:
+                f.cancel()
+
+    return stream()
+
+def execute_query(q: str, source: str = "static", schema_view: Any = None, sample: float | None = None, sample_mode: str = "uniform", seed: int | None = None, budget: QueryBudget | None = DEFAULT_BUDGET, tables: Dict[str, List[Dict[str, Any]]] | None = None, now: datetime | None = None) -> QueryResult:
+    """Run q over the catalog sample rows (or the task view when source="dynamic").
+
+    With sample set to a fraction in (0, 1) the tables are sampled ("uniform" or
+    "time" stratified, keeping at least one row per table or hourly stratum) and
+    summarize count()/dcount() are scaled up by each row's actual inclusion rate,
+    with 95% confidence bounds; the result is then marked approximate.
+
+    Execution is bounded by budget (wall time, rows scanned, rows materialized,
+    estimated memory; None disables limits). Hitting the scan limit truncates the
+    input and marks the result truncated; the others abort with partial stats.
+
+    tables maps table names to rows that replace the catalog's (and the dynamic view's) for this query, and
+    now pins the clock that ago() and startofday(now()) are measured from."""
+    body, env = parse_lets(strip_comments(q).strip())
+    ctx = ExecContext(source=source, schema_view=schema_view, env=env, sample=sample, sample_mode=sample_mode, seed=seed, governor=Governor(budget), tables=tables, now=now)
+    approximate = sample is not None and sample < 1
+    try:
+        rows = run_pipeline(body, ctx)
+    except QueryAborted as e:
+        return QueryResult([], approximate=approximate, sample_rate=actual_rate(ctx) if approximate else None, stats={**ctx.stats, **ctx.governor.stats(), "aborted_by": e.kind}, aborted=True, message=str(e))
+    gov = ctx.governor
+    message = f"Results truncated: scanned row budget of {gov.budget.max_rows_scanned} reached" if gov.truncated else None
+    return QueryResult(rows, approximate=approximate, sample_rate=actual_rate(ctx) if approximate else None, stats={**ctx.stats, **gov.stats()}, truncated=gov.truncated, message=message)
+
+def actual_rate(ctx: ExecContext) -> float | None:
+    # at least one row per table (or time stratum) is kept, so small tables are sampled above the requested rate
+    total = ctx.stats.get("rows_total")
+    return ctx.stats.get("rows_sampled", 0) / total if total else ctx.sample
+
+# column -> str(value) -> rows with that value, in table order
+ColumnIndex = Dict[str, Dict[str, List[Dict[str, Any]]]]
+
+@lru_cache(maxsize=1024)
+def pipeline_plan(q: str) -> tuple[str, ...] | None:
+    """Stages of a query without let statements (table first), split once per
+    text; None for queries with lets, whose bindings hold per-run state."""
+    body, env = parse_lets(strip_comments(q).strip())
+    return None if env else tuple(split_top_level(body, "|"))
+
+def build_index(rows: List[Dict[str, Any]], column: str) -> Dict[str, List[Dict[str, Any]]]:
+    index: Dict[str, List[Dict[str, Any]]] = {}
+    for r in rows:
+        index.setdefault(str(r.get(column)), []).append(r)
+    return index
+
+def index_lookup(wheres: List[str], index: ColumnIndex) -> List[Dict[str, Any]] | None:
+    """Rows that can pass the where stages, from the first `column == literal`
+    term on an indexed column; None when no term can use an index."""
+    for w in wheres:
+        terms, has_or = where_terms(w)
+        for p in [] if has_or else terms:
+            m = EQUALS.fullmatch(p)
+            if m and m.group(1) in index:
+                return index[m.group(1)].get(literal(m, 2), [])
+    return None
+
+def execute_variants(q: str, base: Dict[str, List[Dict[str, Any]]], deltas: List[Dict[str, List[Dict[str, Any]]]], budget: QueryBudget | None = DEFAULT_BUDGET, now: datetime | None = None, indexes: Dict[str, ColumnIndex] | None = None) -> List[QueryResult]:
+    """Run q over several datasets that share their bulk: variant i is base plus
+    deltas[i] for each table. The leading where stages scan the base rows once
+    for every variant, and only each variant's delta rows are filtered
+    separately; the remaining stages then run per variant. Queries with let
+    statements, unions or a table outside base run once per variant.
+
+    indexes maps a base table to column indexes (build_index over its rows); a
+    leading `column == literal` term on an indexed column then scans only the
+    matching base rows."""
+    stages = pipeline_plan(q)
+    table = stages[0] if stages else ""
+    if stages is None or table not in base:
+        return [execute_query(q, budget=budget, tables={t: rows + d.get(t, []) for t, rows in base.items()}, now=now) for d in deltas]
+    lead = 0
+    while lead + 1 < len(stages) and stages[lead + 1].startswith("where"):
+        lead += 1
+    governor = Governor(budget)
+    results = []
+    try:
+        terms = [t for w in stages[1:lead + 1] for t in compile_where(w, governor, now)]
+        candidates = index_lookup(list(stages[1:lead + 1]), (indexes or {}).get(table, {}))
+        shared = filter_rows(governor.scan(base[table] if candidates is None else candidates), terms)
+        for d in deltas:
+            ctx = ExecContext(env={}, governor=governor, tables=base, now=now)
+            extra = filter_rows(governor.scan(d.get(table, [])), terms)
+            rows = run_stages(shared + extra, list(stages[lead + 1:]), ctx)
+            results.append(QueryResult(rows, stats={**ctx.stats, **governor.stats()}, truncated=governor.truncated))
+    except QueryAborted as e:
+        aborted = QueryResult([], stats={**governor.stats(), "aborted_by": e.kind}, aborted=True, message=str(e))
+        return results + [aborted] * (len(deltas) - len(results))
+    return results
+
+def run_pipeline(q: str, ctx: ExecContext) -> List[Dict[str, Any]]:
+    stages = split_top_level(q.strip(), "|")
     if not stages:
         return []
     table = stages[0]
-    if table not in BASE_CATALOG:
-        return []
-    rows = BASE_CATALOG[table]["sample_rows"]
-    if source == "dynamic" and schema_view is not None:
-        rows = schema_view.sample_rows
-    data = rows
-    for s in stages[1:]:
+    if re.match(r"union\b", table, flags=re.IGNORECASE):
+        data = scan_union(table, ctx)
+        raw = True
+    else:
+        data = scan_table(table, ctx)
+        if data is None:
+            return []
+        raw = table not in ctx.env or not ctx.env[table].aggregated
+    # only the first aggregation over sampled raw rows is scaled up
+    rate = ctx.sample if raw and ctx.sample is not None and ctx.sample < 1 else None
+    try:
+        return run_stages(data, stages[1:], ctx, rate)
+    finally:
+        # a scan the stages stopped pulling from (take, an abort) records the rows it produced now
+        if hasattr(data, "close"):
+            data.close()
+
+def run_stages(data: Iterable[Dict[str, Any]], stages: List[str], ctx: ExecContext, rate: float | None = None) -> List[Dict[str, Any]]:
+    for s in stages:
         if s.startswith("where"):
-            data = apply_where(data, s)
-        elif s.startswith("project"):
-            data = apply_project(data, s)
-        elif s.startswith("extend"):
-            data = apply_extend(data, s)
+            data = apply_where(data, s, ctx.governor, ctx.now)
+        elif s.startswith("project") or s.startswith("extend"):
+            rows = data if isinstance(data, list) else list(data)
+            data = (apply_project if s.startswith("project") else apply_extend)(rows, s)
+            if rate is not None and data is not rows:
+                # new rows stand for as many rows as the ones they were made from
+                data = [carry_weight(old, new) for old, new in zip(rows, data)]
         elif s.startswith("distinct"):
             data = apply_distinct(data, s)
+            rate = None
         elif s.startswith("summarize"):
-            data = apply_summarize(data, s)
+            data = apply_summarize(data, s, sample_rate=rate)
+            rate = None
         elif s.startswith("order by"):
             data = apply_orderby(data, s)
         elif s.startswith("take") or s.startswith("limit"):
             m = re.search(r"(take|limit)\s+(\d+)", s)
             n = int(m.group(2)) if m else 10
-            data = data[:n]
+            data = list(islice(data, n))
+            rate = None
         elif s.startswith("top"):
             data = apply_top(data, s)
+            rate = None
+        if isinstance(data, list):
+            ctx.governor.materialized(data)
+    if not isinstance(data, list):
+        data = list(data)
+        ctx.governor.materialized(data)
     return data
 
-def apply_where(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, Any]]:
-    expr = clause[len("where"):].strip()
-    parts = [p.strip() for p in re.split(r"\band\b", expr, flags=re.IGNORECASE)]
-
-    def time_threshold(p: str) -> tuple[str, datetime] | None:
-        m_ago = re.match(r"(TimeGenerated|Timestamp)\s*(>=|>)\s*ago\(([^)]+)\)", p, flags=re.IGNORECASE)
-        m_start = re.match(r"(TimeGenerated|Timestamp)\s*(>=|>)\s*startofday\(now\(\)\)", p, flags=re.IGNORECASE)
-        if m_ago:
-            unit_str = m_ago.group(3).strip()
-            n = int(re.match(r"(\d+)", unit_str).group(1)) if re.match(r"(\d+)", unit_str) else 24
-            if "d" in unit_str:
-                delta = timedelta(days=n)
-            elif "m" in unit_str:
-                delta = timedelta(minutes=n)
-            else:
-                delta = timedelta(hours=n)
-            th = datetime.now(timezone.utc) - delta
-            return (m_ago.group(1), th)
-        if m_start:
-            now = datetime.now(timezone.utc)
-            th = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
-            return (m_start.group(1), th)
+# a literal in double or single quotes, or a bare token
+LITERAL = r"""(?:"([^"]*)"|'([^']*)'|([^\s"']+))"""
+EQUALS = re.compile(r"([A-Za-z0-9_]+)\s*==\s*" + LITERAL)
+
+def literal(m: re.Match, first: int) -> str:
+    return next(g for g in m.groups()[first - 1:first + 2] if g is not None)
+
+def unquote(v: str) -> str:
+    v = v.strip()
+    return v[1:-1] if len(v) > 1 and v[0] == v[-1] and v[0] in "\"'" else v
+
+def where_term(p: str, governor: Governor, now_ns: int) -> Callable[[Dict[str, Any]], bool] | None:
+    """Row test for one 'and' term of a where clause, built once per clause.
+    Terms the engine does not model (a pattern must match the whole term)
+    return None and keep every row."""
+    m = EQUALS.fullmatch(p)
+    if m:
+        k, v = m.group(1), literal(m, 2)
+        return lambda r: str(r.get(k)) == v
+    m = re.fullmatch(r"([A-Za-z0-9_]+)\s*!=\s*" + LITERAL, p)
+    if m:
+        k, v = m.group(1), literal(m, 2)
+        return lambda r: str(r.get(k)) != v
+    m = re.fullmatch(r"([A-Za-z0-9_]+)\s+in\s*\(([^)]+)\)", p)
+    if m:
+        k, vals = m.group(1), {unquote(x) for x in m.group(2).split(",")}
+        return lambda r: str(r.get(k)) in vals
+    m = re.fullmatch(r'([A-Za-z0-9_]+)\s*=~\s*"([^"]+)"', p)
+    if m:
+        k, search = m.group(1), governor.regex(m.group(2))
+
+        def regex_match(r: Dict[str, Any]) -> bool:
+            try:
+                return bool(search(str(r.get(k))))
+            except TimeoutError:
+                raise QueryAborted("regex", "Regex evaluation timed out")
+        return regex_match
+    m = re.fullmatch(r"([A-Za-z0-9_]+)\s+contains\s+" + LITERAL, p)
+    if m:
+        k, sub = m.group(1), literal(m, 2).lower()
+        return lambda r: sub in str(r.get(k)).lower()
+    m_ago = re.fullmatch(r"(TimeGenerated|Timestamp)\s*(>=|>)\s*ago\(([^)]+)\)", p, flags=re.IGNORECASE)
+    m_start = re.fullmatch(r"(TimeGenerated|Timestamp)\s*(>=|>)\s*startofday\(now\(\)\)", p, flags=re.IGNORECASE)
+    if m_ago:
+        m_span = re.match(r"(\d+(?:\.\d+)?)\s*(ms|s|m|h|d)", m_ago.group(3).strip())
+        key, threshold = m_ago.group(1), now_ns - (timespan_ns(m_span.group(1), m_span.group(2)) if m_span else timespan_ns(24, "h"))
+    elif m_start:
+        key, threshold = m_start.group(1), bin_ns(now_ns, UNIT_NS["d"])
+    else:
         return None
 
-    def match(r: Dict[str, Any]) -> bool:
-        for p in parts:
-            m_eq = re.match(r'([A-Za-z0-9_]+)\s*==\s*"?([^"]+)"?', p)
-            m_neq = re.match(r'([A-Za-z0-9_]+)\s*!=\s*"?([^"]+)"?', p)
-            m_in = re.match(r'([A-Za-z0-9_]+)\s+in\s*\(([^)]+)\)', p)
-            m_regex = re.match(r'([A-Za-z0-9_]+)\s*=~\s*"([^"]+)"', p)
-            m_contains = re.match(r'([A-Za-z0-9_]+)\s+contains\s+"([^"]+)"', p)
-            m_id = re.match(r"EventID\s*==\s*(\d+)", p)
-            th = time_threshold(p)
-            if m_eq:
-                k = m_eq.group(1)
-                v = m_eq.group(2)
-                if str(r.get(k)) != v:
-                    return False
-            elif m_neq:
-                k = m_neq.group(1)
-                v = m_neq.group(2)
-                if str(r.get(k)) == v:
-                    return False
-            elif m_in:
-                k = m_in.group(1)
-                vals_raw = [x.strip() for x in m_in.group(2).split(',')]
-                vals = [v.strip('"') for v in vals_raw]
-                if str(r.get(k)) not in vals:
-                    return False
-            elif m_regex:
-                k = m_regex.group(1)
-                pattern = m_regex.group(2)
-                if not re.search(pattern, str(r.get(k)), re.IGNORECASE):
-                    return False
-            elif m_contains:
-                k = m_contains.group(1)
-                substr = m_contains.group(2)
-                if substr.lower() not in str(r.get(k)).lower():
-                    return False
-            elif m_id:
-                if int(r.get("EventID", -1)) != int(m_id.group(1)):
-                    return False
-            elif th:
-                key, tval = th
-                rv = r.get(key)
-                if rv is None:
-                    return False
-                if parse_iso(str(rv)) < tval:
-                    return False
-        return True
+    def after(r: Dict[str, Any]) -> bool:
+        ns = to_epoch_ns(r.get(key))
+        return ns is not None and ns >= threshold
+    return after
+
+# a string literal, a parenthesis or a bare and/or: what splitting a where clause needs to see
+CLAUSE_TOKENS = re.compile(r""""(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[()]|\b(?:and|or)\b""")
+
+def where_terms(clause: str) -> tuple[List[str], bool]:
+    """The top-level 'and' terms of a where clause, and whether it also has a
+    top-level 'or' (which binds looser, so the terms are then not a conjunction)."""
+    expr = clause[len("where"):]
+    terms, start, depth, has_or = [], 0, 0, False
+    for m in CLAUSE_TOKENS.finditer(expr):
+        t = m.group(0)
+        depth += {"(": 1, ")": -1}.get(t, 0)
+        if depth == 0 and t == "or":
+            has_or = True
+        elif depth == 0 and t == "and":
+            terms.append(expr[start:m.start()].strip())
+            start = m.end()
+    terms.append(expr[start:].strip())
+    return [t for t in terms if t], has_or
+
+def compile_where(clause: str, governor: Governor | None = None, now: datetime | None = None) -> List[Callable[[Dict[str, Any]], bool]]:
+    """Row tests for the 'and' terms of a where clause. Terms, thresholds and
+    regexes are resolved once per clause, not once per row. A clause with a
+    top-level 'or' is not modeled and keeps every row."""
+    terms, has_or = where_terms(clause)
+    if has_or:
+        return []
+    now_ns = datetime_to_ns(now or datetime.now(timezone.utc))
+    governor = governor or Governor()
+    return [t for t in (where_term(p, governor, now_ns) for p in terms) if t is not None]
+
+def filter_rows(rows: Iterable[Dict[str, Any]], terms: List[Callable[[Dict[str, Any]], bool]]) -> List[Dict[str, Any]]:
+    # one pass per term: each pass only sees the rows the earlier terms kept
+    for t in terms:
+        rows = [r for r in rows if t(r)]
+    return rows if isinstance(rows, list) else list(rows)
+
+def apply_where(rows: List[Dict[str, Any]], clause: str, governor: Governor | None = None, now: datetime | None = None) -> List[Dict[str, Any]]:
+    return filter_rows(rows, compile_where(clause, governor, now))
+
+# summarize forms apply_summarize computes, and the columns they output (KQL's names)
+COUNT_BY = re.compile(r"summarize\s+(?:([A-Za-z0-9_]+)\s*=\s*)?count\(\)\s+by\s+(?:([A-Za-z0-9_]+)|bin\(([A-Za-z0-9_]+)\s*,\s*\d+(?:\.\d+)?(?:ms|s|m|h|d)\))\s*")
+DCOUNT = re.compile(r"summarize\s+dcount\(([A-Za-z0-9_]+)\)(?:\s+by\s+([A-Za-z0-9_]+))?\s*")
+IDENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+# forms the other operators parse; anything more is skipped by the engine
+ORDER_BY = re.compile(r"order\s+by\s+([A-Za-z_][A-Za-z0-9_]*)(?:\s+(?:asc|desc))?\s*")
+TOP_BY = re.compile(r"top\s+\d+\s+by\s+([A-Za-z_][A-Za-z0-9_]*)(?:\s+(?:asc|desc))?\s*")
+TAKE = re.compile(r"(?:take|limit)\s+\d+\s*")
+EXTEND_TERM = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(?:"[^"]+"|([A-Za-z_][A-Za-z0-9_]*))')
+
+def where_supported(clause: str) -> bool:
+    terms, has_or = where_terms(clause)
+    # =~ is KQL's case-insensitive equality, which the engine runs as a regex search
+    if has_or or any("=~" in t for t in terms):
+        return False
+    try:
+        return all(where_term(t, Governor(None), 0) is not None for t in terms)
+    except QueryAborted:
+        return False
+
+def stage_columns(s: str, cols: List[str] | None) -> tuple[bool, List[str] | None]:
+    """Whether the engine runs stage s as KQL does, given the columns of its
+    input (None when unknown), and the columns it outputs. A column the input
+    does not have is an error in KQL, so such stages are not modeled either."""
+    def has(*names: str | None) -> bool:
+        return cols is None or all(n in cols for n in names if n)
+
+    if s.startswith("where"):
+        return where_supported(s), cols
+    if s.startswith("summarize"):
+        m = COUNT_BY.fullmatch(s)
+        if m:
+            by = m.group(2) or m.group(3)
+            return has(by), [by, m.group(1) or "count_"]
+        m = DCOUNT.fullmatch(s)
+        if m:
+            return has(m.group(1), m.group(2)), [c for c in (m.group(2), f"dcount_{m.group(1)}") if c]
+        return False, None
+    if s.startswith("project"):
+        names = [c.strip() for c in s[len("project"):].split(",")]
+        ok = not s.startswith("project-") and all(IDENT.fullmatch(c) for c in names) and has(*names)
+        return ok, names
+    if s.startswith("distinct"):
+        col = s[len("distinct"):].strip()
+        return IDENT.fullmatch(col) is not None and has(col), [col]
+    if s.startswith("extend"):
+        terms = [EXTEND_TERM.fullmatch(t.strip()) for t in s[len("extend"):].split(",")]
+        ok = all(terms) and has(*(m.group(2) for m in terms))
+        return ok, None if cols is None or not ok else cols + [m.group(1) for m in terms if m.group(1) not in cols]
+    for form in (ORDER_BY, TOP_BY):
+        m = form.fullmatch(s)
+        if m:
+            return has(m.group(1)), cols
+    return TAKE.fullmatch(s) is not None, cols
+
+def pipeline_columns(expr: str, known: Dict[str, List[str] | None], out: List[str] | None = None) -> List[str] | None:
+    """Columns expr outputs (None when unknown), with known holding the columns
+    of tabular lets; stages the engine does not model are appended to out."""
+    stages = split_top_level(expr, "|")
+    head = stages[0] if stages else ""
 
-    return [r for r in rows if match(r)]
+    def source(name: str) -> List[str] | None:
+        return known[name] if name in known else (table_columns(name) or None)
+
+    m = re.match(r"union\s+(?:withsource\s*=\s*([A-Za-z0-9_]+)\s+)?(.+)$", head, flags=re.IGNORECASE | re.DOTALL)
+    if m:
+        branches = [pipeline_columns(b[1:-1], known, out) if b.startswith("(") and b.endswith(")") else source(b)
+                    for b in split_top_level(m.group(2), ",")]
+        cols = None if any(b is None for b in branches) else list(dict.fromkeys(
+            ([m.group(1)] if m.group(1) else []) + [c for b in branches for c in b]))
+    else:
+        cols = source(head)
+    for s in stages[1:]:
+        ok, cols = stage_columns(s, cols)
+        if not ok and out is not None:
+            out.append(s)
+    return cols
+
+def unsupported_stages(q: str) -> List[str]:
+    """Stages of q (and of its tabular lets and union subqueries) that this
+    engine would skip, only partly apply, or apply to a column KQL would not
+    have, so results computed here would not be KQL's."""
+    body, env = parse_lets(strip_comments(q).strip())
+    out: List[str] = []
+    known: Dict[str, List[str] | None] = {}
+    for name, binding in env.items():
+        known[name] = pipeline_columns(binding.expr, known, out)
+    pipeline_columns(body, known, out)
+    return out
 
 def apply_project(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, Any]]:
     cols = [c.strip() for c in clause[len("project"):].split(",") if c.strip()]
@@ -152,13 +750,62 @@ def apply_distinct(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, An
             out.append({col: v})
     return out
 
-def apply_summarize(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, Any]]:
+def scale_count(c: int, rate: float) -> tuple[int, int, int]:
+    # Horvitz-Thompson estimate with a normal 95% interval for a Bernoulli sample
+    est = c / rate
+    half = 1.96 * math.sqrt(c * (1 - rate)) / rate
+    return round(est), max(c, math.floor(est - half)), math.ceil(est + half)
+
+def estimate_dcount(freq: Counter, rate: float) -> tuple[int, int, int]:
+    # GEE estimator (Charikar et al.): values seen once in the sample stand for
+    # sqrt(1/rate) distinct values; the bounds are the sample count and 1/rate per singleton
+    f1 = sum(1 for v in freq.values() if v == 1)
+    rest = len(freq) - f1
+    return round(math.sqrt(1 / rate) * f1 + rest), len(freq), math.ceil(f1 / rate + rest)
+
+def group_rate(weight: Callable[[Dict[str, Any]], float] | None, mass: Dict[Any, float], key: Any, count: int) -> float | None:
+    # rows sampled in a group over the rows they stand for
+    return None if weight is None else count / mass[key]
+
+def agg_cols(alias: str, value: int, rate: float | None, freq: Counter | None = None) -> Dict[str, Any]:
+    if rate is None:
+        return {alias: value}
+    est, lo, hi = estimate_dcount(freq, rate) if freq is not None else scale_count(value, rate)
+    return {alias: est, f"{alias}_low": lo, f"{alias}_high": hi}
+
+def apply_summarize(rows: List[Dict[str, Any]], clause: str, sample_rate: float | None = None) -> List[Dict[str, Any]]:
+    """sample_rate marks rows as sampled; each then counts for its SampledRow
+    weight (1 / sample_rate for other rows) in the scaled estimates."""
     m_count_alias = re.match(r"summarize\s+([A-Za-z0-9_]+)\s*=\s*count\(\)\s+by\s+([A-Za-z0-9_]+)", clause)
     m_count_by = re.match(r"summarize\s+count\(\)\s+by\s+([A-Za-z0-9_]+)", clause)
     m_dcount_by = re.match(r"summarize\s+dcount\(([A-Za-z0-9_]+)\)\s+by\s+([A-Za-z0-9_]+)", clause)
     m_dcount = re.match(r"summarize\s+dcount\(([A-Za-z0-9_]+)\)", clause)
-    m_count_by_bin = re.match(r"summarize\s+count\(\)\s+by\s+bin\(([A-Za-z0-9_]+)\s*,\s*(\d+)([smhd])\)", clause)
-    m_count_alias_by_bin = re.match(r"summarize\s+([A-Za-z0-9_]+)\s*=\s*count\(\)\s+by\s+bin\(([A-Za-z0-9_]+)\s*,\s*(\d+)([smhd])\)", clause)
+    m_count_by_bin = re.match(r"summarize\s+count\(\)\s+by\s+bin\(([A-Za-z0-9_]+)\s*,\s*(\d+(?:\.\d+)?)(ms|s|m|h|d)\)", clause)
+    m_count_alias_by_bin = re.match(r"summarize\s+([A-Za-z0-9_]+)\s*=\s*count\(\)\s+by\s+bin\(([A-Za-z0-9_]+)\s*,\s*(\d+(?:\.\d+)?)(ms|s|m|h|d)\)", clause)
+    weight = None if sample_rate is None else (lambda r: r.weight if isinstance(r, SampledRow) else 1 / sample_rate)
+    mass: Dict[Any, float] = {}
+    # bin() must be checked before the plain 'by col' forms, which would match 'bin' as a column
+    if m_count_by_bin or m_count_alias_by_bin:
+        if m_count_by_bin:
+            col = m_count_by_bin.group(1)
+            n = m_count_by_bin.group(2)
+            unit = m_count_by_bin.group(3)
+            alias = "count_"
+        else:
+            alias = m_count_alias_by_bin.group(1)
+            col = m_count_alias_by_bin.group(2)
+            n = m_count_alias_by_bin.group(3)
+            unit = m_count_alias_by_bin.group(4)
+        size = timespan_ns(n, unit)
+        groups = {}
+        for r in rows:
+            ns = to_epoch_ns(r.get(col))
+            key = bin_ns(ns, size) if ns is not None else None
+            groups[key] = groups.get(key, 0) + 1
+            if weight:
+                mass[key] = mass.get(key, 0) + weight(r)
+        # bins stay integers while grouping and are formatted only for output
+        return [{col: format_ns(k), **agg_cols(alias, v, group_rate(weight, mass, k, v))} for k, v in groups.items()]
     # alias for count()
     if m_count_alias:
         alias = m_count_alias.group(1)
@@ -167,45 +814,35 @@ def apply_summarize(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, A
         for r in rows:
             k = r.get(col)
             groups[k] = groups.get(k, 0) + 1
-        return [{col: k, alias: v} for k, v in groups.items()]
+            if weight:
+                mass[k] = mass.get(k, 0) + weight(r)
+        return [{col: k, **agg_cols(alias, v, group_rate(weight, mass, k, v))} for k, v in groups.items()]
     if m_count_by:
         col = m_count_by.group(1)
         groups = {}
         for r in rows:
             k = r.get(col)
             groups[k] = groups.get(k, 0) + 1
-        return [{col: k, "count": v} for k, v in groups.items()]
-    if m_count_by_bin or m_count_alias_by_bin:
-        if m_count_by_bin:
-            col = m_count_by_bin.group(1)
-            n = int(m_count_by_bin.group(2))
-            unit = m_count_by_bin.group(3)
-            alias = "count"
-        else:
-            alias = m_count_alias_by_bin.group(1)
-            col = m_count_alias_by_bin.group(2)
-            n = int(m_count_alias_by_bin.group(3))
-            unit = m_count_alias_by_bin.group(4)
-        groups = {}
-        for r in rows:
-            dt = parse_iso(str(r.get(col)))
-            key = floor_time(dt, n, unit)
-            groups[key] = groups.get(key, 0) + 1
-        return [{col: k.isoformat(), alias: v} for k, v in groups.items()]
+            if weight:
+                mass[k] = mass.get(k, 0) + weight(r)
+        return [{col: k, **agg_cols("count_", v, group_rate(weight, mass, k, v))} for k, v in groups.items()]
     if m_dcount_by:
         val_col = m_dcount_by.group(1)
         by_col = m_dcount_by.group(2)
         groups = {}
         for r in rows:
             k = r.get(by_col)
-            groups.setdefault(k, set()).add(r.get(val_col))
-        return [{by_col: k, f"dcount_{val_col}": len(v)} for k, v in groups.items()]
+            groups.setdefault(k, Counter())[r.get(val_col)] += 1
+            if weight:
+                mass[k] = mass.get(k, 0) + weight(r)
+        return [{by_col: k, **agg_cols(f"dcount_{val_col}", len(v), group_rate(weight, mass, k, v.total()), v)} for k, v in groups.items()]
     if m_dcount:
         col = m_dcount.group(1)
-        vals = set()
-        for r in rows:
-            vals.add(r.get(col))
-        return [{f"dcount_{col}": len(vals)}]
+        rows = rows if isinstance(rows, list) else list(rows)
+        vals = Counter(r.get(col) for r in rows)
+        if weight:
+            mass[None] = sum(weight(r) for r in rows)
+        return [agg_cols(f"dcount_{col}", len(vals), group_rate(weight, mass, None, len(rows)) if rows else sample_rate, vals)]
     return rows
 
 def apply_top(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, Any]]:
@@ -215,6 +852,7 @@ def apply_top(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, Any]]:
     n = int(m.group(1))
     by = m.group(2)
     direction = (m.group(3) or "desc").lower()
+    rows = rows if isinstance(rows, list) else list(rows)
     try:
         sorted_rows = sorted(rows, key=lambda r: r.get(by), reverse=(direction == "desc"))
     except Exception:
@@ -227,6 +865,7 @@ def apply_orderby(rows: List[Dict[str, Any]], clause: str) -> List[Dict[str, Any
         return rows
     by = m.group(1)
     direction = (m.group(2) or "asc").lower()
+    rows = rows if isinstance(rows, list) else list(rows)
     try:
         return sorted(rows, key=lambda r: r.get(by), reverse=(direction == "desc"))
     except Exception:
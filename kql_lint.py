@@ -0,0 +1,279 @@
+"""Rule registry and batch linter for the query checks in kql_rules.
+
+A Rule fires on a regex over the query's token text (`pattern`), an AST
+predicate over its QueryAnalysis (`check`), or both, and may carry an auto-fix.
+Patterns are compiled once at registration; all enabled pattern rules of a group
+are merged into one alternation, so a query is scanned once per pass rather
+than once per rule. Rules can be switched off with RULES.disable(id) or
+KQLTUTOR_DISABLED_RULES=id,id.
+
+Lint a cohort's submissions (one JSON object with "query", and optionally
+"task" and "suggested_table", per line):
+
+    python kql_lint.py submissions.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Iterable
+from kql_parse import QueryAnalysis, as_analysis
+
+SEVERITIES = ("error", "hint", "optimization", "fix", "requirement")
+
+# Messages and requirement labels are plain strings or built from the query and context
+Text = str | Callable[[QueryAnalysis, dict], str]
+
+@dataclass(frozen=True)
+class Rule:
+    id: str
+    group: str      # "lint" (analyze_kql), "fix" (fix_query) or "task" (assess_task)
+    severity: str
+    message: Text
+    pattern: str | None = None      # regex over scan_text(); no named groups
+    negate: bool = False            # pattern rules fire when the pattern does not occur
+    check: Callable[[QueryAnalysis, dict], bool] | None = None
+    applies: Callable[[QueryAnalysis, dict], bool] | None = None  # rules that do not apply are not reported at all
+    fix: Callable[[QueryAnalysis, dict], str] | None = None
+    requirement: Text | None = None  # task rules: label in the assess_task checks list
+    decisive: bool | Callable[[QueryAnalysis, dict], bool] = False
+
+@dataclass(frozen=True)
+class Finding:
+    rule: str
+    severity: str
+    message: str
+    fixable: bool = False
+
+@dataclass
+class LintReport:
+    findings: list[list[Finding]]   # per input query, in input order
+    hits: dict[str, int]            # rule id -> queries it fired on
+    seconds: dict[str, float]       # rule id -> time in its predicates; "scan:<group>" for the combined regex passes
+    queries: int = 0
+    unique: int = 0
+    elapsed: float = 0.0
+    severities: dict[str, str] = field(default_factory=dict)
+
+    def summary(self) -> list[dict]:
+        rows = [{"rule": rule, "severity": self.severities.get(rule, ""), "hits": self.hits.get(rule, 0),
+                 "rate": round(self.hits.get(rule, 0) / self.queries, 4) if self.queries else 0.0,
+                 "ms": round(self.seconds.get(rule, 0.0) * 1000, 3)}
+                for rule in self.seconds]
+        return sorted(rows, key=lambda r: (-r["hits"], r["rule"]))
+
+    def to_dict(self) -> dict:
+        return {"queries": self.queries, "unique": self.unique, "elapsed_s": round(self.elapsed, 4), "rules": self.summary()}
+
+@lru_cache(maxsize=4096)
+def scan_text(q: str) -> str:
+    """Tokens joined by single spaces, with string literals blanked and comments
+    dropped, so patterns need no \\s* noise and never match inside strings."""
+    return " ".join('""' if t.kind == "string" else t.text for t in as_analysis(q).tokens)
+
+def render(text: Text | None, a: QueryAnalysis, context: dict) -> str:
+    if text is None:
+        return ""
+    return text(a, context) if callable(text) else text
+
+def is_decisive(rule: Rule, a: QueryAnalysis, context: dict) -> bool:
+    return rule.decisive(a, context) if callable(rule.decisive) else rule.decisive
+
+class RuleRegistry:
+    def __init__(self):
+        self._rules: dict[str, Rule] = {}
+        self._compiled: dict[str, re.Pattern] = {}
+        self._disabled = {r.strip() for r in os.getenv("KQLTUTOR_DISABLED_RULES", "").split(",") if r.strip()}
+        self._scanners: dict[tuple[str, ...], re.Pattern] = {}
+        self._lock = threading.Lock()
+
+    def add(self, rule: Rule) -> Rule:
+        if rule.id in self._rules:
+            raise ValueError(f"Duplicate rule id: {rule.id}")
+        if rule.severity not in SEVERITIES:
+            raise ValueError(f"Unknown severity for {rule.id}: {rule.severity}")
+        if rule.pattern is None and rule.check is None:
+            raise ValueError(f"Rule {rule.id} needs a pattern or a check")
+        with self._lock:
+            if rule.pattern is not None:
+                self._compiled[rule.id] = re.compile(rule.pattern)
+            self._rules[rule.id] = rule
+            self._scanners.clear()
+        return rule
+
+    def get(self, rule_id: str) -> Rule:
+        try:
+            return self._rules[rule_id]
+        except KeyError:
+            raise KeyError(f"Unknown rule: {rule_id}") from None
+
+    def enable(self, rule_id: str) -> None:
+        self.get(rule_id)
+        with self._lock:
+            self._disabled.discard(rule_id)
+            self._scanners.clear()
+
+    def disable(self, rule_id: str) -> None:
+        self.get(rule_id)
+        with self._lock:
+            self._disabled.add(rule_id)
+            self._scanners.clear()
+
+    def enabled(self, rule_id: str) -> bool:
+        return rule_id not in self._disabled
+
+    def rules(self, group: str | None = None, include_disabled: bool = False) -> list[Rule]:
+        return [r for r in self._rules.values()
+                if (group is None or r.group == group) and (include_disabled or r.id not in self._disabled)]
+
+    def _scanner(self, ids: tuple[str, ...]) -> re.Pattern:
+        scanner = self._scanners.get(ids)
+        if scanner is None:
+            # Group names must be identifiers, so alternatives are named by position
+            scanner = re.compile("|".join(f"(?P<r{i}>{self._rules[rule_id].pattern})" for i, rule_id in enumerate(ids)))
+            with self._lock:
+                if len(self._scanners) > 256:
+                    self._scanners.clear()
+                self._scanners[ids] = scanner
+        return scanner
+
+    def _scan(self, text: str, ids: tuple[str, ...]) -> set[str]:
+        """Ids of the pattern rules whose pattern occurs in text. Each pass runs one
+        combined alternation; a match reports only the first alternative that
+        matched at its position, so rules found are dropped and the rest rescanned
+        until a pass finds nothing new (at most hits + 1 passes)."""
+        found = set()
+        while ids:
+            new = {ids[int(m.lastgroup[1:])] for m in self._scanner(ids).finditer(text)}
+            if not new:
+                break
+            found |= new
+            ids = tuple(i for i in ids if i not in new)
+        return found
+
+    def _fires(self, rule: Rule, a: QueryAnalysis, context: dict, matched: set[str] | None = None) -> bool:
+        if rule.pattern is not None:
+            hit = rule.id in matched if matched is not None else bool(self._compiled[rule.id].search(scan_text(a.text)))
+            if hit == rule.negate:
+                return False
+        return rule.check is None or bool(rule.check(a, context))
+
+    def evaluate(self, q: "str | QueryAnalysis", group: str, context: dict | None = None,
+                 timings: dict | None = None) -> list[tuple[Rule, bool]]:
+        """(rule, fired) for every enabled rule of group that applies to this query."""
+        a = as_analysis(q)
+        context = context or {}
+        rules = self.rules(group)
+        clock = time.perf_counter
+        t0 = clock()
+        patterned = tuple(r.id for r in rules if r.pattern is not None)
+        matched = self._scan(scan_text(a.text), patterned) if patterned else set()
+        if timings is not None:
+            timings["scan:" + group] += clock() - t0
+        results = []
+        for r in rules:
+            t0 = clock()
+            if r.applies is None or r.applies(a, context):
+                results.append((r, self._fires(r, a, context, matched)))
+            if timings is not None:
+                timings[r.id] += clock() - t0
+        return results
+
+    def lint(self, q: "str | QueryAnalysis", group: str = "lint", context: dict | None = None,
+             timings: dict | None = None) -> list[Finding]:
+        a = as_analysis(q)
+        context = context or {}
+        return [Finding(r.id, r.severity, render(r.message, a, context), r.fix is not None)
+                for r, fired in self.evaluate(a, group, context, timings) if fired]
+
+    def apply_fixes(self, q: "str | QueryAnalysis", group: str = "fix", context: dict | None = None) -> tuple[str, list[Finding]]:
+        """Run the auto-fix of each firing rule in registration order; each rule
+        sees the query as rewritten by the rules before it."""
+        a = as_analysis(q)
+        context = context or {}
+        x = a.text.strip()
+        applied = []
+        for r in self.rules(group):
+            if r.fix is None or (r.applies is not None and not r.applies(a, context)) or not self._fires(r, a, context):
+                continue
+            applied.append(Finding(r.id, r.severity, render(r.message, a, context), True))
+            x = r.fix(a, context)
+            a = as_analysis(x)
+        return x, applied
+
+    def lint_batch(self, queries: Iterable["str | dict"], group: str = "lint", context: dict | None = None) -> LintReport:
+        """Lint many queries in one call. Items are query strings or dicts with a
+        "query" key plus per-item context (task, suggested_table) that overrides
+        context. Repeated (query, context) pairs are linted once."""
+        start = time.perf_counter()
+        timings: dict[str, float] = defaultdict(float)
+        for r in self.rules(group):
+            timings[r.id] += 0.0
+        hits: Counter = Counter()
+        seen: dict[tuple, list[Finding]] = {}
+        findings = []
+        for item in queries:
+            if isinstance(item, dict):
+                ctx = {**(context or {}), **{k: v for k, v in item.items() if k != "query"}}
+                q = str(item.get("query") or "")
+            else:
+                ctx, q = context or {}, item or ""
+            key = (q, json.dumps(ctx, sort_keys=True, default=str)) if ctx else (q, "")
+            result = seen.get(key)
+            if result is None:
+                result = seen[key] = self.lint(q, group, ctx, timings)
+            hits.update(f.rule for f in result)
+            findings.append(result)
+        return LintReport(findings=findings, hits=dict(hits), seconds=dict(timings), queries=len(findings),
+                          unique=len(seen), elapsed=time.perf_counter() - start,
+                          severities={r.id: r.severity for r in self.rules(group)})
+
+RULES = RuleRegistry()
+
+def read_queries(path: str) -> Iterable["str | dict"]:
+    """JSONL objects with a "query" key; lines that are not JSON are taken as raw queries."""
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                yield line.rstrip("\n")
+                continue
+            yield item if isinstance(item, dict) else str(item)
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Lint a corpus of KQL submissions")
+    ap.add_argument("path", help="JSONL file of submissions, or - for stdin")
+    ap.add_argument("--group", default="lint", choices=["lint", "fix", "task"])
+    ap.add_argument("--disable", default="", help="comma-separated rule ids to skip")
+    ap.add_argument("--findings", action="store_true", help="print each query's findings as JSONL")
+    ap.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = ap.parse_args()
+
+    # Run as a script this module is __main__; the registry with the built-in rules is kql_lint.RULES
+    from kql_rules import RULES as registry
+
+    for rule_id in filter(None, (r.strip() for r in args.disable.split(","))):
+        registry.disable(rule_id)
+    report = registry.lint_batch(read_queries(args.path), group=args.group)
+    if args.findings:
+        for i, found in enumerate(report.findings):
+            print(json.dumps({"index": i, "findings": [f.__dict__ for f in found]}))
+    if args.json:
+        print(json.dumps(report.to_dict(), indent=2))
+        return
+    print(f"{report.queries} queries ({report.unique} unique) in {report.elapsed:.3f}s")
+    print(f"  {'rule':<28} {'severity':<13} {'hits':>7} {'rate':>7} {'ms':>9}")
+    for row in report.summary():
+        print(f"  {row['rule']:<28} {row['severity']:<13} {row['hits']:>7} {row['rate']:>7.1%} {row['ms']:>9.3f}")
+
+if __name__ == "__main__":
+    main()
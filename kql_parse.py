@@ -0,0 +1,320 @@
+import re
+from bisect import bisect_left
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable
+
+# One alternation, scanned once: comments and string literals are recognised
+# before pipes, so '|' or '//' inside "..." never split a stage or start a comment
+TOKEN_RE = re.compile(r"""
+ (?P<comment>//[^\n]*)
+|(?P<string>@"[^"]*"?|@'[^']*'?|"(?:\\.|[^"\\\n])*"?|'(?:\\.|[^'\\\n])*'?)
+|(?P<space>\s+)
+|(?P<timespan>\d+(?:\.\d+)?(?:ms|s|m|h|d)\b)
+|(?P<number>\d+(?:\.\d+)?)
+|(?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+|(?P<op>==|!=|=~|!~|>=|<=|=|<|>|\+|-|\*|/|%|!)
+|(?P<pipe>\|)
+|(?P<semicolon>;)
+|(?P<lparen>[(\[{])
+|(?P<rparen>[)\]}])
+|(?P<comma>,)
+|(?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+COMPARISONS = {"==", "!=", "=~", "!~", ">=", "<=", ">", "<"}
+WORD_OPS = {"in", "has", "contains", "startswith", "endswith", "between", "matches", "has_any", "has_all", "hasprefix", "hassuffix", "contains_cs", "has_cs", "like"}
+TIME_COLUMNS = {"timegenerated", "timestamp"}
+KEYWORDS = {
+    "and", "or", "not", "by", "asc", "desc", "nulls", "first", "last", "true", "false", "with", "on", "kind", "let",
+    "inner", "leftouter", "rightouter", "fullouter", "leftanti", "rightanti", "leftsemi", "rightsemi", "innerunique",
+    "datetime", "timespan", "dynamic", "null", "to", "step", "from", "of", "typeof", "bool", "int", "long", "real",
+    "string", "double", "decimal", "guid", "regex", "where", "project", "summarize", "extend", "distinct", "top",
+    "take", "limit", "order", "sort", "count", "union", "join", "render", "parse", "mv", "expand", "away", "rename",
+    "reorder", "lookup", "as", "invoke", "evaluate", "sample", "search", "getschema", "serialize", "range", "print",
+} | WORD_OPS
+HYPHEN_SUFFIXES = {"expand", "away", "keep", "rename", "reorder", "apply", "kv", "series", "where"}
+
+@dataclass(frozen=True)
+class Token:
+    kind: str
+    text: str
+    start: int
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.text)
+
+@dataclass(frozen=True)
+class Stage:
+    operator: str   # lower-case operator ("where", "summarize", "order", "mv-expand", ...); the table name for the first stage
+    text: str       # stage text without comments
+    tokens: tuple[Token, ...]
+
+@dataclass(frozen=True)
+class Predicate:
+    column: str
+    op: str
+    value: str
+
+@dataclass(frozen=True)
+class Aggregation:
+    alias: str | None
+    function: str
+    args: str
+
+@dataclass(frozen=True)
+class QueryAnalysis:
+    text: str
+    code: str                       # text with comments removed
+    tokens: tuple[Token, ...]       # without whitespace and comments
+    lets: tuple[str, ...]           # statements before the query body
+    stages: tuple[Stage, ...]       # body split on top-level pipes
+    empty_stages: int               # from '||' or a dangling pipe
+    pipes: int
+    table: str | None
+    predicates: tuple[Predicate, ...]
+    time_filters: tuple[Predicate, ...]
+    aggregations: tuple[Aggregation, ...]
+    group_by: tuple[str, ...]
+    columns: frozenset[str]
+
+    @property
+    def operators(self) -> tuple[str, ...]:
+        return tuple(s.operator for s in self.stages[1:])
+
+    def has(self, operator: str) -> bool:
+        return operator in self.operators
+
+    def stage_index(self, operator: str) -> int | None:
+        return next((i for i, s in enumerate(self.stages) if i and s.operator == operator), None)
+
+    def stages_of(self, operator: str) -> list[Stage]:
+        return [s for s in self.stages[1:] if s.operator == operator]
+
+    def values(self, column: str, op: str = "==") -> list[str]:
+        return [p.value for p in self.predicates if p.column.lower() == column.lower() and p.op == op]
+
+    def references(self, column: str) -> bool:
+        return column.lower() in {c.lower() for c in self.columns}
+
+    def with_stages(self, stages: list[str]) -> str:
+        """Query text with the body replaced by stages (let statements kept)."""
+        body = " | ".join(s.strip() for s in stages if s.strip())
+        return "; ".join(list(self.lets) + [body]) if self.lets else body
+
+def tokenize(q: str) -> list[Token]:
+    return [Token(m.lastgroup, m.group(), m.start()) for m in TOKEN_RE.finditer(q or "")]
+
+def split_tokens(tokens: list[Token], kind: str) -> list[list[Token]]:
+    """Split at depth-0 tokens of kind (pipe, semicolon, comma)."""
+    parts, cur, depth = [], [], 0
+    for t in tokens:
+        if t.kind == "lparen":
+            depth += 1
+        elif t.kind == "rparen":
+            depth = max(0, depth - 1)
+        elif t.kind == kind and depth == 0:
+            parts.append(cur)
+            cur = []
+            continue
+        cur.append(t)
+    parts.append(cur)
+    return parts
+
+def text_of(tokens: list[Token]) -> str:
+    return "".join(t.text for t in tokens).strip()
+
+def significant(tokens: list[Token]) -> list[Token]:
+    return [t for t in tokens if t.kind not in ("space", "comment")]
+
+def stage_operator(sig: list[Token]) -> str:
+    if not sig:
+        return ""
+    head = sig[0].text.lower()
+    # hyphenated operators: mv-expand, project-away, ...
+    if len(sig) > 2 and sig[1].text == "-" and sig[2].kind == "ident" and sig[1].start == sig[0].end:
+        return head + "-" + sig[2].text.lower()
+    return head
+
+def parse_predicates(sig: list[Token], span: Callable[[list[Token]], str]) -> list[Predicate]:
+    preds = []
+    groups, cur, depth = [], [], 0
+    for t in sig:
+        if t.kind == "lparen":
+            depth += 1
+        elif t.kind == "rparen":
+            depth = max(0, depth - 1)
+        elif depth == 0 and t.kind == "ident" and t.text.lower() in ("and", "or"):
+            groups.append(cur)
+            cur = []
+            continue
+        cur.append(t)
+    groups.append(cur)
+    for g in groups:
+        # Parenthesised sub-conditions are parsed on their own
+        if g and g[0].kind == "lparen" and g[-1].kind == "rparen":
+            preds.extend(parse_predicates(g[1:-1], span))
+            continue
+        depth = 0
+        for i, t in enumerate(g):
+            if t.kind == "lparen":
+                depth += 1
+            elif t.kind == "rparen":
+                depth -= 1
+            if depth:
+                continue
+            op = None
+            if t.kind == "op" and t.text in COMPARISONS:
+                op, j = t.text, i + 1
+            elif t.kind == "ident" and t.text.lower() in WORD_OPS and i:
+                op, j = t.text.lower(), i + 1
+                if g[i - 1].text == "!" and i > 1:
+                    op = "!" + op
+                    i -= 1
+            if op is None:
+                continue
+            lhs, rhs = g[:i], g[j:]
+            if op == "matches" and rhs and rhs[0].text.lower() == "regex":
+                op, rhs = "matches regex", rhs[1:]
+            if len(lhs) == 1 and lhs[0].kind == "ident":
+                preds.append(Predicate(lhs[0].text, op, span(rhs)))
+            elif len(rhs) == 1 and rhs[0].kind == "ident" and op in COMPARISONS:
+                flipped = {">": "<", "<": ">", ">=": "<=", "<=": ">="}.get(op, op)
+                preds.append(Predicate(rhs[0].text, flipped, span(lhs)))
+            break
+    return preds
+
+def parse_summarize(sig: list[Token], span: Callable[[list[Token]], str]) -> tuple[list[Aggregation], list[str], set[str]]:
+    body = sig[1:]
+    by_at = None
+    depth = 0
+    for i, t in enumerate(body):
+        if t.kind == "lparen":
+            depth += 1
+        elif t.kind == "rparen":
+            depth -= 1
+        elif depth == 0 and t.kind == "ident" and t.text.lower() == "by":
+            by_at = i
+            break
+    aggs, aliases = [], set()
+    for item in split_tokens(body[:by_at] if by_at is not None else body, "comma"):
+        if not item:
+            continue
+        alias = None
+        if len(item) > 2 and item[0].kind == "ident" and item[1].text == "=":
+            alias = item[0].text
+            aliases.add(alias)
+            item = item[2:]
+        if item and item[0].kind == "ident" and len(item) > 1 and item[1].kind == "lparen":
+            aggs.append(Aggregation(alias, item[0].text.lower(), span(item[2:-1])))
+    group_by = [span(item) for item in split_tokens(body[by_at + 1:], "comma")] if by_at is not None else []
+    return aggs, [g for g in group_by if g], aliases
+
+@lru_cache(maxsize=4096)
+def analyze_query(q: str) -> QueryAnalysis:
+    """Tokenize and parse q once; the result is immutable and memoized per text."""
+    q = q or ""
+    raw = tokenize(q)
+    kept = [t for t in raw if t.kind != "comment"]
+    code = "".join(t.text for t in kept)
+    starts = [t.start for t in kept]
+
+    def span(tokens: list[Token]) -> str:
+        # source text covering tokens, without comments
+        if not tokens:
+            return ""
+        lo, hi = bisect_left(starts, tokens[0].start), bisect_left(starts, tokens[-1].start)
+        return "".join(t.text for t in kept[lo:hi + 1]).strip()
+
+    statements = [s for s in split_tokens(kept, "semicolon") if significant(s)]
+    body = statements[-1] if statements else []
+    lets = tuple(text_of(s) for s in statements[:-1])
+    pieces = split_tokens(body, "pipe")
+    pipes = len(pieces) - 1
+    stages, empty = [], 0
+    for piece in pieces:
+        sig = significant(piece)
+        if not sig:
+            empty += 1
+            continue
+        stages.append(Stage(stage_operator(sig), text_of(piece), tuple(sig)))
+    table = None
+    if stages and len(stages[0].tokens) == 1 and stages[0].tokens[0].kind == "ident":
+        table = stages[0].tokens[0].text
+    predicates, aggregations, group_by, aliases = [], [], [], set()
+    # Filters inside tabular let statements count too
+    for st in statements[:-1]:
+        sig = significant(st)
+        if len(sig) > 3 and sig[0].text == "let" and sig[2].text == "=":
+            for piece in split_tokens(sig[3:], "pipe")[1:]:
+                if piece and stage_operator(piece) == "where":
+                    predicates.extend(parse_predicates(piece[1:], span))
+    for s in stages[1 if table else 0:]:
+        if s.operator == "where":
+            predicates.extend(parse_predicates(list(s.tokens[1:]), span))
+        elif s.operator == "summarize":
+            aggs, by, names = parse_summarize(list(s.tokens), span)
+            aggregations.extend(aggs)
+            group_by.extend(by)
+            aliases |= names
+    # let names and the tables their expressions read are not columns
+    let_names = set()
+    for st in statements[:-1]:
+        sig = significant(st)
+        if len(sig) > 3 and sig[0].text == "let" and sig[1].kind == "ident" and sig[2].text == "=":
+            let_names.add(sig[1].text)
+            head = significant(split_tokens(sig[3:], "pipe")[0])
+            if len(head) == 1 and head[0].kind == "ident":
+                let_names.add(head[0].text)
+    sig_all = significant([t for s in statements for t in s])
+    columns = set()
+    for i, t in enumerate(sig_all):
+        if t.kind != "ident" or t.text.lower() in KEYWORDS or t.text in let_names or t.text == table or t.text in aliases:
+            continue
+        if i + 1 < len(sig_all) and sig_all[i + 1].kind == "lparen":
+            continue  # function call
+        if t.text.lower() in HYPHEN_SUFFIXES and i > 1 and sig_all[i - 1].text == "-" and sig_all[i - 1].end == t.start:
+            continue  # second half of a hyphenated operator
+        columns.add(t.text)
+    time_filters = [p for p in predicates if p.column.lower() in TIME_COLUMNS and p.op in (">", ">=", "between")]
+    return QueryAnalysis(
+        text=q,
+        code=code,
+        tokens=tuple(sig_all),
+        lets=lets,
+        stages=tuple(stages),
+        empty_stages=empty,
+        pipes=pipes,
+        table=table,
+        predicates=tuple(predicates),
+        time_filters=tuple(time_filters),
+        aggregations=tuple(aggregations),
+        group_by=tuple(group_by),
+        columns=frozenset(columns),
+    )
+
+def as_analysis(q: "str | QueryAnalysis") -> QueryAnalysis:
+    return q if isinstance(q, QueryAnalysis) else analyze_query(q or "")
+
+def strip_comments(q: str) -> str:
+    return analyze_query(q).code
+
+def identifiers(text: str) -> list[str]:
+    """Column-like identifiers in an expression (no keywords or function names)."""
+    sig = significant(tokenize(text))
+    return [t.text for i, t in enumerate(sig)
+            if t.kind == "ident" and t.text.lower() not in KEYWORDS and not (i + 1 < len(sig) and sig[i + 1].kind == "lparen")]
+
+def sub_code(pattern: str, repl: str, text: str, flags: int = 0, count: int = 0) -> str:
+    """re.sub applied outside string literals and comments."""
+    out, pending = [], []
+    for t in tokenize(text):
+        if t.kind in ("string", "comment"):
+            out.append(re.sub(pattern, repl, "".join(pending), count=count, flags=flags))
+            pending = []
+            out.append(t.text)
+        else:
+            pending.append(t.text)
+    out.append(re.sub(pattern, repl, "".join(pending), count=count, flags=flags))
+    return "".join(out)
@@ -1,134 +1,80 @@
 import re
+from kql_canon import canonical_query
+from kql_lint import RULES, Rule, is_decisive, render
+from kql_parse import QueryAnalysis, as_analysis, identifiers, sub_code
+import kql_semantic
 
-def analyze_kql(q: str) -> dict:
-    qn = q.strip()
-    hints = []
-    errors = []
-    optimizations = []
-    if not qn:
-        errors.append("Query is empty")
-    if "|" not in qn:
-        hints.append("Use pipe to chain operators")
-    if re.search(r"summarize\s+[^|]*$", qn) and "by" not in qn:
-        hints.append("Use 'summarize ... by field' for grouping")
-    if re.search(r"summarize\s+count\(\)\s*$", qn) and "by" not in qn:
-        hints.append("Add 'by' after count() to group")
-    if re.search(r"\|\s*where\b.*\|\s*summarize\b", qn) is None and re.search(r"\|\s*summarize\b.*\|\s*where\b", qn):
-        hints.append("Place where before summarize when filtering")
-    if re.search(r"\|\s*project\b", qn) is None:
-        optimizations.append("Project needed columns early to reduce scans")
-    if re.search(r"\|\s*limit\b|\|\s*take\b", qn) is None:
-        optimizations.append("Use take/limit for sampling during exploration")
-    if re.search(r"distinct\b", qn) and re.search(r"\|\s*project\b", qn) is None:
-        optimizations.append("Project target column then distinct for efficiency")
-    if re.search(r"\|\s*where\b", qn) is None:
-        hints.append("Filter early with where to reduce data")
-    if re.search(r"\|\|", qn):
-        errors.append("Remove duplicate pipes")
-    return {"hints": hints, "errors": errors, "optimizations": optimizations}
-
-def fix_query(q: str, suggested_table: str | None = None, task: str | None = None) -> str:
-    x = q
-    x = re.sub(r"\|\|+", "|", x)
-    if re.search(r"\|\s*summarize\b.*\|\s*where\b", x):
-        parts = [p.strip() for p in x.split("|") if p.strip()]
-        parts_sorted = []
-        for p in parts:
-            if p.startswith("where"):
-                parts_sorted.insert(1 if parts_sorted else 0, p)
-            else:
-                parts_sorted.append(p)
-        x = " | ".join(parts_sorted)
-    if re.search(r"summarize\s+count\(\)\s*$", x) and "by" not in x:
-        x = re.sub(r"summarize\s+count\(\)\s*$", "summarize count() by Target", x)
-    repl = suggested_table or "SecurityEvent"
-    x = re.sub(r"^\s*Table\b", repl, x.strip())
-    if not has_time_filter(x):
-        x = insert_after_table(x, "where TimeGenerated >= ago(24h)")
-    
-    # Fix incorrect EventID values based on task context
-    if task:
-        task_lower = task.lower()
-        # If task mentions failed logins/logons, ensure EventID is 4625
-        if ("failed" in task_lower and ("login" in task_lower or "logon" in task_lower)) or "4625" in task:
-            # Check if EventID exists but is wrong
-            eventid_match = re.search(r"EventID\s*==\s*(\d+)", x, re.IGNORECASE)
-            if eventid_match:
-                current_eventid = eventid_match.group(1)
-                if current_eventid != "4625":
-                    # Replace incorrect EventID with 4625
-                    x = re.sub(r"EventID\s*==\s*\d+", "EventID == 4625", x, flags=re.IGNORECASE)
-            elif "eventid" not in x.lower():
-                # Add EventID 4625 if missing
-                # Find the where clause and add EventID filter
-                where_match = re.search(r"where\s+([^|]+)", x, re.IGNORECASE)
-                if where_match:
-                    where_content = where_match.group(1)
-                    # Add "and EventID == 4625" to the where clause
-                    x = re.sub(r"(where\s+[^|]+)", r"\1 and EventID == 4625", x, flags=re.IGNORECASE, count=1)
-                else:
-                    # No where clause, add one after table
-                    x = insert_after_table(x, "where EventID == 4625")
-    
-    return x.strip()
-
-def has_time_filter(q: str) -> bool:
-    return re.search(r"\b(TimeGenerated|Timestamp)\s*(>=|>)\s*ago\([^)]+\)", q, re.IGNORECASE) is not None
-
-def insert_after_table(q: str, clause: str) -> str:
-    parts = [p.strip() for p in q.split("|") if p.strip()]
-    if not parts:
+# Every rule takes the query text or its QueryAnalysis (kql_parse.analyze_query,
+# memoized per text), so one Analyze click tokenizes each distinct query once.
+
+def analyze_kql(q: "str | QueryAnalysis") -> dict:
+    out = {"hints": [], "errors": [], "optimizations": []}
+    for f in RULES.lint(q, "lint"):
+        out[f.severity + "s"].append(f.message)
+    return out
+
+def where_after_summarize(a: QueryAnalysis) -> bool:
+    i = a.stage_index("summarize")
+    return i is not None and any(s.operator == "where" for s in a.stages[i + 1:])
+
+def where_before_summarize(a: QueryAnalysis) -> bool:
+    last = max((i for i, s in enumerate(a.stages) if i and s.operator == "summarize"), default=None)
+    return last is not None and any(s.operator == "where" for s in a.stages[1:last])
+
+def fix_query(q: "str | QueryAnalysis", suggested_table: str | None = None, task: str | None = None) -> str:
+    fixed, _ = RULES.apply_fixes(q, "fix", {"suggested_table": suggested_table, "task": task or ""})
+    return fixed.strip()
+
+def has_time_filter(q: "str | QueryAnalysis") -> bool:
+    return any(f.op in (">=", ">") and f.value.lower().startswith("ago(") for f in as_analysis(q).time_filters)
+
+def insert_after_table(q: "str | QueryAnalysis", clause: str) -> str:
+    a = as_analysis(q)
+    if not a.stages:
         return clause
-    parts = [parts[0]] + ([clause] + parts[1:])
-    return " | ".join(parts)
+    return a.with_stages([a.stages[0].text, clause] + [s.text for s in a.stages[1:]])
 
-def compute_diffs(original: str, fixed: str) -> list:
+def compute_diffs(original: "str | QueryAnalysis", fixed: "str | QueryAnalysis") -> list:
     diffs = []
-    o = original.strip()
-    f = fixed.strip()
-    o_lower = o.lower()
-    f_lower = f.lower()
-    if re.match(r"^\s*Table\b", o) and not re.match(r"^\s*Table\b", f):
+    o = as_analysis(original)
+    f = as_analysis(fixed)
+    if o.table == "Table" and f.table != "Table":
         diffs.append("Replaced placeholder table with suggested dataset")
-    if "||" in o and "||" not in f:
+    if o.empty_stages and o.stages and not f.empty_stages:
         diffs.append("Collapsed duplicate pipes")
-    if re.search(r"\|\s*summarize\b.*\|\s*where\b", o) and re.search(r"\|\s*summarize\b.*\|\s*where\b", f) is None:
+    if where_after_summarize(o) and not where_after_summarize(f):
         diffs.append("Moved where before summarize")
-    if re.search(r"summarize\s+count\(\)\s*$", o) and "by" not in o and re.search(r"summarize\s+count\(\)\s+by\b", f):
+    if o.stages and re.fullmatch(r"summarize\s+count\(\)", o.stages[-1].text) and not o.group_by \
+            and any(re.match(r"summarize\s+count\(\)\s+by\b", s.text) for s in f.stages_of("summarize")):
         diffs.append("Added 'by' to summarize count()")
     if not has_time_filter(o) and has_time_filter(f):
         diffs.append("Added TimeGenerated time filter")
     # Check for EventID corrections
-    o_eventid = re.search(r"EventID\s*==\s*(\d+)", o_lower)
-    f_eventid = re.search(r"EventID\s*==\s*(\d+)", f_lower)
+    o_eventid = next(iter(o.values("EventID")), None)
+    f_eventid = next(iter(f.values("EventID")), None)
     if o_eventid and f_eventid:
-        o_val = o_eventid.group(1)
-        f_val = f_eventid.group(1)
-        if o_val != f_val:
-            diffs.append(f"Corrected EventID from {o_val} to {f_val}")
-    elif o_eventid and not f_eventid:
-        # EventID was removed (shouldn't happen, but check anyway)
-        pass
+        if o_eventid != f_eventid:
+            diffs.append(f"Corrected EventID from {o_eventid} to {f_eventid}")
     elif not o_eventid and f_eventid:
-        diffs.append(f"Added EventID filter: {f_eventid.group(1)}")
+        diffs.append(f"Added EventID filter: {f_eventid}")
     return diffs
 
-def render_commented_query(fixed: str, diffs: list) -> str:
-    parts = [p.strip() for p in fixed.split("|") if p.strip()]
+def render_commented_query(fixed: "str | QueryAnalysis", diffs: list) -> str:
     annotated = []
-    for p in parts:
+    for i, stage in enumerate(as_analysis(fixed).stages):
+        p = stage.text
         comment = None
-        if p.startswith("SecurityEvent"):
+        if i == 0 and p.startswith("SecurityEvent"):
             comment = "// choose appropriate table (e.g., SecurityEvent)"
-        elif p.startswith("where") and "TimeGenerated" in p:
+        elif stage.operator == "where" and any(t.text == "TimeGenerated" for t in stage.tokens):
             comment = "// add time filter to bound data volume"
-        elif p.startswith("where"):
+        elif stage.operator == "where":
             comment = "// filter rows before aggregation"
-        elif p.startswith("project"):
+        elif stage.operator == "project":
             comment = "// project only needed columns to reduce scans"
-        elif p.startswith("summarize"):
+        elif stage.operator == "summarize":
             comment = "// aggregate results with summarize"
-        elif p.startswith("distinct"):
+        elif stage.operator == "distinct":
             comment = "// distinct values for the target column"
         line = p
         if comment:
@@ -138,12 +84,14 @@ def render_commented_query(fixed: str, diffs: list) -> str:
     body = " | \n".join(annotated)
     return (header + "\n" + body).strip()
 
-def optimize_query(q: str, task: str | None = None, relevant_columns: list | None = None, suggested_table: str | None = None) -> tuple[str, list]:
+def optimize_query(q: "str | QueryAnalysis", task: str | None = None, relevant_columns: list | None = None, suggested_table: str | None = None) -> tuple[str, list]:
     changes = []
-    x = q.strip()
+    a = as_analysis(q)
+    x = a.text.strip()
     # Remove large sampling
-    if re.search(r"\|\s*(take|limit)\s+\d+", x):
-        x = re.sub(r"\|\s*(take|limit)\s+\d+", "", x)
+    sampled = [s for s in a.stages[1:] if s.operator in ("take", "limit") and re.fullmatch(r"(take|limit)\s+\d+", s.text, re.IGNORECASE)]
+    if sampled:
+        x = a.with_stages([s.text for s in a.stages if s not in sampled])
         changes.append("Removed take/limit sampling")
     # Ensure time filter exists
     if not has_time_filter(x):
@@ -154,51 +102,50 @@ def optimize_query(q: str, task: str | None = None, relevant_columns: list | Non
     if relevant_columns:
         for c in relevant_columns:
             cols.add(c)
-    if cols:
+    b = as_analysis(x)
+    if cols and b.stages and not any(op.startswith("project") for op in b.operators):
         proj = "project " + ", ".join(sorted(cols))
-        if re.search(r"\|\s*project\b", x) is None:
-            # insert after first where if present, else after table
-            parts = [p.strip() for p in x.split("|") if p.strip()]
-            inserted = False
-            for i, p in enumerate(parts):
-                if p.startswith("where"):
-                    parts.insert(i+1, proj)
-                    inserted = True
-                    break
-            if not inserted:
-                parts = [parts[0], proj] + parts[1:]
-            x = " | ".join(parts)
-            changes.append("Added project to reduce columns")
+        # insert after first where if present, else after table
+        stages = [s.text for s in b.stages]
+        i = b.stage_index("where")
+        stages.insert(i + 1 if i is not None else 1, proj)
+        x = b.with_stages(stages)
+        changes.append("Added project to reduce columns")
     # Task-specific: distinct hosts → dcount
     if task and re.search(r"distinct\s+hosts", task, re.IGNORECASE):
-        if re.search(r"distinct\s+HostName\b", x):
-            x = re.sub(r"distinct\s+HostName\b", "summarize dcount(HostName)", x)
+        b = as_analysis(x)
+        distinct_host = next((s for s in b.stages_of("distinct") if re.fullmatch(r"distinct\s+HostName", s.text)), None)
+        if distinct_host is not None:
+            x = b.with_stages(["summarize dcount(HostName)" if s is distinct_host else s.text for s in b.stages])
             changes.append("Replaced distinct HostName with summarize dcount(HostName)")
-        elif re.search(r"summarize\b", x) is None:
+        elif not b.has("summarize"):
             x = x + " | summarize dcount(HostName)"
             changes.append("Added summarize dcount(HostName)")
     return x.strip(), changes
 
-def infer_columns(q: str) -> set:
+def infer_columns(q: "str | QueryAnalysis") -> set:
+    a = as_analysis(q)
     cols = set()
-    # capture columns used in 'by', 'distinct', equality filters
-    m_by = re.search(r"by\s+([A-Za-z0-9_]+)", q)
-    if m_by:
-        cols.add(m_by.group(1))
-    m_dist = re.search(r"distinct\s+([A-Za-z0-9_]+)", q)
-    if m_dist:
-        cols.add(m_dist.group(1))
-    for m in re.finditer(r"\b([A-Za-z0-9_]+)\s*(==|=~|!=|in)\s*", q):
-        cols.add(m.group(1))
+    # columns used in 'by', 'distinct', aggregations and equality filters
+    for g in a.group_by:
+        cols.update(identifiers(g))
+    for s in a.stages_of("distinct"):
+        cols.update(identifiers(s.text))
+    for agg in a.aggregations:
+        cols.update(identifiers(agg.args))
+    for p in a.predicates:
+        if p.op in ("==", "=~", "!=", "in"):
+            cols.add(p.column)
     cols.add("TimeGenerated")
     return cols
 
-def explain_natural(q: str) -> tuple[str, str | None]:
-    parts = [p.strip() for p in q.split("|") if p.strip()]
-    table = parts[0] if parts else "(table)"
-    time_clause = next((p for p in parts if p.startswith("where") and "TimeGenerated" in p), None)
-    fail_clause = next((p for p in parts if re.search(r"(EventID\s*==\s*4625|LogonResult\s*==\s*\"Failed\")", p)), None)
-    distinct_host = next((p for p in parts if re.search(r"distinct\s+HostName|dcount\(HostName\)", p)), None)
+def explain_natural(q: "str | QueryAnalysis") -> tuple[str, str | None]:
+    a = as_analysis(q)
+    table = a.stages[0].text if a.stages else "(table)"
+    time_clause = any(any(t.text == "TimeGenerated" for t in s.tokens) for s in a.stages_of("where"))
+    fail_clause = "4625" in a.values("EventID") or any(v.strip("'\"") == "Failed" for v in a.values("LogonResult"))
+    distinct_host = any("HostName" in identifiers(s.text) for s in a.stages_of("distinct")) \
+        or any(agg.function == "dcount" and "HostName" in identifiers(agg.args) for agg in a.aggregations)
     s = []
     s.append(f"Step 1 selects {table} which holds relevant logs (e.g., SecurityEvent or SigninLogs).")
     if time_clause:
@@ -213,86 +160,206 @@ def explain_natural(q: str) -> tuple[str, str | None]:
     if fail_clause:
         classification = "This is a hunting query for failed logons; you could turn it into an analytic rule by adding thresholds and scheduling."
     return " ".join(s), classification
-def assess_task(task: str, q: str, schema: dict | None = None) -> tuple[bool, list, str, str]:
+
+def normalize_query(q: "str | QueryAnalysis") -> str:
+    """Canonical form (kql_canon) used for exact-match checks: ignores whitespace,
+    comments, limit/sort aliases, and the order of `and` terms. Keyword case counts:
+    KQL operators are case-sensitive, so `WHERE` is not the reference's `where`."""
+    return canonical_query(as_analysis(q).text)
+
+def assess_task_detailed(task: str, q: "str | QueryAnalysis", schema: dict | None = None, reference: str | None = None) -> dict:
+    """assess_task plus a confidence score and the list of checked requirements.
+
+    Each check is {"requirement", "passed", "decisive"}. A failed decisive check
+    (wrong table, unless schema["ranked"] says only the BM25 ranking chose it;
+    missing explicit time window; wrong EventID) is a clear verdict;
+    the other checks are keyword heuristics. A query that canonicalizes to the
+    reference (starter) query and passes every check gets confidence 1.0.
+
+    With a reference query, both are also run on generated data
+    (kql_semantic). Equal results pass the query even if keyword checks failed;
+    those checks are marked "superseded". Different results fail it."""
+    a = as_analysis(q)
+    q = a.text
     mismatches = []
-    fulfills = True  # Start optimistic, but check thoroughly
-    reason = ""
-    qn = q.strip().lower()
-    t = (task or "").lower()
+    checks = []
     suggested = (schema or {}).get("suggested_table")
-    
+    exact = bool(reference) and normalize_query(a) == normalize_query(reference)
+
+    def check(requirement: str, passed: bool, decisive: bool, mismatch: str | None = None) -> None:
+        checks.append({"requirement": requirement, "passed": passed, "decisive": decisive})
+        if not passed:
+            mismatches.append(mismatch or requirement)
+
     # Check if query is empty or too basic
-    if not q or not q.strip() or len(q.strip()) < 10:
-        fulfills = False
-        mismatches.append("Query is empty or too basic")
-        return fulfills, mismatches, q, "Query is empty or too basic"
-    
-    # Check table name
-    if suggested and not q.strip().startswith(suggested):
-        fulfills = False
-        mismatches.append(f"Uses a different table than suggested ({suggested})")
-    
-    # Check time filters - look for various time patterns
-    time_patterns = [
-        r"24h", r"24\s*h", r"ago\(24h\)", r"ago\(1d\)",
-        r"7d", r"7\s*d", r"ago\(7d\)",
-        r"today", r"startofday",
-        r"TimeGenerated\s*>=\s*ago",
-        r"Timestamp\s*>=\s*ago"
-    ]
-    has_time = any(re.search(pattern, qn, re.IGNORECASE) for pattern in time_patterns) or has_time_filter(q)
-    
-    if "24h" in t or "24 hours" in t or "last 24" in t:
-        if not has_time:
-            fulfills = False
-            mismatches.append("Missing 24h time filter (should use ago(24h) or similar)")
-    elif "7d" in t or "7 days" in t or "last 7" in t:
-        if not has_time:
-            fulfills = False
-            mismatches.append("Missing 7d time filter (should use ago(7d) or similar)")
-    elif "today" in t:
-        if not (has_time or "startofday" in qn):
-            fulfills = False
-            mismatches.append("Missing today time filter (should use startofday(now()) or similar)")
-    elif any(time_word in t for time_word in ["time", "ago", "recent", "last"]):
-        if not has_time:
-            fulfills = False
-            mismatches.append("Missing time filter")
-    
-    # Check for distinct hosts
-    if "distinct hosts" in t or "distinct host" in t:
-        if not (re.search(r"distinct\s+hostname", qn) or re.search(r"summarize\b.*hostname", qn) or re.search(r"dcount.*hostname", qn)):
-            fulfills = False
-            mismatches.append("Missing distinct HostName operation")
-    
-    # Check for failed logins
-    if "failed" in t and ("login" in t or "logon" in t):
-        eventid_match = re.search(r"EventID\s*==\s*(\d+)", qn)
-        if eventid_match:
-            eventid_value = eventid_match.group(1)
-            if eventid_value != "4625":
-                fulfills = False
-                mismatches.append(f"Incorrect EventID {eventid_value} (should be 4625 for failed logons)")
-        elif "4625" not in q and "eventid" not in qn and "resulttype" not in qn:
-            fulfills = False
-            mismatches.append("Missing failed login filter (EventID 4625 or ResultType)")
-    
-    # Check for specific aggregations mentioned in task
-    if "count" in t and "per" in t:
-        if "summarize" not in qn and "count()" not in qn:
-            fulfills = False
-            mismatches.append("Missing count aggregation (summarize count())")
-    
-    if "top" in t or "5" in t or "10" in t:
-        if "top" not in qn and "limit" not in qn:
-            fulfills = False
-            mismatches.append("Missing top/limit clause")
-    
+    if len(a.code.strip()) < 10:
+        check("Non-trivial query", False, True, "Query is empty or too basic")
+        return {"fulfills": False, "mismatches": mismatches, "corrected": q, "reason": "Query is empty or too basic",
+                "confidence": 1.0, "checks": checks, "exact_match": exact}
+
+    context = {"task": task or "", "suggested_table": suggested, "ranked": bool((schema or {}).get("ranked"))}
+    for rule, fired in RULES.evaluate(a, "task", context):
+        check(render(rule.requirement, a, context), not fired, is_decisive(rule, a, context), render(rule.message, a, context))
+
+    # Same results as the reference on generated data outranks the keyword checks, both ways
+    semantic = None
+    if reference and not exact and kql_semantic.ENABLED:
+        semantic = kql_semantic.compare_cached(a.text, reference, task or "")
+        if semantic["equivalent"]:
+            for c in checks:
+                if not c["passed"]:
+                    c["superseded"] = True
+            mismatches.clear()
+        if semantic["equivalent"] is not None:
+            check("Same results as the reference solution", semantic["equivalent"], True, semantic["reason"])
+
+    fulfills = not mismatches
     corrected = q
     if mismatches:
-        corrected = fix_query(q, suggested_table=suggested, task=task)
-    if fulfills:
-        reason = "Query aligns with task requirements"
+        corrected = fix_query(a, suggested_table=suggested, task=task)
+    if fulfills and semantic and semantic["equivalent"]:
+        reason = semantic["reason"]
+    elif fulfills:
+        reason = "Query matches the reference solution" if exact else "Query aligns with task requirements"
     else:
         reason = "Query diverges from task: " + "; ".join(mismatches)
-    return fulfills, mismatches, corrected, reason
+
+    # Passing keyword checks is weak evidence; failing a decisive one is strong
+    if any(not c["passed"] and c["decisive"] and not c.get("superseded") for c in checks):
+        confidence = 0.95
+    elif not fulfills:
+        confidence = 0.7
+    elif exact:
+        confidence = 1.0
+    elif semantic and semantic["equivalent"]:
+        confidence = 0.98
+    else:
+        confidence = min(0.85, 0.5 + 0.1 * len(checks))
+    return {"fulfills": fulfills, "mismatches": mismatches, "corrected": corrected, "reason": reason,
+            "confidence": confidence, "checks": checks, "exact_match": exact, "semantic": semantic}
+
+def assess_task(task: str, q: "str | QueryAnalysis", schema: dict | None = None) -> tuple[bool, list, str, str]:
+    a = assess_task_detailed(task, q, schema)
+    return a["fulfills"], a["mismatches"], a["corrected"], a["reason"]
+
+# --- Rules -------------------------------------------------------------------
+# Patterns match kql_lint.scan_text: tokens separated by single spaces, string
+# literals blanked. Within a group, registration order is report order, and for
+# "fix" rules the order the fixes are applied in.
+
+def has_project(a: QueryAnalysis) -> bool:
+    return any(op.startswith("project") for op in a.operators)
+
+def task_text(context: dict) -> str:
+    return (context.get("task") or "").lower()
+
+def failed_logon_task(context: dict) -> bool:
+    t = task_text(context)
+    return "failed" in t and ("login" in t or "logon" in t)
+
+def time_window(context: dict) -> str | None:
+    # An explicit window in the task is decisive; a vague "recent" is not
+    t = task_text(context)
+    if "24h" in t or "24 hours" in t or "last 24" in t:
+        return "24h"
+    if "7d" in t or "7 days" in t or "last 7" in t:
+        return "7d"
+    if "today" in t:
+        return "today"
+    if any(word in t for word in ("time", "ago", "recent", "last")):
+        return "any"
+    return None
+
+def move_where_up(a: QueryAnalysis, context: dict) -> str:
+    # where stages move up behind the table, keeping their order
+    rest = a.stages[1:]
+    return a.with_stages([s.text for s in a.stages[:1]] + [s.text for s in rest if s.operator == "where"]
+                         + [s.text for s in rest if s.operator != "where"])
+
+def add_eventid_4625(a: QueryAnalysis, context: dict) -> str:
+    # to the first where clause, or as a new one
+    i = a.stage_index("where")
+    if i is None:
+        return insert_after_table(a, "where EventID == 4625")
+    stages = [s.text for s in a.stages]
+    stages[i] += " and EventID == 4625"
+    return a.with_stages(stages)
+
+COUNT_WITHOUT_BY = r"(?:^|\| )summarize count \( \)(?: ;)*$"
+
+# analyze_kql
+RULES.add(Rule("empty-query", "lint", "error", "Query is empty", check=lambda a, c: not a.stages))
+RULES.add(Rule("no-pipe", "lint", "hint", "Use pipe to chain operators", pattern=r"\|", negate=True))
+RULES.add(Rule("summarize-without-by", "lint", "hint", "Use 'summarize ... by field' for grouping",
+               check=lambda a, c: bool(a.stages) and a.stages[-1].operator == "summarize" and not a.group_by))
+RULES.add(Rule("count-without-by", "lint", "hint", "Add 'by' after count() to group", pattern=COUNT_WITHOUT_BY))
+RULES.add(Rule("where-after-summarize", "lint", "hint", "Place where before summarize when filtering",
+               check=lambda a, c: where_after_summarize(a) and not where_before_summarize(a)))
+RULES.add(Rule("no-project", "lint", "optimization", "Project needed columns early to reduce scans",
+               pattern=r"\| project\b", negate=True))
+RULES.add(Rule("no-take", "lint", "optimization", "Use take/limit for sampling during exploration",
+               pattern=r"\| (?:take|limit)\b", negate=True))
+RULES.add(Rule("distinct-without-project", "lint", "optimization", "Project target column then distinct for efficiency",
+               pattern=r"(?i:\bdistinct\b)", check=lambda a, c: not has_project(a)))
+RULES.add(Rule("no-where", "lint", "hint", "Filter early with where to reduce data", pattern=r"\| where\b", negate=True))
+RULES.add(Rule("duplicate-pipes", "lint", "error", "Remove duplicate pipes",
+               check=lambda a, c: bool(a.empty_stages and a.stages)))
+
+# fix_query; the messages match compute_diffs
+RULES.add(Rule("move-where-up", "fix", "fix", "Moved where before summarize",
+               check=lambda a, c: where_after_summarize(a), fix=move_where_up))
+RULES.add(Rule("add-by-to-count", "fix", "fix", "Added 'by' to summarize count()", pattern=COUNT_WITHOUT_BY,
+               fix=lambda a, c: a.with_stages([s.text for s in a.stages[:-1]] + [a.stages[-1].text + " by Target"])))
+RULES.add(Rule("placeholder-table", "fix", "fix", "Replaced placeholder table with suggested dataset",
+               check=lambda a, c: a.table == "Table",
+               fix=lambda a, c: a.with_stages([c.get("suggested_table") or "SecurityEvent"] + [s.text for s in a.stages[1:]])))
+RULES.add(Rule("collapse-pipes", "fix", "fix", "Collapsed duplicate pipes",
+               check=lambda a, c: bool(a.empty_stages), fix=lambda a, c: a.with_stages([s.text for s in a.stages])))
+RULES.add(Rule("add-time-filter", "fix", "fix", "Added TimeGenerated time filter",
+               check=lambda a, c: not has_time_filter(a),
+               fix=lambda a, c: insert_after_table(a, "where TimeGenerated >= ago(24h)")))
+RULES.add(Rule("correct-eventid", "fix", "fix", lambda a, c: f"Corrected EventID from {next(v for v in a.values('EventID') if v != '4625')} to 4625",
+               applies=lambda a, c: failed_logon_task(c) or "4625" in c.get("task", ""),
+               check=lambda a, c: any(v != "4625" for v in a.values("EventID")),
+               fix=lambda a, c: sub_code(r"\bEventID\s*==\s*\d+", "EventID == 4625", a.text, flags=re.IGNORECASE)))
+RULES.add(Rule("add-eventid", "fix", "fix", "Added EventID filter: 4625",
+               applies=lambda a, c: failed_logon_task(c) or "4625" in c.get("task", ""),
+               check=lambda a, c: not a.values("EventID") and not a.references("EventID"), fix=add_eventid_4625))
+
+# assess_task: a rule fires when the requirement is not met
+RULES.add(Rule("uses-suggested-table", "task", "requirement",
+               lambda a, c: f"Uses a different table than suggested ({c['suggested_table']})",
+               # A table picked only by the schema ranking may be a near miss
+               requirement=lambda a, c: f"Uses table {c['suggested_table']}", decisive=lambda a, c: not c.get("ranked"),
+               applies=lambda a, c: bool(c.get("suggested_table")), check=lambda a, c: a.table != c["suggested_table"]))
+RULES.add(Rule("time-filter-24h", "task", "requirement", "Missing 24h time filter (should use ago(24h) or similar)",
+               requirement="24h time filter", decisive=True,
+               applies=lambda a, c: time_window(c) == "24h", check=lambda a, c: not a.time_filters))
+RULES.add(Rule("time-filter-7d", "task", "requirement", "Missing 7d time filter (should use ago(7d) or similar)",
+               requirement="7d time filter", decisive=True,
+               applies=lambda a, c: time_window(c) == "7d", check=lambda a, c: not a.time_filters))
+RULES.add(Rule("time-filter-today", "task", "requirement",
+               "Missing today time filter (should use startofday(now()) or similar)",
+               requirement="Today time filter", decisive=True,
+               applies=lambda a, c: time_window(c) == "today", check=lambda a, c: not a.time_filters))
+RULES.add(Rule("time-filter", "task", "requirement", "Missing time filter", requirement="Time filter",
+               applies=lambda a, c: time_window(c) == "any", check=lambda a, c: not a.time_filters))
+RULES.add(Rule("distinct-hostname", "task", "requirement", "Missing distinct HostName operation",
+               requirement="Distinct HostName", applies=lambda a, c: "distinct host" in task_text(c),
+               check=lambda a, c: not any("hostname" in (x.lower() for x in identifiers(s.text))
+                                          for s in a.stages_of("distinct") + a.stages_of("summarize"))))
+RULES.add(Rule("eventid-4625", "task", "requirement",
+               lambda a, c: f"Incorrect EventID {next((v for v in a.values('EventID') if v != '4625'), '')} (should be 4625 for failed logons)",
+               requirement="EventID 4625 for failed logons", decisive=True,
+               applies=lambda a, c: failed_logon_task(c) and bool(a.values("EventID")),
+               check=lambda a, c: any(v != "4625" for v in a.values("EventID"))))
+RULES.add(Rule("failed-login-filter", "task", "requirement", "Missing failed login filter (EventID 4625 or ResultType)",
+               requirement="Failed login filter", applies=lambda a, c: failed_logon_task(c) and not a.values("EventID"),
+               check=lambda a, c: not ("4625" in a.code or a.references("EventID") or a.references("ResultType"))))
+RULES.add(Rule("count-aggregation", "task", "requirement", "Missing count aggregation (summarize count())",
+               requirement="Count aggregation", applies=lambda a, c: "count" in task_text(c) and "per" in task_text(c),
+               check=lambda a, c: not (a.has("summarize") or any(g.function == "count" for g in a.aggregations))))
+# Whole numbers only, so an EventID like 4625 does not read as "top 5"
+RULES.add(Rule("top-limit", "task", "requirement", "Missing top/limit clause", requirement="Top/limit clause",
+               check=lambda a, c: not (a.has("top") or a.has("limit") or a.has("take")),
+               applies=lambda a, c: bool(re.search(r"\btop\b|\b(5|10)\b", task_text(c)))))
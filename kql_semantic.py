@@ -0,0 +1,254 @@
+"""Result-based grading: run a student query and the task's reference query over
+generated datasets and compare what they return.
+
+Keyword checks accept wrong queries and reject equivalent ones (LogonResult ==
+"Failed" for EventID 4625, ago(1d) for ago(24h)); comparing results does not
+care how the filter is written. The datasets are a large base plus small
+per-variant deltas (boundary rows, extra random rows), executed with
+kql_exec.execute_variants so the base is scanned once for all variants. The
+clock is pinned, so datasets and reference results never go stale and are
+cached per task.
+"""
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+from kql_canon import query_hash
+from kql_exec import ColumnIndex, QueryBudget, QueryResult, build_index, execute_variants, pipeline_plan, unsupported_stages
+from kql_parse import QueryAnalysis, as_analysis
+from schema_catalog import BASE_CATALOG
+
+ENABLED = os.getenv("KQLTUTOR_SEMANTIC_GRADING", "1") != "0"
+ROWS = int(os.getenv("KQLTUTOR_SEMANTIC_ROWS", "20000"))
+VARIANTS = max(1, int(os.getenv("KQLTUTOR_SEMANTIC_VARIANTS", "3")))
+REL_TOL = 1e-6
+ABS_TOL = 1e-9
+# Mid-afternoon, so startofday(now()) keeps part of the data
+NOW = datetime(2025, 12, 8, 15, 0, tzinfo=timezone.utc)
+BUDGET = QueryBudget(max_seconds=2.0, max_rows_scanned=None, max_rows_materialized=None, max_memory_mb=None)
+
+HOSTS = [f"srv-{i:02d}" for i in range(1, 41)]
+# HostName is drawn separately from Computer, so a query on the wrong one returns different rows
+WORKSTATIONS = [f"ws-{i:02d}" for i in range(1, 31)]
+USERS = [f"user{i:02d}" for i in range(1, 61)]
+# (EventID, LogonResult, weight)
+EVENTS = [(4624, "Success", 60), (4625, "Failed", 25), (4634, "Success", 10), (4672, "Success", 5)]
+RESULT_TYPES = [("0", 70), ("50074", 12), ("50126", 12), ("50053", 6)]
+# Minutes before NOW that common time filters cut at; boundary rows sit one minute either side
+WINDOWS = [60, 24 * 60, 7 * 24 * 60, 30 * 24 * 60, 15 * 60]  # 1h, 24h, 7d, 30d, start of day
+SPAN_MINUTES = 10 * 24 * 60
+
+def iso(minutes_ago: int) -> str:
+    return (NOW - timedelta(minutes=minutes_ago)).strftime("%Y-%m-%dT%H:%M:00Z")
+
+def security_event(rng: random.Random, minutes_ago: int, host: str | None = None) -> Dict[str, Any]:
+    event_id, result, _ = rng.choices(EVENTS, weights=[w for *_, w in EVENTS])[0]
+    computer = f"{host}-srv" if host else rng.choice(HOSTS)
+    return {"TimeGenerated": iso(minutes_ago), "Computer": computer, "Account": f"contoso\\{rng.choice(USERS)}",
+            "EventID": event_id, "LogonResult": result, "HostName": f"{host}-ws" if host else rng.choice(WORKSTATIONS),
+            "IpAddress": f"10.0.{rng.randrange(8)}.{rng.randrange(1, 255)}"}
+
+def signin(rng: random.Random, minutes_ago: int, user: str | None = None) -> Dict[str, Any]:
+    return {"TimeGenerated": iso(minutes_ago), "UserPrincipalName": f"{user or rng.choice(USERS)}@contoso.com",
+            "IPAddress": f"20.1.{rng.randrange(8)}.{rng.randrange(1, 255)}",
+            "ResultType": rng.choices(RESULT_TYPES, weights=[w for _, w in RESULT_TYPES])[0][0]}
+
+GENERATORS = {"SecurityEvent": security_event, "SigninLogs": signin}
+
+def random_rows(table: str, n: int, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(f"{table}-{seed}")
+    make = GENERATORS[table]
+    return [make(rng, rng.randrange(SPAN_MINUTES)) for _ in range(n)]
+
+def boundary_rows(table: str) -> List[Dict[str, Any]]:
+    # Hosts and users seen only here, so a wrong window changes distinct lists as well as counts
+    rng = random.Random(f"{table}-edges")
+    make = GENERATORS[table]
+    rows = []
+    for i, minutes in enumerate(WINDOWS):
+        for side, offset in (("in", -1), ("out", 1)):
+            for _ in range(3):
+                rows.append(make(rng, minutes + offset, f"edge-{i}-{side}"))
+    return rows
+
+Datasets = tuple[Dict[str, List[Dict[str, Any]]], List[Dict[str, List[Dict[str, Any]]]]]
+_datasets: Datasets | None = None
+_datasets_lock = threading.Lock()
+
+def datasets() -> Datasets:
+    """(base, deltas): variant 0 is the base alone, variant 1 adds boundary rows,
+    later variants add fresh random rows. Built once; concurrent first callers wait."""
+    global _datasets
+    if _datasets is None:
+        with _datasets_lock:
+            if _datasets is None:
+                _datasets = build_datasets()
+    return _datasets
+
+def build_datasets() -> Datasets:
+    tables = [t for t in BASE_CATALOG if t in GENERATORS]
+    base = {t: random_rows(t, ROWS, 0) for t in tables}
+    deltas: List[Dict[str, List[Dict[str, Any]]]] = [{}]
+    for v in range(1, VARIANTS):
+        deltas.append({t: (boundary_rows(t) if v == 1 else []) + random_rows(t, max(1, ROWS // 10), v) for t in tables})
+    return base, deltas
+
+def value_key(v: Any) -> tuple:
+    if v is None:
+        return (0, "")
+    if isinstance(v, (bool, int, float)):
+        return (1, float(v))
+    if isinstance(v, datetime):
+        return (2, v.isoformat())
+    return (2, str(v))
+
+def canonical(rows: List[Dict[str, Any]]) -> List[tuple]:
+    """Rows as sorted tuples of their values: row order, column order and column
+    names (count_ vs Count) do not matter."""
+    return sorted(tuple(sorted(value_key(v) for v in r.values())) for r in rows)
+
+def values_equal(a: tuple, b: tuple, rel_tol: float, abs_tol: float) -> bool:
+    if a[0] != b[0]:
+        return False
+    return math.isclose(a[1], b[1], rel_tol=rel_tol, abs_tol=abs_tol) if a[0] == 1 else a[1] == b[1]
+
+def rows_match(got: List[tuple], expected: List[tuple], rel_tol: float = REL_TOL, abs_tol: float = ABS_TOL) -> bool:
+    return len(got) == len(expected) and all(
+        len(x) == len(y) and all(values_equal(a, b, rel_tol, abs_tol) for a, b in zip(x, y)) for x, y in zip(got, expected))
+
+def show(row: tuple) -> list:
+    return [v for _, v in row]
+
+# (task, reference hash) -> canonical reference rows per variant; LRU like the scheduler's reference feedback
+_reference_results: "OrderedDict[tuple, List[List[tuple]] | str]" = OrderedDict()
+_reference_lock = threading.Lock()
+_stats = Counter()
+REFERENCE_CACHE_SIZE = 512
+
+# table -> column -> value -> base rows; replaced whole when a column is added, so readers need no lock
+_indexes: Dict[str, ColumnIndex] = {}
+
+def index_columns(q: "str | QueryAnalysis") -> List[str]:
+    """Base-table indexes for the columns q compares with ==; returns the columns newly indexed."""
+    a = as_analysis(q)
+    base, _ = datasets()
+    rows = base.get(a.table or "")
+    if not rows:
+        return []
+    wanted = {p.column for p in a.predicates if p.op == "==" and p.column in rows[0]}
+    added = []
+    with _datasets_lock:
+        index = dict(_indexes.get(a.table, {}))
+        for column in sorted(wanted - index.keys()):
+            index[column] = build_index(rows, column)
+            added.append(column)
+        if added:
+            _indexes[a.table] = index
+    return added
+
+def prepare(q: "str | QueryAnalysis") -> dict:
+    """Build what running q needs ahead of time (datasets, its stage plan, indexes
+    on the columns it filters); returns milliseconds per step."""
+    timings = {}
+    start = time.perf_counter()
+    datasets()
+    timings["datasets_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    start = time.perf_counter()
+    pipeline_plan(as_analysis(q).text)
+    timings["indexed"] = index_columns(q)
+    timings["plan_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return timings
+
+def run(q: str) -> List[QueryResult]:
+    base, deltas = datasets()
+    return execute_variants(q, base, deltas, BUDGET, now=NOW, indexes=_indexes)
+
+def reference_results(task: str, reference: "str | QueryAnalysis") -> List[List[tuple]] | str:
+    """Canonical reference rows per variant, or why the reference cannot be used."""
+    key = (task or "", query_hash(as_analysis(reference).text))
+    with _reference_lock:
+        cached = _reference_results.get(key)
+        if cached is not None:
+            _reference_results.move_to_end(key)
+            _stats["reference_hits"] += 1
+            return cached
+        _stats["reference_misses"] += 1
+    text = as_analysis(reference).text
+    results = run(text)
+    aborted = next((r for r in results if r.aborted), None)
+    if aborted is not None:
+        value: List[List[tuple]] | str = f"Reference query failed: {aborted.message}"
+    elif not any(results):
+        value = "Reference query returns no rows on the generated data"
+    else:
+        value = [canonical(r) for r in results]
+    with _reference_lock:
+        _reference_results[key] = value
+        while len(_reference_results) > REFERENCE_CACHE_SIZE:
+            _reference_results.popitem(last=False)
+    return value
+
+def semantic_compare(q: "str | QueryAnalysis", reference: "str | QueryAnalysis", task: str = "",
+                     rel_tol: float = REL_TOL, abs_tol: float = ABS_TOL) -> dict:
+    """{"equivalent": True/False, or None when inconclusive, "reason", ...}.
+
+    Both queries run on every dataset variant; results are compared as
+    multisets of rows with numbers equal within the tolerances."""
+    start = time.perf_counter()
+    a, ref = as_analysis(q), as_analysis(reference)
+
+    def verdict(equivalent: bool | None, reason: str, **extra: Any) -> dict:
+        return {"equivalent": equivalent, "reason": reason, "variants": VARIANTS,
+                "elapsed_ms": round((time.perf_counter() - start) * 1000, 1), **extra}
+
+    unsupported = unsupported_stages(a.text) + unsupported_stages(ref.text)
+    if unsupported:
+        return verdict(None, "Not compared: the local engine does not run " + "; ".join(unsupported[:3]))
+    expected = reference_results(task, ref)
+    if isinstance(expected, str):
+        return verdict(None, expected)
+    results = run(a.text)
+    for i, (got, want) in enumerate(zip(results, expected)):
+        if got.aborted:
+            return verdict(None, f"Query failed: {got.message}")
+        rows = canonical(got)
+        if not rows_match(rows, want, rel_tol, abs_tol):
+            missing, extra = Counter(want) - Counter(rows), Counter(rows) - Counter(want)
+            return verdict(False, f"On generated data, returns {len(rows)} rows where the reference solution returns {len(want)}"
+                           if len(rows) != len(want) else "On generated data, returns different values than the reference solution",
+                           variant=i, rows=len(rows), reference_rows=len(want),
+                           missing=[show(r) for r in list(missing.elements())[:3]],
+                           extra=[show(r) for r in list(extra.elements())[:3]])
+    return verdict(True, f"Same results as the reference solution on {len(expected)} generated datasets",
+                   rows=[len(r) for r in expected])
+
+_compared: "OrderedDict[tuple, dict]" = OrderedDict()
+COMPARE_CACHE_SIZE = 1024
+
+def compare_cached(q: str, reference: str, task: str = "") -> dict:
+    """semantic_compare memoized on the canonical hashes of both queries, so
+    resubmissions differing only in spacing, case or `and` order are not rerun
+    (and the evaluator's second assess per Analyze is free)."""
+    key = (task or "", query_hash(q), query_hash(reference))
+    with _reference_lock:
+        cached = _compared.get(key)
+        if cached is not None:
+            _compared.move_to_end(key)
+            _stats["compare_hits"] += 1
+            return cached
+        _stats["compare_misses"] += 1
+    value = semantic_compare(q, reference, task)
+    with _reference_lock:
+        _compared[key] = value
+        while len(_compared) > COMPARE_CACHE_SIZE:
+            _compared.popitem(last=False)
+    return value
+
+def cache_stats() -> dict:
+    with _reference_lock:
+        return {"entries": len(_reference_results), "compared": len(_compared),
+                "indexes": sorted(f"{t}.{c}" for t, index in _indexes.items() for c in index), **_stats}
@@ -0,0 +1,217 @@
+"""Headless load test of the Create task → Analyze flow.
+
+Simulates N students, each running CreatorAgent, SchemaAgent.compute and the
+evaluator + Tutor/Fixer/Optimizer/Explainer graph the way app.py does, against
+the fake LLM backend (agents.backends.FakeBackend). Example:
+
+    python loadtest.py --students 300 --ramp 30 --latency lognormal:1.2,0.5
+"""
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    xs = sorted(values)
+    k = (len(xs) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+def peak_rss_mb() -> float | None:
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    except Exception:
+        return None
+
+def student_query(reference: str, rng: random.Random) -> str:
+    """A submission derived from the task's reference query, mixing the kinds of answers students send."""
+    kind = rng.choice(["exact", "spacing", "wrong_eventid", "no_time", "partial"])
+    if kind == "spacing":
+        return "\n| ".join(p.strip() for p in reference.split("|"))
+    if kind == "wrong_eventid" and "4625" in reference:
+        return reference.replace("4625", "4624")
+    if kind == "no_time":
+        return re.sub(r"TimeGenerated\s*>=\s*(ago\([^)]*\)|startofday\(now\(\)\))\s*(and\s*)?", "", reference)
+    if kind == "partial":
+        return " | ".join(reference.split("|")[:2]).strip()
+    return reference
+
+class Sampler:
+    """Tracks the peak thread count while the test runs."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="loadtest-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self) -> "Sampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+def run_session(i: int, args: argparse.Namespace, llm, scheduler, start_at: float) -> dict:
+    from agents.creator import CreatorAgent
+    from agents.schema import SchemaAgent
+    from agents.scheduler import analysis_nodes
+    from agents.warmup import warm_up
+
+    rng = random.Random(f"{args.seed}-{i}")
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    t0 = time.monotonic()
+    cr = CreatorAgent(llm=llm).run({"level": rng.choice(["Easy", "Intermediate"])})
+    sv = SchemaAgent(llm=llm).compute(cr.content or "")
+    warm_up(cr.content or "", cr.query, sv)
+    t_task = time.monotonic()
+    time.sleep(args.think)
+    t1 = time.monotonic()
+    context = {
+        "query": student_query(cr.query or "", rng),
+        "task": cr.content,
+        "level": "Easy",
+        "reference_query": cr.query,
+        "schema": {
+            "suggested_table": sv.suggested_table,
+            "reason": sv.reason,
+            "relevant_columns": sv.relevant_columns,
+            "sample_rows": sv.sample_rows[:3],
+            "ranked": sv.ranked,
+        },
+    }
+    futures = scheduler.submit(analysis_nodes(context, llm, bundle=args.bundle))
+    final_keys = ["evaluation", "bundle"] if args.bundle else ["evaluation", "tutor", "fixer", "optimizer", "explainer"]
+    # The rule-based evaluation is what the app shows first (absent when the reference feedback is cached)
+    futures.get("rule_evaluation", futures["evaluation"]).result()
+    t_first = time.monotonic()
+    results = {}
+    for k in final_keys:
+        value = futures[k].result()
+        results.update(value if k == "bundle" else {k: value})
+    t_sections = time.monotonic()
+    # Sections that hit their latency budget keep enhancing in the background, as in the app
+    hedged = [r for r in results.values() if r.enhancing and r.pending is not None]
+    for r in hedged:
+        r.pending.result()
+    t_done = time.monotonic()
+    return {
+        "create_s": t_task - t0,
+        "analyze_first_s": t_first - t1,
+        "analyze_sections_s": t_sections - t1,
+        "analyze_s": t_done - t1,
+        "end_to_end_s": (t_done - t0) - args.think,
+        "hedged_sections": len(hedged),
+        "fulfills": results["evaluation"].fulfills_task,
+    }
+
+def configure(args: argparse.Namespace) -> None:
+    # Read when the agents modules are imported, so this runs first
+    os.environ["KQLTUTOR_LLM_BACKEND"] = "fake"
+    os.environ["KQLTUTOR_FAKE_LATENCY"] = args.latency
+    os.environ["KQLTUTOR_FAKE_ERROR_RATE"] = str(args.error_rate)
+    os.environ["KQLTUTOR_FAKE_429_RATE"] = str(args.throttle_rate)
+    os.environ["KQLTUTOR_FAKE_SEED"] = str(args.seed)
+    os.environ["KQLTUTOR_LLM_CACHE"] = "0"
+    os.environ["KQLTUTOR_RPM"] = str(args.rpm)
+    os.environ["KQLTUTOR_TPM"] = str(args.tpm)
+    os.environ["KQLTUTOR_REPLAY_FILE"] = args.replay or os.devnull
+    if args.llm_concurrency:
+        os.environ["KQLTUTOR_LLM_CONCURRENCY"] = str(args.llm_concurrency)
+    if args.agent_workers:
+        os.environ["KQLTUTOR_AGENT_WORKERS"] = str(args.agent_workers)
+        os.environ["KQLTUTOR_HEDGE_WORKERS"] = str(args.agent_workers)
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Load-test the Analyze pipeline against the fake LLM backend")
+    ap.add_argument("--students", type=int, default=50)
+    ap.add_argument("--ramp", type=float, default=5.0, help="seconds over which sessions start")
+    ap.add_argument("--think", type=float, default=0.0, help="seconds between task creation and Analyze")
+    ap.add_argument("--latency", default="lognormal:0.8,0.4", help="fake LLM latency distribution")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    ap.add_argument("--rpm", type=int, default=100000, help="client-side rate limit (requests per minute)")
+    ap.add_argument("--tpm", type=int, default=100000000)
+    ap.add_argument("--llm-concurrency", type=int, help="in-flight LLM calls per process (KQLTUTOR_LLM_CONCURRENCY)")
+    ap.add_argument("--agent-workers", type=int, help="agent and hedge pool sizes (KQLTUTOR_AGENT_WORKERS)")
+    ap.add_argument("--bundle", action="store_true", help="single combined LLM call for the fan-out")
+    ap.add_argument("--replay", help="replay file recorded with KQLTUTOR_LLM_BACKEND=record")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = ap.parse_args()
+    configure(args)
+
+    from agents.base import get_shared_client
+    from agents.scheduler import get_scheduler
+
+    llm = get_shared_client(True)
+    scheduler = get_scheduler()
+    threads_before = threading.active_count()
+    start = time.monotonic()
+    sessions, failures = [], []
+    with Sampler() as sampler, ThreadPoolExecutor(max_workers=max(1, args.students), thread_name_prefix="student") as pool:
+        futures = [pool.submit(run_session, i, args, llm, scheduler, start + args.ramp * i / max(1, args.students)) for i in range(args.students)]
+        for f in futures:
+            try:
+                sessions.append(f.result())
+            except Exception as e:
+                failures.append(repr(e))
+    wall = time.monotonic() - start
+
+    def dist(key: str) -> dict:
+        xs = [s[key] for s in sessions]
+        return {"p50": round(percentile(xs, 50), 3), "p95": round(percentile(xs, 95), 3), "p99": round(percentile(xs, 99), 3),
+                "max": round(max(xs), 3) if xs else 0.0}
+
+    backend = llm.backend.stats() if llm.backend is not None else {}
+    n = max(1, len(sessions))
+    report = {
+        "students": args.students,
+        "completed": len(sessions),
+        "failed": len(failures),
+        "wall_s": round(wall, 3),
+        "throughput_sessions_per_s": round(len(sessions) / wall, 3) if wall else 0.0,
+        "end_to_end_s": dist("end_to_end_s"),
+        "create_s": dist("create_s"),
+        "analyze_first_result_s": dist("analyze_first_s"),
+        "analyze_sections_s": dist("analyze_sections_s"),
+        "analyze_s": dist("analyze_s"),
+        "llm_calls_per_session": round(backend.get("calls", 0) / n, 2),
+        "hedged_sections_per_session": round(sum(s["hedged_sections"] for s in sessions) / n, 2),
+        "backend": backend,
+        "response_cache": llm.cache.stats(),
+        "rate_limiter": llm.limiter.stats(),
+        "threads": {"before": threads_before, "peak": sampler.peak_threads, "after": threading.active_count()},
+        "peak_rss_mb": round(peak_rss_mb() or 0.0, 1),
+        "errors": failures[:5],
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['completed']}/{args.students} sessions in {report['wall_s']}s "
+          f"({report['throughput_sessions_per_s']} sessions/s), {report['failed']} failed")
+    for key in ("end_to_end_s", "create_s", "analyze_first_result_s", "analyze_sections_s", "analyze_s"):
+        d = report[key]
+        print(f"  {key:<24} p50 {d['p50']:.3f}  p95 {d['p95']:.3f}  p99 {d['p99']:.3f}  max {d['max']:.3f}")
+    print(f"  LLM calls/session {report['llm_calls_per_session']}, hedged sections/session {report['hedged_sections_per_session']}")
+    print(f"  backend {backend}")
+    print(f"  response cache {report['response_cache']}")
+    print(f"  threads {report['threads']}, peak RSS {report['peak_rss_mb']} MB")
+    for e in report["errors"]:
+        print(f"  error: {e}")
+
+if __name__ == "__main__":
+    main()
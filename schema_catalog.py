@@ -1,3 +1,23 @@
+"""Table schemas for the tutor.
+
+BASE_CATALOG holds the tables the local engine runs queries on, with sample
+rows. CATALOG describes every table the tutor can suggest, one JSON file per
+table in schemas/ (or KQLTUTOR_SCHEMA_DIR): name, description, synonyms and
+columns with descriptions. Nothing is read at import; the first search builds a
+BM25 inverted index over table names, synonyms, column names and descriptions
+(keeping only the terms), and a table's full definition is parsed when a view
+needs it.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable
+
 BASE_CATALOG = {
     "SecurityEvent": {
         "columns": [
@@ -69,3 +89,205 @@ BASE_CATALOG = {
     },
 }
 
+SCHEMA_DIR = os.getenv("KQLTUTOR_SCHEMA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas"))
+# Field weights in the table index: naming a table outright decides it
+FIELD_WEIGHTS = {"name": 5.0, "synonyms": 2.0, "columns": 1.0, "description": 1.0, "column_descriptions": 0.5}
+K1 = 1.2
+B = 0.75
+COLUMN_CUTOFF = 0.35
+# Task bullet labels and filler words, which every task has
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "from", "by", "with", "and", "or", "per", "each", "is", "are",
+    "be", "as", "that", "this", "it", "its", "all", "any", "such", "than", "into", "use", "show", "find", "list", "return",
+    "table", "time", "range", "filter", "group", "output", "sort", "aggregation", "column", "value", "descend", "ascend",
+    "last", "today", "hour", "day", "ago", "now", "startofday", "count", "top", "distinct", "when", "which", "who", "what",
+}
+WORD = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
+def stem(w: str) -> str:
+    if len(w) > 4 and w.endswith("ies"):
+        return w[:-3] + "y"
+    if len(w) > 4 and w.endswith(("sses", "xes", "ches", "shes")):
+        # processes -> process, hashes -> hash
+        return w[:-2]
+    if len(w) > 5 and w.endswith("ed"):
+        return w[:-2]
+    if len(w) > 6 and w.endswith("ing"):
+        return w[:-3]
+    if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+        return w[:-1]
+    return w
+
+def term_sources(text: str) -> list[tuple[str, str]]:
+    """(term, word as written) pairs; see terms()."""
+    out = []
+    for raw in re.findall(r"[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*", text or ""):
+        parts = [w.lower() for piece in raw.split("-") for w in WORD.findall(piece)]
+        out.extend((stem(p), raw) for p in parts if p not in STOPWORDS)
+        if len(parts) > 1:
+            out.append((stem("".join(parts)), raw))
+    return out
+
+def terms(text: str) -> list[str]:
+    """Index terms: camel case and hyphens split (SigninLogs -> signin, log) and
+    also joined (signinlogs, sign-ins -> signin), lower-cased and stemmed."""
+    return [term for term, _ in term_sources(text)]
+
+def mentions(text: str, matched: Iterable[str]) -> list[str]:
+    """The words of text that produced the matched terms, as written and without
+    repeats (stems like "processe" or "sign" are not for display)."""
+    written: dict[str, str] = {}
+    for term, raw in term_sources(text):
+        written.setdefault(term, raw)
+    return list(dict.fromkeys(written.get(t, t) for t in matched))
+
+@dataclass(frozen=True)
+class Column:
+    name: str
+    type: str = "string"
+    description: str = ""
+
+@dataclass(frozen=True)
+class TableSchema:
+    name: str
+    description: str
+    synonyms: tuple[str, ...]
+    columns: tuple[Column, ...]
+    time_column: str | None
+    sample_rows: tuple[dict, ...] = field(default=(), compare=False)
+
+    @property
+    def column_names(self) -> list[str]:
+        return [c.name for c in self.columns]
+
+class BM25Index:
+    """Inverted index with BM25 ranking. Documents are weighted term counts."""
+
+    def __init__(self, docs: list[Counter]):
+        self.n = len(docs)
+        self.lengths = [sum(d.values()) for d in docs]
+        self.avg = (sum(self.lengths) / self.n) if self.n else 0.0
+        self.postings: dict[str, list[tuple[int, float]]] = {}
+        for i, d in enumerate(docs):
+            for term, tf in d.items():
+                self.postings.setdefault(term, []).append((i, tf))
+        self.idf = {t: math.log(1 + (self.n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+
+    def search(self, query_terms: list[str]) -> list[tuple[int, float, list[str]]]:
+        """(doc, score, matched terms) for every doc matching a term, best first."""
+        scores: dict[int, float] = {}
+        matched: dict[int, list[str]] = {}
+        for term in dict.fromkeys(query_terms):
+            for i, tf in self.postings.get(term, ()):
+                norm = K1 * (1 - B + B * self.lengths[i] / self.avg) if self.avg else K1
+                scores[i] = scores.get(i, 0.0) + self.idf[term] * tf * (K1 + 1) / (tf + norm)
+                matched.setdefault(i, []).append(term)
+        return sorted(((i, s, matched[i]) for i, s in scores.items()), key=lambda r: (-r[1], r[0]))
+
+def table_document(t: dict) -> Counter:
+    doc = Counter()
+    fields = {
+        "name": [t.get("name", "")],
+        "synonyms": t.get("synonyms", []),
+        "columns": [c.get("name", "") for c in t.get("columns", [])],
+        "description": [t.get("description", "")],
+        "column_descriptions": [c.get("description", "") for c in t.get("columns", [])],
+    }
+    for field_name, texts in fields.items():
+        for text in texts:
+            for term in terms(text):
+                doc[term] += FIELD_WEIGHTS[field_name]
+    return doc
+
+class SchemaCatalog:
+    """Schemas loaded lazily from a directory of <Table>.json files, with
+    BASE_CATALOG tables that have no file included from their column lists."""
+
+    def __init__(self, path: str = SCHEMA_DIR):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tables: dict[str, TableSchema] = {}
+        self._index: BM25Index | None = None
+        self._names: list[str] = []
+
+    def files(self) -> dict[str, str]:
+        try:
+            listing = sorted(os.listdir(self.path))
+        except OSError:
+            return {}
+        return {f[:-5]: os.path.join(self.path, f) for f in listing if f.endswith(".json")}
+
+    def _read(self, name: str) -> dict:
+        path = self.files().get(name)
+        if path is None:
+            base = BASE_CATALOG.get(name)
+            return {"name": name, "columns": [{"name": c} for c in base["columns"]]} if base else {}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def table(self, name: str) -> TableSchema | None:
+        t = self._tables.get(name)
+        if t is None:
+            raw = self._read(name)
+            if not raw:
+                return None
+            t = TableSchema(
+                name=raw.get("name") or name,
+                description=raw.get("description", ""),
+                synonyms=tuple(raw.get("synonyms", [])),
+                columns=tuple(Column(c["name"], c.get("type", "string"), c.get("description", "")) for c in raw.get("columns", [])),
+                time_column=raw.get("time_column", "TimeGenerated"),
+                sample_rows=tuple(BASE_CATALOG.get(name, {}).get("sample_rows", [])),
+            )
+            with self._lock:
+                self._tables[name] = t
+        return t
+
+    def names(self) -> list[str]:
+        return sorted(set(self.files()) | set(BASE_CATALOG))
+
+    def index(self) -> BM25Index:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    names = self.names()
+                    # Only the terms are kept; definitions are parsed again, on demand, by table()
+                    docs = [table_document(self._read(n)) for n in names]
+                    self._names = names
+                    self._index = BM25Index(docs)
+        return self._index
+
+    def search(self, text: str, limit: int = 5) -> tuple[tuple[str, float, tuple[str, ...]], ...]:
+        """(table, score, matched terms) for the best-matching tables; search()
+        caches this for CATALOG."""
+        index = self.index()
+        return tuple((self._names[i], score, tuple(matched)) for i, score, matched in index.search(terms(text))[:limit])
+
+    def relevant_columns(self, table: str, text: str, limit: int = 6) -> list[str]:
+        """The table's time column, then the columns whose name or description
+        match the text, best first; weak matches (below COLUMN_CUTOFF of the
+        best score) are left out."""
+        t = self.table(table)
+        if t is None:
+            return []
+        ranked = column_index(t).search(terms(text))
+        cols = [t.time_column] if t.time_column in t.column_names else []
+        cols += [t.columns[i].name for i, score, _ in ranked
+                 if score >= COLUMN_CUTOFF * ranked[0][1] and t.columns[i].name not in cols]
+        return cols[:limit]
+
+@lru_cache(maxsize=256)
+def column_index(t: TableSchema) -> BM25Index:
+    # Column names count double: "host" should prefer HostName over a description mentioning hosts
+    docs = []
+    for c in t.columns:
+        doc = Counter({term: 2.0 for term in terms(c.name)})
+        doc.update(terms(c.description))
+        docs.append(doc)
+    return BM25Index(docs)
+
+CATALOG = SchemaCatalog()
+
+@lru_cache(maxsize=1024)
+def search(text: str, limit: int = 5) -> tuple[tuple[str, float, tuple[str, ...]], ...]:
+    return CATALOG.search(text, limit)
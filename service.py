@@ -0,0 +1,294 @@
+"""Standalone HTTP service for task creation, schema views, analysis and execution.
+
+Stdlib only (asyncio streams, HTTP/1.1 with keep-alive). All requests share the
+process-wide LLM client, response cache, rate limiter and agent scheduler, so
+analysis workers scale independently of Streamlit sessions. Run with:
+
+    python service.py --port 8765
+
+Endpoints (JSON in, JSON out):
+    POST /create-task  {"level"}                                   -> task, query, schema
+    POST /schema       {"task"}                                    -> schema view
+    POST /analyze      {"task", "query", "reference_query"?, "schema"?, "bundle"?, "wait_enhanced"?}
+    POST /execute      {"query", "source"?, "task"?, "sample"?, "sample_mode"?, "seed"?, "max_rows"?}
+    POST /batch        {"requests": [{"path", "body"}, ...]}       -> responses in order
+    GET  /health
+"""
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, fields
+from typing import Any, Awaitable, Callable
+from agents.base import AgentResult, get_shared_client
+from agents.creator import CreatorAgent
+from agents.taskbank import get_task_bank
+from agents.warmup import warm_up
+from agents.schema import SchemaAgent, SchemaView
+from agents.scheduler import analysis_nodes, get_scheduler
+from kql_exec import execute_query
+
+MAX_BODY = 1 << 20
+KEEPALIVE_TIMEOUT = 30.0
+ENHANCE_WAIT = 60.0
+MAX_BATCH = 64
+DEFAULT_MAX_ROWS = 1000
+
+# Blocking work (client setup and model discovery, schema views, rule-based
+# evaluation, task creation, query execution) runs here; agent graphs run on the shared scheduler
+_pool = ThreadPoolExecutor(max_workers=int(os.getenv("KQLTUTOR_SERVICE_WORKERS", "32")), thread_name_prefix="service")
+# Identical requests in flight at the same time share one computation
+_inflight: dict[str, asyncio.Future] = {}
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def result_to_dict(r: AgentResult) -> dict:
+    return {f.name: getattr(r, f.name) for f in fields(r) if f.name != "pending"}
+
+def schema_to_dict(view: SchemaView, sample_rows: int = 3) -> dict:
+    d = asdict(view)
+    d["sample_rows"] = d["sample_rows"][:sample_rows]
+    return d
+
+def require(body: dict, key: str) -> Any:
+    value = body.get(key)
+    if value is None:
+        raise HTTPError(400, f"Missing field: {key}")
+    return value
+
+def optional_number(body: dict, key: str, kind: type, default: Any = None) -> Any:
+    """body[key] as an int or float, or default when absent; anything else is a 400."""
+    value = body.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and not float(value).is_integer()):
+        raise HTTPError(400, f"{key} must be {'an integer' if kind is int else 'a number'}")
+    return kind(value)
+
+async def run_blocking(fn: Callable, *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+
+async def create_task(body: dict) -> dict:
+    llm = await run_blocking(get_shared_client, body.get("use_llm", True))
+    cr = await run_blocking(CreatorAgent(llm=llm).run, {"level": body.get("level", "Easy")})
+    view = await run_blocking(SchemaAgent(llm=llm).compute, cr.content or "")
+    warm_up(cr.content or "", cr.query, view)
+    return {"task": cr.content, "query": cr.query, "schema": schema_to_dict(view)}
+
+async def schema(body: dict) -> dict:
+    task = str(require(body, "task"))
+    view = await run_blocking(lambda: SchemaAgent(llm=get_shared_client(False)).compute(task))
+    return schema_to_dict(view)
+
+async def analyze(body: dict) -> dict:
+    task = str(body.get("task") or "")
+    query = str(require(body, "query"))
+    llm = await run_blocking(get_shared_client, body.get("use_llm", True))
+    bundle = bool(body.get("bundle", False))
+    context = {
+        "query": query,
+        "task": task,
+        "level": body.get("level", "Easy"),
+        "reference_query": body.get("reference_query"),
+        "schema": body.get("schema") or schema_to_dict(await run_blocking(SchemaAgent(llm=llm).compute, task)),
+    }
+    # building the graph runs the rule-based evaluation, including the result comparison
+    nodes = await run_blocking(lambda: analysis_nodes(context, llm, bundle=bundle))
+    futures = get_scheduler().submit(nodes)
+    final_keys = ["evaluation", "bundle"] if bundle else ["evaluation", "tutor", "fixer", "optimizer", "explainer"]
+    values = await asyncio.gather(*(asyncio.wrap_future(futures[k]) for k in final_keys))
+    results: dict[str, AgentResult] = {}
+    for k, value in zip(final_keys, values):
+        results.update(value if k == "bundle" else {k: value})
+    if body.get("wait_enhanced"):
+        # Sections that hit their latency budget: wait for the LLM result instead of returning the rule-based one
+        for name, r in list(results.items()):
+            if r.enhancing and r.pending is not None:
+                try:
+                    value = await asyncio.wait_for(asyncio.wrap_future(r.pending), ENHANCE_WAIT)
+                    results[name] = value[name] if isinstance(value, dict) else value
+                except asyncio.TimeoutError:
+                    pass
+    return {name: result_to_dict(r) for name, r in results.items()}
+
+async def execute(body: dict) -> dict:
+    query = str(require(body, "query"))
+    source = body.get("source", "static")
+    task = str(body["task"]) if body.get("task") else None
+    sample = optional_number(body, "sample", float)
+    seed = optional_number(body, "seed", int)
+    max_rows = optional_number(body, "max_rows", int, DEFAULT_MAX_ROWS)
+    sample_mode = body.get("sample_mode", "uniform")
+    if source not in ("static", "dynamic"):
+        raise HTTPError(400, "source must be \"static\" or \"dynamic\"")
+    if sample_mode not in ("uniform", "time"):
+        raise HTTPError(400, "sample_mode must be \"uniform\" or \"time\"")
+    if sample is not None and not 0 < sample <= 1:
+        raise HTTPError(400, "sample must be in (0, 1]")
+    if max_rows < 0:
+        raise HTTPError(400, "max_rows must not be negative")
+
+    def run() -> Any:
+        view = SchemaAgent(llm=get_shared_client(False)).compute(task) if task else None
+        return execute_query(query, source=source, schema_view=view, sample=sample, sample_mode=sample_mode, seed=seed)
+
+    result = await run_blocking(run)
+    return {
+        "rows": result[:max_rows],
+        "row_count": len(result),
+        "approximate": result.approximate,
+        "sample_rate": result.sample_rate,
+        "stats": result.stats,
+        "truncated": result.truncated,
+        "aborted": result.aborted,
+        "message": result.message,
+    }
+
+async def batch(body: dict) -> dict:
+    requests = require(body, "requests")
+    if not isinstance(requests, list) or len(requests) > MAX_BATCH:
+        raise HTTPError(400, f"requests must be a list of at most {MAX_BATCH} items")
+
+    async def one(item: Any) -> dict:
+        path = item.get("path") if isinstance(item, dict) else None
+        if path == "/batch":
+            return {"status": 400, "body": {"error": "Nested batches are not supported"}}
+        status, payload = await dispatch("POST", path or "", item.get("body") if isinstance(item, dict) else None)
+        return {"status": status, "body": payload}
+
+    return {"responses": await asyncio.gather(*(one(item) for item in requests))}
+
+async def health(body: dict) -> dict:
+    llm = await run_blocking(get_shared_client, True)
+    bank = get_task_bank()
+    return {"status": "ok", "inflight": len(_inflight), "response_cache": llm.cache.stats(), "rate_limiter": llm.limiter.stats(),
+            "task_bank": bank.summary() if bank else None}
+
+ROUTES: dict[tuple[str, str], Callable[[dict], Awaitable[dict]]] = {
+    ("POST", "/create-task"): create_task,
+    ("POST", "/schema"): schema,
+    ("POST", "/analyze"): analyze,
+    ("POST", "/execute"): execute,
+    ("POST", "/batch"): batch,
+    ("GET", "/health"): health,
+}
+# Task creation is meant to vary between calls, so it is never shared
+COALESCE = {"/schema", "/analyze", "/execute"}
+
+async def dispatch(method: str, path: str, body: Any) -> tuple[int, dict]:
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        return (405 if any(p == path for _, p in ROUTES) else 404), {"error": f"No route for {method} {path}"}
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        return 400, {"error": "Request body must be a JSON object"}
+    try:
+        if path not in COALESCE:
+            return 200, await handler(body)
+        key = path + "\x00" + json.dumps(body, sort_keys=True, default=str)
+        shared = _inflight.get(key)
+        if shared is None:
+            shared = asyncio.ensure_future(handler(body))
+            _inflight[key] = shared
+            shared.add_done_callback(lambda _: _inflight.pop(key, None))
+        return 200, await asyncio.shield(shared)
+    except HTTPError as e:
+        return e.status, {"error": str(e)}
+    except Exception as e:
+        return 500, {"error": f"{type(e).__name__}: {e}"}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while True:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            if not request_line.strip():
+                break
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                await write_response(writer, 400, {"error": "Malformed request line"}, False)
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+            if "transfer-encoding" in headers:
+                await write_response(writer, 411, {"error": "Chunked request bodies are not supported"}, False)
+                break
+            try:
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                await write_response(writer, 400, {"error": "Invalid Content-Length"}, False)
+                break
+            if length > MAX_BODY:
+                await write_response(writer, 413, {"error": f"Body larger than {MAX_BODY} bytes"}, False)
+                break
+            raw = await reader.readexactly(length) if length else b""
+            try:
+                body = json.loads(raw) if raw else None
+            except json.JSONDecodeError:
+                status, payload = 400, {"error": "Body is not valid JSON"}
+            else:
+                status, payload = await dispatch(method, target.split("?", 1)[0], body)
+            await write_response(writer, status, payload, keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def write_response(writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool) -> None:
+    data = json.dumps(payload, default=str).encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        + (f"Keep-Alive: timeout={int(KEEPALIVE_TIMEOUT)}\r\n" if keep_alive else "")
+        + "\r\n"
+    )
+    writer.write(head.encode("latin-1") + data)
+    await writer.drain()
+
+async def serve(host: str, port: int) -> None:
+    server = await asyncio.start_server(handle_connection, host, port)
+    addrs = ", ".join(str(s.getsockname()) for s in server.sockets)
+    print(f"KQL Tutor service listening on {addrs}")
+    async with server:
+        await server.serve_forever()
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="KQL Tutor analysis service")
+    ap.add_argument("--host", default=os.getenv("KQLTUTOR_SERVICE_HOST", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("KQLTUTOR_SERVICE_PORT", "8765")))
+    args = ap.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
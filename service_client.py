@@ -0,0 +1,67 @@
+import http.client
+import json
+import threading
+from typing import Any
+from urllib.parse import urlparse
+from agents.base import AgentResult
+from agents.schema import SchemaView
+from kql_exec import QueryResult
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+class ServiceClient:
+    """Thin client for service.py. Each thread keeps one persistent (keep-alive)
+    connection and reconnects once if the server closed it."""
+
+    def __init__(self, base_url: str, timeout: float = 120.0):
+        url = urlparse(base_url if "//" in base_url else "http://" + base_url)
+        self.host = url.hostname or "127.0.0.1"
+        self.port = url.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method: str, path: str, body: dict | None = None) -> Any:
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                payload = json.loads(response.read() or b"{}")
+                break
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise ServiceError(response.status, payload.get("error", ""))
+        return payload
+
+    def create_task(self, level: str = "Easy", use_llm: bool = True) -> tuple[AgentResult, SchemaView]:
+        d = self.request("POST", "/create-task", {"level": level, "use_llm": use_llm})
+        return AgentResult(title="Creator", content=d["task"], query=d["query"]), SchemaView(**d["schema"])
+
+    def schema(self, task: str) -> SchemaView:
+        return SchemaView(**self.request("POST", "/schema", {"task": task}))
+
+    def analyze(self, context: dict, bundle: bool = False, use_llm: bool = True, wait_enhanced: bool = True) -> dict[str, AgentResult]:
+        body = {k: context.get(k) for k in ("query", "task", "level", "reference_query", "schema")}
+        body.update({"bundle": bundle, "use_llm": use_llm, "wait_enhanced": wait_enhanced})
+        return {name: AgentResult(**r) for name, r in self.request("POST", "/analyze", body).items()}
+
+    def execute(self, query: str, source: str = "static", task: str | None = None, sample: float | None = None, sample_mode: str = "uniform") -> QueryResult:
+        d = self.request("POST", "/execute", {"query": query, "source": source, "task": task, "sample": sample, "sample_mode": sample_mode})
+        return QueryResult(d["rows"], approximate=d["approximate"], sample_rate=d["sample_rate"], stats=d["stats"],
+                           truncated=d["truncated"], aborted=d["aborted"], message=d["message"])